@@ -230,7 +230,7 @@ class TensorboardCallback(pl.callbacks.Callback):
 
         # Given the sample, make the prediction with the PyTorch Lightning Module
         with torch.no_grad():
-            outputs = pl_module(batch['image'])        
+            outputs = pl_module(batch['image'], batch.get('intrinsics', None))        
 
         # Create the summary figure
         summary_fig = tools.vz.compare_mask_performance(
@@ -265,7 +265,7 @@ class TensorboardCallback(pl.callbacks.Callback):
 
         # Given the sample, make the prediciton with the PyTorch Lightning Moduel
         with torch.no_grad():
-            outputs = pl_module(batch['image'])
+            outputs = pl_module(batch['image'], batch.get('intrinsics', None))
 
         # Create the pose figure
         summary_fig = tools.vz.compare_quat_performance(
@@ -298,7 +298,7 @@ class TensorboardCallback(pl.callbacks.Callback):
 
         # Given the sample, make the prediciton with the PyTorch Lightning Moduel
         with torch.no_grad():
-            outputs = pl_module(batch['image'])
+            outputs = pl_module(batch['image'], batch.get('intrinsics', None))
 
         # Create the pose figure
         summary_fig = tools.vz.compare_xy_performance(
@@ -332,7 +332,7 @@ class TensorboardCallback(pl.callbacks.Callback):
 
         # Given the sample, make the prediciton with the PyTorch Lightning Moduel
         with torch.no_grad():
-            outputs = pl_module(batch['image'])
+            outputs = pl_module(batch['image'], batch.get('intrinsics', None))
 
         # Create the pose figure
         summary_fig = tools.vz.compare_z_performance(
@@ -365,7 +365,7 @@ class TensorboardCallback(pl.callbacks.Callback):
 
         # Given the sample, make the prediciton with the PyTorch Lightning Moduel
         with torch.no_grad():
-            outputs = pl_module(batch['image'])
+            outputs = pl_module(batch['image'], batch.get('intrinsics', None))
 
         # Create the pose figure
         summary_fig = tools.vz.compare_scales_performance(
@@ -404,7 +404,7 @@ class TensorboardCallback(pl.callbacks.Callback):
 
         # Given the sample, make the prediciton with the PyTorch Lightning Moduel
         with torch.no_grad():
-            outputs = pl_module(batch['image'].float())
+            outputs = pl_module(batch['image'].float(), batch.get('intrinsics', None))
 
         # Create summary for the pose
         summary_fig = tools.vz.compare_hough_voting_performance(
@@ -441,7 +441,7 @@ class TensorboardCallback(pl.callbacks.Callback):
 
         # Given the sample, make the prediciton with the PyTorch Lightning Moduel
         with torch.no_grad():
-            outputs = pl_module(batch['image'].float())
+            outputs = pl_module(batch['image'].float(), batch.get('intrinsics', None))
 
         # Determine matches between the aggreated ground truth and preds
         gt_pred_matches = lib.mg.batchwise_find_matches(
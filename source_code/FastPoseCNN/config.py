@@ -28,6 +28,24 @@ class DEFAULT_POSE_HPARAM(argparse.Namespace):
     #SELECTED_CLASSES = ['bg','camera','laptop']
     SELECTED_CLASSES = tools.pj.constants.CAMERA_CLASSES 
     CKPT_SAVE_FREQUENCY = 5
+    USE_SHARDS = False # Read from the memory-mapped shards (tools/shard_tools.py)
+    USE_STREAMING = False # Stream the tar shards sequentially (tools/shard_tools.py --FORMAT tar)
+    SUBSET_STRATEGY = 'ordered' # 'ordered', 'random' or 'stratified' (TRAIN_SIZE/VALID_SIZE subsets)
+    SUBSET_SEED = 0
+    SAMPLE_CACHE_SPLITS = '' # Splits with a shared-memory decoded-sample cache, e.g. 'valid' or 'train,valid'
+    SAMPLE_CACHE_GB = 4.0
+    PREFETCH_BATCHES = 0 # Batches kept in flight by the tools.ds.PrefetchLoader (0 = disabled)
+    BATCH_AUGMENTATION = False # Augment the collated training batches in the training device
+    DEVICE_NORMALIZATION = False # Ship uint8 images from the workers and normalize them in the device
+    RESOLUTION_SCALE = 1.0 # 1.0, 0.5 or 0.25, pre-downsampled splits (tools/pyramid_tools.py)
+    READAHEAD_DEPTH = 0 # Samples read ahead by each worker's threads (0 = disabled), for NFS-like storage
+    READAHEAD_THREADS = 4
+    STAGING_GB = 0.0 # Local copies (STAGING_DIR in .env) of the dataset files on first access (0 = disabled)
+    STAGING_CHECK_SOURCE = False # Compare the staged files with the network mount on every access
+    CHECK_TARGETS = False # Compare the meta+ files with the precomputed targets (tools/target_tools.py) once at setup
+    CROP_SIZE = 0 # Object-centric training crops (multiple of 32, 0 = full images), e.g. for HEAD_TRAINING
+    CROP_MARGIN = 0.25 # Context around the instance's bounding box within the crops
+    SHARED_COLLATE = False # Workers collate the samples directly into shared memory batch tensors
 
     # Run Specifications
     CUDA_VISIBLE_DEVICES = '2' # '0,1,2,3'
@@ -82,6 +100,8 @@ class DEFAULT_POSE_HPARAM(argparse.Namespace):
     BACKBONE_ARCH = 'FPN'
     ENCODER = 'resnet18' #'resnext50_32x4d'
     ENCODER_WEIGHTS = 'imagenet'
+    FUSED_DECODER = False # Run the PoseRegressor's four decoders and heads as one fused pass (lib/fused_decoder.py)
+    PRECISION = 'fp32' # 'fp32', 'fp32_channels_last' or 'bf16' (channels-last and bf16 autocast of the encoder, decoders and heads, bf16 requires torch>=1.10, lib/precision.py)
 
     # Algorithmic Parameters
     
@@ -100,6 +120,15 @@ class DEFAULT_POSE_HPARAM(argparse.Namespace):
     ### Pruning Method Parameters (IQR)
     IQR_MULTIPLIER=1.5
 
+    ## Export Parameters (export.py and lib/exportable.py)
+    INFERENCE_BACKEND = 'torch' # 'torch', 'torchscript' or 'onnxruntime' (exported with export.py)
+    EXPORT_MAX_INSTANCES = 32 # Instances per batch of the exported post-processing (fixed shapes)
+    EXPORT_LABEL_ITERATIONS = 64 # Propagation steps of the exported instance labeling
+
+    ## Quantization Parameters (quantize.py and lib/quantization.py)
+    QUANTIZED = False # Load the INT8 checkpoint (<ckpt>_int8.pth) for CPU evaluation and inference
+    QUANT_CALIBRATION_BATCHES = 200 # CAMERA validation batches observed by the calibration
+
 class MASK_TRAINING(DEFAULT_POSE_HPARAM):
 
     FREEZE_ENCODER = False
@@ -46,6 +46,75 @@ DRAW = True
 TOTAL_DRAW_IMAGES = 10
 APS_NUM_OF_POINTS = 50
 
+#-------------------------------------------------------------------------------
+# Functions
+
+def collect_raw_data(all_matches, HPARAM):
+
+    # Raw data
+    raw_data = {
+        '3d_iou': {},
+        'degree_error': {},
+        'offset_error': {}
+        }
+
+    # For each match calculate the 3D IoU, degree error, and offset error 
+    for match in tqdm.tqdm(all_matches):
+
+        # Catching no-instance scenario
+        if type(match) == type(None) or 'quaternion' not in match.keys():
+            continue
+
+        # Identify all the classes present in the match
+        classes = match['class_ids']
+
+        for class_id in torch.unique(classes):
+
+            # Identify the instances of this class
+            class_instances = torch.where(classes == class_id)[0]
+
+            # Obtaining essential data
+            gt_q = match['quaternion'][0][class_instances]
+            pred_q = match['quaternion'][1][class_instances]
+            gt_RTs = match['RT'][0][class_instances]
+            pred_RTs = match['RT'][1][class_instances]
+            gt_scales = match['scales'][0][class_instances]
+            pred_scales = match['scales'][1][class_instances]
+
+            # Calculating the distance between the quaternions
+            degree_distance = lib.gtf.get_quat_distance(
+                gt_q, 
+                pred_q,
+                match['symmetric_ids'][class_instances]
+            )
+
+            # Calculating the iou 3d for between the ground truth and predicted 
+            ious_3d = lib.gtf.get_3d_ious(gt_RTs, pred_RTs, gt_scales, pred_scales)
+
+            # Determing the offset errors
+            offset_errors = lib.gtf.from_RTs_get_T_offset_errors(
+                gt_RTs,
+                pred_RTs
+            )
+
+            # Store data
+            if int(class_id) not in raw_data['degree_error'].keys():
+                raw_data['degree_error'][int(class_id)] = [degree_distance]
+                raw_data['3d_iou'][int(class_id)] = [ious_3d]
+                raw_data['offset_error'][int(class_id)] = [offset_errors]
+            else:
+                raw_data['degree_error'][int(class_id)].append(degree_distance)
+                raw_data['3d_iou'][int(class_id)].append(ious_3d)
+                raw_data['offset_error'][int(class_id)].append(offset_errors)
+
+    # After the loop of the matches
+    for class_id in range(1, len(HPARAM.SELECTED_CLASSES)): # -1 to remove bg
+        raw_data['degree_error'][class_id] = torch.cat(raw_data['degree_error'][class_id])
+        raw_data['3d_iou'][class_id] = torch.cat(raw_data['3d_iou'][class_id])
+        raw_data['offset_error'][class_id] = torch.cat(raw_data['offset_error'][class_id])
+
+    return raw_data
+
 #-------------------------------------------------------------------------------
 # File Main
 
@@ -64,8 +133,17 @@ if __name__ == '__main__':
     # Updating the HPARAMs
     parser.parse_args(namespace=HPARAM)
 
+    # The INT8 checkpoint's (quantize.py) and the channels-last / bf16
+    # (PRECISION) results are stored separately
+    if HPARAM.QUANTIZED:
+        tag = '_int8'
+    elif HPARAM.PRECISION != 'fp32':
+        tag = f'_{HPARAM.PRECISION}'
+    else:
+        tag = ''
+
     # Construct the json path depending on the PATH string
-    pth_path = PATH.parent.parent / f'{PATH.stem}_{HPARAM.VALID_SIZE}_results.pth'
+    pth_path = PATH.parent.parent / f'{PATH.stem}{tag}_{HPARAM.VALID_SIZE}_results.pth'
 
     # Constructing folder of images if not existent
     images_path = PATH.parent.parent / 'images'
@@ -80,7 +158,10 @@ if __name__ == '__main__':
         matplotlib.use('Agg')
 
     # Getting the intrinsics for the dataset selected
-    HPARAM.NUMPY_INTRINSICS = tools.pj.constants.INTRINSICS[HPARAM.DATASET_NAME]
+    HPARAM.NUMPY_INTRINSICS = tools.pt.scale_intrinsics(
+        tools.pj.constants.INTRINSICS[HPARAM.DATASET_NAME],
+        HPARAM.RESOLUTION_SCALE
+    )
     
     # Making the evaluation actually do something useful.
     HPARAM.PERFORM_AGGREGATION = True 
@@ -92,10 +173,16 @@ if __name__ == '__main__':
     # or visualizing the results of the model's performance
     if COLLECT_DATA:
 
-        model = lib.pose_regressor.MODELS[HPARAM.MODEL].load_from_ckpt(
-            PATH,
-            HPARAM
-        )
+        if HPARAM.QUANTIZED:
+            model = lib.quantization.load_quantized_model(
+                PATH.with_name(f'{PATH.stem}_int8.pth'),
+                HPARAM
+            )
+        else:
+            model = lib.pose_regressor.MODELS[HPARAM.MODEL].load_from_ckpt(
+                PATH,
+                HPARAM
+            )
 
         # Put the model into evaluation mode
         #model.to('cuda') # ! Make it work with multiple GPUs
@@ -110,7 +197,25 @@ if __name__ == '__main__':
             encoder=HPARAM.ENCODER,
             encoder_weights=HPARAM.ENCODER_WEIGHTS,
             train_size=HPARAM.TRAIN_SIZE,
-            valid_size=HPARAM.VALID_SIZE
+            valid_size=HPARAM.VALID_SIZE,
+            use_shards=HPARAM.USE_SHARDS,
+            use_streaming=HPARAM.USE_STREAMING,
+            subset_strategy=HPARAM.SUBSET_STRATEGY,
+            subset_seed=HPARAM.SUBSET_SEED,
+            prefetch_batches=HPARAM.PREFETCH_BATCHES,
+            prefetch_device='cuda' if HPARAM.NUM_GPUS > 0 else None,
+            cache_splits=[x for x in HPARAM.SAMPLE_CACHE_SPLITS.split(',') if x],
+            cache_bytes=int(HPARAM.SAMPLE_CACHE_GB * 1024**3),
+            device_normalization=HPARAM.DEVICE_NORMALIZATION,
+            resolution_scale=HPARAM.RESOLUTION_SCALE,
+            readahead_depth=HPARAM.READAHEAD_DEPTH,
+            readahead_threads=HPARAM.READAHEAD_THREADS,
+            staging_bytes=int(HPARAM.STAGING_GB * 1024**3),
+            staging_check_source=HPARAM.STAGING_CHECK_SOURCE,
+            check_targets=HPARAM.CHECK_TARGETS,
+            crop_size=HPARAM.CROP_SIZE,
+            crop_margin=HPARAM.CROP_MARGIN,
+            shared_collate=HPARAM.SHARED_COLLATE
         )
 
         # Setup the dataset
@@ -130,6 +235,9 @@ if __name__ == '__main__':
         # and the ground truths
         for batch in tqdm.tqdm(datamodule.val_dataloader()):
 
+            # Normalizing the uint8 images (if DEVICE_NORMALIZATION)
+            batch = datamodule.normalize_batch(batch)
+
             # Forward pass
             with torch.no_grad():
                 outputs = model.forward(batch['image'])
@@ -178,13 +286,6 @@ if __name__ == '__main__':
 
     else:
 
-        # Raw data
-        raw_data = {
-            '3d_iou': {},
-            'degree_error': {},
-            'offset_error': {}
-            }
-
         # Defining the nature of the metric (higher/lower is better)
         metrics_operator = {
             '3d_iou': torch.greater,
@@ -214,59 +315,7 @@ if __name__ == '__main__':
             sys.exit(0)
 
         # For each match calculate the 3D IoU, degree error, and offset error 
-        for match in tqdm.tqdm(all_matches):
-
-            # Catching no-instance scenario
-            if type(match) == type(None) or 'quaternion' not in match.keys():
-                continue
-
-            # Identify all the classes present in the match
-            classes = match['class_ids']
-
-            for class_id in torch.unique(classes):
-
-                # Identify the instances of this class
-                class_instances = torch.where(classes == class_id)[0]
-
-                # Obtaining essential data
-                gt_q = match['quaternion'][0][class_instances]
-                pred_q = match['quaternion'][1][class_instances]
-                gt_RTs = match['RT'][0][class_instances]
-                pred_RTs = match['RT'][1][class_instances]
-                gt_scales = match['scales'][0][class_instances]
-                pred_scales = match['scales'][1][class_instances]
-
-                # Calculating the distance between the quaternions
-                degree_distance = lib.gtf.get_quat_distance(
-                    gt_q, 
-                    pred_q,
-                    match['symmetric_ids'][class_instances]
-                )
-
-                # Calculating the iou 3d for between the ground truth and predicted 
-                ious_3d = lib.gtf.get_3d_ious(gt_RTs, pred_RTs, gt_scales, pred_scales)
-
-                # Determing the offset errors
-                offset_errors = lib.gtf.from_RTs_get_T_offset_errors(
-                    gt_RTs,
-                    pred_RTs
-                )
-
-                # Store data
-                if int(class_id) not in raw_data['degree_error'].keys():
-                    raw_data['degree_error'][int(class_id)] = [degree_distance]
-                    raw_data['3d_iou'][int(class_id)] = [ious_3d]
-                    raw_data['offset_error'][int(class_id)] = [offset_errors]
-                else:
-                    raw_data['degree_error'][int(class_id)].append(degree_distance)
-                    raw_data['3d_iou'][int(class_id)].append(ious_3d)
-                    raw_data['offset_error'][int(class_id)].append(offset_errors)
-
-        # After the loop of the matches
-        for class_id in range(1, len(HPARAM.SELECTED_CLASSES)): # -1 to remove bg
-            raw_data['degree_error'][class_id] = torch.cat(raw_data['degree_error'][class_id])
-            raw_data['3d_iou'][class_id] = torch.cat(raw_data['3d_iou'][class_id])
-            raw_data['offset_error'][class_id] = torch.cat(raw_data['offset_error'][class_id])
+        raw_data = collect_raw_data(all_matches, HPARAM)
 
         # Creating a list of all the plotted classes
         plot_classes = HPARAM.SELECTED_CLASSES[1:] + ['mean']
@@ -289,7 +338,7 @@ if __name__ == '__main__':
 
         # Saving the plot
         fig.savefig(
-            str(PATH.parent.parent / f'all_metrics_{HPARAM.VALID_SIZE}_aps.png')
+            str(PATH.parent.parent / f'all_metrics{tag}_{HPARAM.VALID_SIZE}_aps.png')
         )
 
         # Determine the APs values for table data
@@ -300,5 +349,26 @@ if __name__ == '__main__':
         )
 
         # Storing the table critical values into an excel sheet
-        excel_path = PATH.parent.parent / f'{HPARAM.VALID_SIZE}_aps_values_table.xlsx'
-        tools.et.save_aps_to_excel(excel_path, table_metrics_thresholds, table_aps, plot_classes)
\ No newline at end of file
+        excel_path = PATH.parent.parent / f'{HPARAM.VALID_SIZE}{tag}_aps_values_table.xlsx'
+        tools.et.save_aps_to_excel(excel_path, table_metrics_thresholds, table_aps, plot_classes)
+
+        # Accuracy report of the INT8 checkpoint or the PRECISION: its
+        # table's difference with the fp32 table (if evaluated with the same
+        # VALID_SIZE)
+        fp32_pth_path = PATH.parent.parent / f'{PATH.stem}_{HPARAM.VALID_SIZE}_results.pth'
+        if tag and fp32_pth_path.exists():
+
+            fp32_table_aps = lib.gtf.calculate_aps(
+                collect_raw_data(torch.load(fp32_pth_path), HPARAM),
+                table_metrics_thresholds,
+                metrics_operator
+            )
+            delta_table_aps = {
+                k:{c:table_aps[k][c] - fp32_table_aps[k][c] for c in table_aps[k].keys()} 
+                for k in table_aps.keys()
+            }
+
+            excel_path = PATH.parent.parent / f'{HPARAM.VALID_SIZE}{tag}_vs_fp32_aps_values_table.xlsx'
+            tools.et.save_aps_to_excel(excel_path, table_metrics_thresholds, delta_table_aps, plot_classes)
+            print(f"{tag[1:].upper()} - fp32 APs ({excel_path}):")
+            pprint(delta_table_aps)
\ No newline at end of file
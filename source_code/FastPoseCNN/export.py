@@ -0,0 +1,64 @@
+# External Imports
+import os
+import sys
+import pathlib
+import torch
+import argparse
+
+# Local Imports
+import setup_env
+import tools
+import config
+import lib
+
+#-------------------------------------------------------------------------------
+# Constants
+
+PATH = pathlib.Path('/home/students/edavalos/GitHub/FastPoseCNN/source_code/FastPoseCNN/logs/21-03-06/16-36-BASE_TEST-CAMERA-resnet18-imagenet/_/checkpoints/last.ckpt')
+HPARAM = config.DEFAULT_POSE_HPARAM()
+
+# Input resolution of the exported graphs (before RESOLUTION_SCALE and the
+# pyramid padding)
+IMAGE_SIZE = (480, 640)
+
+#-------------------------------------------------------------------------------
+# File Main
+
+if __name__ == '__main__':
+
+    # Parse arguments and replace global variables if needed
+    parser = argparse.ArgumentParser(description='Export the model and its post-processing to TorchScript and ONNX')
+
+    # Automatically adding all the attributes of the HPARAM to the parser
+    for attr in dir(HPARAM):
+        if '__' in attr or attr[0] == '_': # Private or magic attributes
+            continue
+
+        parser.add_argument(f'--{attr}', type=type(getattr(HPARAM, attr)), default=getattr(HPARAM, attr))
+
+    # Updating the HPARAMs
+    parser.parse_args(namespace=HPARAM)
+
+    # Getting the intrinsics for the dataset selected
+    HPARAM.NUMPY_INTRINSICS = tools.pt.scale_intrinsics(
+        tools.pj.constants.INTRINSICS[HPARAM.DATASET_NAME],
+        HPARAM.RESOLUTION_SCALE
+    )
+    image_size = tools.pt.get_scaled_image_size(IMAGE_SIZE, HPARAM.RESOLUTION_SCALE)
+
+    # Construct model (if ckpt=None, it will just load as is)
+    model = lib.pose_regressor.MODELS[HPARAM.MODEL].load_from_ckpt(
+        PATH,
+        HPARAM
+    )
+    model.eval()
+
+    # Network and post-processing as a single traceable module
+    exportable = lib.exportable.ExportablePoseRegressor(model, HPARAM).eval()
+
+    # Saving the exported graphs next to the checkpoint (the paths used by
+    # inference.py's INFERENCE_BACKEND)
+    lib.exportable.export_torchscript(exportable, PATH.with_suffix('.pt'), image_size)
+    lib.exportable.export_onnx(exportable, PATH.with_suffix('.onnx'), image_size)
+
+    print(f"Exported {PATH.with_suffix('.pt')} and {PATH.with_suffix('.onnx')} ({image_size[0]}x{image_size[1]})")
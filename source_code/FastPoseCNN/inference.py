@@ -41,15 +41,36 @@ for attr in dir(HPARAM):
 parser.parse_args(namespace=HPARAM)
 
 # Getting the intrinsics for the dataset selected
-HPARAM.NUMPY_INTRINSICS = tools.pj.constants.INTRINSICS[HPARAM.DATASET_NAME]
+HPARAM.NUMPY_INTRINSICS = tools.pt.scale_intrinsics(
+    tools.pj.constants.INTRINSICS[HPARAM.DATASET_NAME],
+    HPARAM.RESOLUTION_SCALE
+)
 HPARAM.BATCH_SIZE = 1
 HPARAM.VALID_SIZE = 20
 
-# Construct model (if ckpt=None, it will just load as is)
-model = lib.pose_regressor.MODELS[HPARAM.MODEL].load_from_ckpt(
-    PATH,
-    HPARAM
-)
+# The channels-last and bf16 modes (PRECISION) are part of the fp32 torch model
+# only
+if HPARAM.PRECISION != 'fp32' and (HPARAM.INFERENCE_BACKEND != 'torch' or HPARAM.QUANTIZED):
+    raise RuntimeError(f'PRECISION={HPARAM.PRECISION} requires INFERENCE_BACKEND=torch and QUANTIZED=False')
+
+# Construct model (if ckpt=None, it will just load as is), or load the graph
+# exported by export.py next to the checkpoint
+if HPARAM.INFERENCE_BACKEND == 'torch' and HPARAM.QUANTIZED:
+    model = lib.quantization.load_quantized_model(
+        PATH.with_name(f'{PATH.stem}_int8.pth'),
+        HPARAM
+    )
+elif HPARAM.INFERENCE_BACKEND == 'torch':
+    model = lib.pose_regressor.MODELS[HPARAM.MODEL].load_from_ckpt(
+        PATH,
+        HPARAM
+    )
+elif HPARAM.INFERENCE_BACKEND == 'torchscript':
+    model = lib.exportable.TorchScriptBackend(PATH.with_suffix('.pt'))
+elif HPARAM.INFERENCE_BACKEND == 'onnxruntime':
+    model = lib.exportable.OnnxRuntimeBackend(PATH.with_suffix('.onnx'))
+else:
+    raise RuntimeError(f'Invalid HPARAM.INFERENCE_BACKEND: {HPARAM.INFERENCE_BACKEND}')
 
 # Put the model into evaluation mode
 #model.to('cuda') # ! Make it work with multiple GPUs
@@ -64,7 +85,25 @@ datamodule = tools.ds.PoseRegressionDataModule(
     encoder=HPARAM.ENCODER,
     encoder_weights=HPARAM.ENCODER_WEIGHTS,
     train_size=HPARAM.TRAIN_SIZE,
-    valid_size=HPARAM.VALID_SIZE
+    valid_size=HPARAM.VALID_SIZE,
+    use_shards=HPARAM.USE_SHARDS,
+    use_streaming=HPARAM.USE_STREAMING,
+    subset_strategy=HPARAM.SUBSET_STRATEGY,
+    subset_seed=HPARAM.SUBSET_SEED,
+    prefetch_batches=HPARAM.PREFETCH_BATCHES,
+    prefetch_device='cuda' if HPARAM.NUM_GPUS > 0 else None,
+    cache_splits=[x for x in HPARAM.SAMPLE_CACHE_SPLITS.split(',') if x],
+    cache_bytes=int(HPARAM.SAMPLE_CACHE_GB * 1024**3),
+    device_normalization=HPARAM.DEVICE_NORMALIZATION,
+    resolution_scale=HPARAM.RESOLUTION_SCALE,
+    readahead_depth=HPARAM.READAHEAD_DEPTH,
+    readahead_threads=HPARAM.READAHEAD_THREADS,
+    staging_bytes=int(HPARAM.STAGING_GB * 1024**3),
+    staging_check_source=HPARAM.STAGING_CHECK_SOURCE,
+    check_targets=HPARAM.CHECK_TARGETS,
+    crop_size=HPARAM.CROP_SIZE,
+    crop_margin=HPARAM.CROP_MARGIN,
+    shared_collate=HPARAM.SHARED_COLLATE
 )
 
 # Setup the dataset
@@ -87,6 +126,9 @@ for batch_id, batch in tqdm.tqdm(enumerate(datamodule.val_dataloader())):
     if type(batch) == type(None):
         continue
 
+    # Normalizing the uint8 images (if DEVICE_NORMALIZATION)
+    batch = datamodule.normalize_batch(batch)
+
     # Forward pass
     tic = time.time()
     
@@ -7,4 +7,7 @@ import loss
 import gpu_tensor_funcs as gtf
 import matching as mg
 import metrics 
-import pose_regressor
\ No newline at end of file
+import pose_regressor
+import exportable
+import quantization
+import precision
\ No newline at end of file
@@ -22,7 +22,10 @@ except ImportError:
     pass
 
 import hough_voting as hv
+import instance_masks as im
+import containers as ct
 import gpu_tensor_funcs as gtf
+import precision as pc
 
 class AggregationLayer(nn.Module):
 
@@ -51,6 +54,7 @@ class AggregationLayer(nn.Module):
             ],
         ])
 
+    @pc.fp32_island
     def forward(
         self, 
         cat_mask: torch.Tensor, 
@@ -88,28 +92,12 @@ class AggregationLayer(nn.Module):
             # Storing the number of instances to keep record
             complete_agg_data['class_ids'].append(class_instance_identifiers)
 
-            # Construct pure instance masks
-            sample_id_for_instances = torch.zeros(
-                (total_num_of_instances,), 
-                dtype=torch.int64, 
-                device=cat_mask.device
+            # Construct the compact instance masks and the sample (element) id
+            # of each instance directly from the labeled masks
+            pure_instance_masks, sample_id_for_instances = im.InstanceMasks.from_label_map(
+                instance_masks.to(cat_mask.device),
+                total_num_of_instances
             )
-            pure_instance_masks = torch.empty(
-                (total_num_of_instances, h, w), 
-                device=cat_mask.device
-            )
-
-            # For each instance, find its corresponding element and grab its mask
-            for i in range(1, total_num_of_instances+1):
-
-                # Determine which sample within the entire batch the instance is located
-                element_id = torch.where(instance_masks == i)[0][0]
-
-                # Storing the specific instance mask into the pure_instance_masks
-                pure_instance_masks[i-1] = (instance_masks[element_id] == i)
-
-                # Storing the element id of the instance masks into a tensor for record
-                sample_id_for_instances[i-1] = element_id
 
             # Storing the instances masks and their sample ids
             complete_agg_data['sample_ids'].append(sample_id_for_instances)
@@ -117,44 +105,49 @@ class AggregationLayer(nn.Module):
 
         # Concatenate all of the classes data into a single batch container
         for key in complete_agg_data.keys():
-            complete_agg_data[key] = torch.cat(complete_agg_data[key], dim=0)
+            if key == 'instance_masks':
+                complete_agg_data[key] = im.InstanceMasks.cat(complete_agg_data[key])
+            else:
+                complete_agg_data[key] = torch.cat(complete_agg_data[key], dim=0)
 
-        # Obtain the instance's values (quaternion, z, scales)
-        for data_key in ['quaternion', 'scales', 'xy', 'z']:
+        # Obtain the pixels of all the instances (no dense masks needed)
+        instance_ids, ys, xs = complete_agg_data['instance_masks'].pixel_indices()
+        pixel_sample_ids = complete_agg_data['sample_ids'][instance_ids]
+        mask_size = complete_agg_data['instance_masks'].areas()
 
-            # Matching the categorical data to the instance's quantity and order
-            instance_data = data[data_key][complete_agg_data['sample_ids']]
+        # Obtain the instance's values (quaternion, z, scales)
+        for data_key in ['quaternion', 'scales', 'z']:
 
-            # Need to expand the instance_data when data_key == z
+            # Gathering the categorical data of the instances' pixels (P, C)
             if data_key == 'z':
-                instance_data = torch.unsqueeze(instance_data, dim=1)
-
-            # Obtaining the data for the instance
-            masked_data = torch.unsqueeze(complete_agg_data['instance_masks'], dim=1) * instance_data
+                pixel_data = torch.unsqueeze(data[data_key][pixel_sample_ids, ys, xs], dim=1)
+            else:
+                pixel_data = data[data_key][pixel_sample_ids, :, ys, xs]
 
             # Take the average of quaternions, scales and z's logit value
-            if data_key in ['quaternion', 'scales', 'z']:
-                total_val = torch.sum(masked_data, dim=(-2, -1))
-                mask_size = torch.sum(complete_agg_data['instance_masks'], dim=(-2, -1))
-                agg_data = torch.div(total_val, torch.unsqueeze(mask_size.T, dim=1))
-
-                # Undoing the torch.log in data embedding
-                if data_key == 'z':
-                    agg_data = torch.exp(agg_data)
-
-                # Normalizing data
-                elif data_key == 'quaternion':
-                    agg_data = gtf.normalize(agg_data, dim=1)
+            total_val = torch.zeros(
+                (len(complete_agg_data['instance_masks']), pixel_data.shape[1]),
+                dtype=pixel_data.dtype,
+                device=pixel_data.device
+            ).index_add(0, instance_ids, pixel_data)
+            agg_data = torch.div(total_val, torch.unsqueeze(mask_size, dim=1).to(total_val.dtype))
+
+            # Undoing the torch.log in data embedding
+            if data_key == 'z':
+                agg_data = torch.exp(agg_data)
 
-            # Saving the masked unit vector mask since we need to perform hough
-            # voting for this section.
-            elif data_key == 'xy':
-                agg_data = masked_data
+            # Normalizing data
+            elif data_key == 'quaternion':
+                agg_data = gtf.normalize(agg_data, dim=1)
 
             # Storing the mean of the instances to complete_agg_data
             complete_agg_data[data_key] = agg_data
+
+        # Saving the unit vector image since we need to perform hough voting
+        # with the instances' pixels
+        complete_agg_data['xy_img'] = data['xy']
  
-        return complete_agg_data
+        return ct.AggData(**complete_agg_data)
 
     def batchwise_break_segmentation_mask(self, class_mask):
 
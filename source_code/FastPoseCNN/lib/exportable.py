@@ -0,0 +1,775 @@
+import os
+import sys
+import time
+import logging
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+# Local imports
+sys.path.append(os.getenv("TOOLS_DIR"))
+
+import instance_masks as im
+import containers as ct
+import gpu_tensor_funcs as gtf
+
+#-------------------------------------------------------------------------------
+# Constants
+
+# Outputs of the exported graphs (in order)
+OUTPUT_NAMES = [
+    'mask', 'cat_mask', # Pixel-wise
+    'quaternion_img', 'scales_img', 'xy_img', 'z_img', # Class compressed
+    'instance_map', 'valid', 'class_ids', 'sample_ids', # Instances
+    'quaternion', 'scales', 'z', # Aggregation
+    'xy', 'hypothesis', 'pruned_hypothesis', # Hough Voting
+    'R', 'T', 'RT', # RT
+    'converged' # Instance labeling
+]
+
+# Per-instance outputs (the first valid.sum() rows are the instances)
+INSTANCE_OUTPUT_NAMES = [
+    'class_ids', 'sample_ids', 'quaternion', 'scales', 'z', 'xy',
+    'hypothesis', 'pruned_hypothesis', 'R', 'T', 'RT'
+]
+
+# Spreads the second point of the hypotheses' pairs within the instances
+GOLDEN_RATIO = (5 ** 0.5 - 1) / 2
+
+# Pixels per chunk of the hypotheses' votes (bounds the PxHx2 intermediates)
+VOTES_CHUNK_SIZE = 16384
+
+LOGGER = logging.getLogger('fastposecnn')
+
+#-------------------------------------------------------------------------------
+# Exportable Model
+
+# The post-processing of the PoseRegressor (AggregationLayer, HoughVotingLayer
+# and samplewise_get_RT) with tensor-only operations and fixed shapes, so that
+# it is traced (TorchScript) and exported (ONNX) with the network:
+# - The instances are the 4-connected components of each class, labeled by
+#   propagating the smallest pixel index (a fixed number of iterations, with
+#   pointer jumping) instead of scipy/cupy's label. The converged output is
+#   False if the last iteration still changed the labels (components split
+#   into several instances, increase EXPORT_LABEL_ITERATIONS).
+# - At most EXPORT_MAX_INSTANCES instances per batch, in the same order as the
+#   AggregationLayer's (class, sample and raster order), the invalid rows are
+#   padding (valid=False).
+# - The hypotheses' point pairs are spread deterministically within the
+#   instances (no random sampling), and the 2x2 systems, the pruning and the
+#   RTs are solved in closed form (no pinverse, median or inverse).
+
+class ExportablePoseRegressor(nn.Module):
+
+    def __init__(self, model, HPARAM):
+        super().__init__()
+
+        self.model = model
+        self.HPARAM = HPARAM
+        self.classes = model.classes # includes background
+        self.max_instances = HPARAM.EXPORT_MAX_INSTANCES
+        self.num_of_iterations = HPARAM.EXPORT_LABEL_ITERATIONS
+
+        # Intrinsics of the exported input resolution
+        self.register_buffer('inv_intrinsics', model.inv_intrinsics.clone())
+
+    def forward(self, x):
+
+        # Network (encoder, decoders and heads)
+        mask_logits, logits = self.model.forward_logits(x)
+
+        # Create categorical mask and class compression of the data
+        cat_mask = torch.argmax(torch.nn.LogSoftmax(dim=1)(mask_logits), dim=1)
+        cc_logits = gtf.class_compress3(self.classes, cat_mask, logits)
+
+        # Aggregation
+        labels, converged = label_instances(cat_mask, self.num_of_iterations)
+        pixel_slots, valid, class_ids, sample_ids = group_instances(
+            cat_mask,
+            labels,
+            self.classes,
+            self.max_instances
+        )
+        one_hot = instances_one_hot(pixel_slots, self.max_instances, cc_logits['xy'].dtype)
+        areas, agg_data = aggregate_instances(one_hot, cc_logits)
+
+        # Hough voting
+        xy, hypothesis, pruned_hypothesis = hough_voting(
+            cc_logits['xy'],
+            pixel_slots,
+            one_hot,
+            areas,
+            sample_ids,
+            self.HPARAM
+        )
+
+        # RT
+        R, T, RT = get_RT(agg_data['quaternion'], xy, agg_data['z'], self.inv_intrinsics)
+
+        # Instance of each pixel (1 to N, 0 = background or discarded)
+        instance_map = torch.where(
+            pixel_slots < self.max_instances,
+            pixel_slots + 1,
+            torch.zeros_like(pixel_slots)
+        ).reshape(cat_mask.shape)
+
+        return (
+            mask_logits, cat_mask,
+            cc_logits['quaternion'], cc_logits['scales'], cc_logits['xy'], cc_logits['z'],
+            instance_map, valid, class_ids, sample_ids,
+            agg_data['quaternion'], agg_data['scales'], agg_data['z'],
+            xy, hypothesis, pruned_hypothesis,
+            R, T, RT,
+            converged
+        )
+
+#-------------------------------------------------------------------------------
+# Exportable Aggregation
+
+def label_instances(cat_mask, num_of_iterations):
+    """
+    Args:
+        cat_mask (torch.Tensor): BxHxW categorical mask
+        num_of_iterations (int): propagation steps (each one followed by a
+            pointer jump, enough for the compact instances)
+    Output:
+        labels (torch.Tensor): BxHxW smallest flat index (B*H*W) of each
+            pixel's 4-connected same-class component, B*H*W in the background
+        converged (torch.Tensor): bool, False if the last iteration still
+            changed the labels (the labels of a component may differ)
+    """
+
+    b, h, w = cat_mask.shape
+    n = b * h * w
+
+    index = torch.arange(n, device=cat_mask.device).reshape((b, h, w))
+    foreground = cat_mask != 0
+
+    # Same-class neighbours (up, down, left and right, within the sample)
+    shifts = [(0, 1), (2, 1), (1, 0), (1, 2)]
+    padded_cat_mask = F.pad(cat_mask, (1, 1, 1, 1), value=-1)
+    same_class = [
+        foreground & (padded_cat_mask[:, dy:dy+h, dx:dx+w] == cat_mask) for dy, dx in shifts
+    ]
+
+    labels = torch.where(foreground, index, torch.full_like(index, n))
+    previous_labels = labels
+
+    for i in range(num_of_iterations):
+
+        previous_labels = labels
+
+        # Propagating the smallest index of the neighbours
+        padded_labels = F.pad(labels, (1, 1, 1, 1), value=n)
+        for (dy, dx), is_same in zip(shifts, same_class):
+            labels = torch.where(is_same, torch.min(labels, padded_labels[:, dy:dy+h, dx:dx+w]), labels)
+
+        # Pointer jumping (the label of the labeled pixel is in the same component)
+        flat_labels = labels.reshape((-1,))
+        jumped_labels = torch.gather(flat_labels, 0, torch.clamp(flat_labels, max=n-1)).reshape((b, h, w))
+        labels = torch.where(foreground, jumped_labels, labels)
+
+    # Sum instead of all (not exportable with opset 12)
+    converged = torch.sum((labels != previous_labels).int()) == 0
+
+    # Only checked in eager mode (the exported graphs output converged)
+    if torch._C._get_tracing_state() is None and not bool(converged):
+        LOGGER.warning(f'Instance labeling did not converge in {num_of_iterations} iterations, increase EXPORT_LABEL_ITERATIONS')
+
+    return labels, converged
+
+def group_instances(cat_mask, labels, num_of_classes, max_instances):
+    """
+    Args:
+        cat_mask (torch.Tensor): BxHxW categorical mask
+        labels (torch.Tensor): BxHxW from label_instances
+        num_of_classes (int): including the background
+        max_instances (int): N
+    Output:
+        pixel_slots (torch.Tensor): B*H*W instance (0 to N-1) of each pixel, N
+            for the background and the discarded instances
+        valid (torch.Tensor): N bool, the instances (first rows) or padding
+        class_ids (torch.Tensor): N class of each instance (0 for padding)
+        sample_ids (torch.Tensor): N sample of each instance (0 for padding)
+    """
+
+    b, h, w = cat_mask.shape
+    n = b * h * w
+
+    flat_cat_mask = cat_mask.reshape((-1,)).long()
+    flat_labels = labels.reshape((-1,))
+    index = torch.arange(n, device=cat_mask.device)
+
+    # Each component's root is its first pixel (raster order)
+    is_root = (flat_cat_mask != 0) & (flat_labels == index)
+
+    # Ordering the instances as the AggregationLayer (class, sample and raster
+    # order) and keeping the first N
+    no_instance = num_of_classes * n
+    keys = torch.where(is_root, flat_cat_mask * n + index, torch.full_like(index, no_instance))
+    root_keys, roots = torch.topk(keys, max_instances, largest=False, sorted=True)
+    valid = root_keys < no_instance
+
+    # Instance of each root, then of each pixel (through its label)
+    slot_ids = torch.arange(max_instances, device=cat_mask.device)
+    no_slot = torch.full_like(slot_ids, max_instances)
+    slots = torch.full((n + 1,), max_instances, dtype=torch.int64, device=cat_mask.device)
+    slots = slots.scatter(0, roots, torch.where(valid, slot_ids, no_slot))
+    pixel_slots = slots.index_select(0, flat_labels)
+
+    class_ids = torch.where(valid, flat_cat_mask.index_select(0, roots), torch.zeros_like(roots))
+    sample_ids = torch.where(valid, roots // (h * w), torch.zeros_like(roots))
+
+    return pixel_slots, valid, class_ids, sample_ids
+
+def instances_one_hot(pixel_slots, max_instances, dtype):
+    """
+    Segment sums as matrix products (ONNX's scatter add is not available)
+
+    Output:
+        one_hot (torch.Tensor): NxP pixels of each instance
+    """
+
+    slot_ids = torch.arange(max_instances, device=pixel_slots.device)
+
+    return (torch.unsqueeze(slot_ids, dim=1) == torch.unsqueeze(pixel_slots, dim=0)).to(dtype)
+
+def aggregate_instances(one_hot, data):
+    """
+    Args:
+        one_hot (torch.Tensor): NxP from instances_one_hot
+        data (dict): class compressed data (BxCxHxW, BxHxW for z)
+    Output:
+        areas (torch.Tensor): N pixels of each instance
+        agg_data (dict): NxC means of quaternion (normalized), scales and z
+            (exponential), as the AggregationLayer
+    """
+
+    areas = torch.sum(one_hot, dim=1)
+    safe_areas = torch.unsqueeze(torch.clamp(areas, min=1), dim=1)
+
+    agg_data = {}
+    for data_key in ['quaternion', 'scales', 'z']:
+
+        values = data[data_key]
+        if data_key == 'z':
+            values = torch.unsqueeze(values, dim=1)
+
+        # Mean of the instances' pixels
+        pixel_values = values.permute(0, 2, 3, 1).reshape((-1, values.shape[1]))
+        mean_values = torch.matmul(one_hot, pixel_values) / safe_areas
+
+        # Undoing the torch.log in data embedding
+        if data_key == 'z':
+            mean_values = torch.exp(mean_values)
+
+        # Normalizing data
+        elif data_key == 'quaternion':
+            mean_values = gtf.normalize(mean_values, dim=1)
+
+        agg_data[data_key] = mean_values
+
+    return areas, agg_data
+
+#-------------------------------------------------------------------------------
+# Exportable Hough Voting
+
+def take(data, ids):
+    # Indexing the first dimension with any shape of ids (as a Gather)
+    return data.index_select(0, ids.reshape((-1,))).reshape(ids.shape + data.shape[1:])
+
+def hough_voting(uv_img, pixel_slots, one_hot, areas, sample_ids, HPARAM):
+    """
+    Args:
+        uv_img (torch.Tensor): Bx2xHxW unit vector images of the batch
+        pixel_slots (torch.Tensor): B*H*W from group_instances
+        one_hot (torch.Tensor): NxB*H*W from instances_one_hot
+        areas (torch.Tensor): N pixels of each instance
+        sample_ids (torch.Tensor): N sample of each instance
+    Output:
+        xy (torch.Tensor): Nx2 weighted mean of the hypotheses
+        hypothesis, pruned_hypothesis (torch.Tensor): NxHx2
+    """
+
+    b, _, h, w = uv_img.shape
+    n = b * h * w
+    device = uv_img.device
+
+    # Pixels' coordinates [y, x] and unit vectors
+    index = torch.arange(n, device=device)
+    pts = torch.stack([(index // w) % h, index % w], dim=1).to(uv_img.dtype)
+    uv = uv_img.permute(0, 2, 3, 1).reshape((n, 2))
+
+    # Pixels grouped per instance and the start of each instance
+    sorted_pixels = torch.sort(pixel_slots * n + index)[1]
+    long_areas = areas.long()
+    starts = torch.cumsum(long_areas, dim=0) - long_areas
+
+    # Pairs of different pixels spread within each instance (an instance of
+    # one pixel pairs it with itself)
+    hypothesis_ids = torch.arange(HPARAM.HV_NUM_OF_HYPOTHESES, device=device).to(uv_img.dtype)
+    first_fractions = (hypothesis_ids + 0.5) / HPARAM.HV_NUM_OF_HYPOTHESES
+    second_fractions = torch.remainder((hypothesis_ids + 1) * GOLDEN_RATIO, 1)
+
+    first = torch.floor(torch.unsqueeze(areas, dim=1) * first_fractions).long()
+    second = first + 1 + torch.floor(torch.unsqueeze(torch.clamp(areas - 1, min=0), dim=1) * second_fractions).long()
+    second = torch.remainder(second, torch.unsqueeze(torch.clamp(long_areas, min=1), dim=1))
+
+    starts = torch.unsqueeze(starts, dim=1)
+    first_ids = take(sorted_pixels, torch.clamp(starts + first, max=n-1))
+    second_ids = take(sorted_pixels, torch.clamp(starts + second, max=n-1))
+
+    # Intersections of the pairs' vectors
+    hypothesis = intersect_pairs(
+        take(pts, first_ids),
+        take(uv, first_ids),
+        take(pts, second_ids),
+        take(uv, second_ids)
+    )
+
+    # Pruning of outliers
+    pruned_hypothesis = prun_outliers(hypothesis, HPARAM)
+
+    # Calculate the weights of each hypothesis
+    weights = hypothesis_weights(
+        pruned_hypothesis,
+        pts,
+        uv,
+        pixel_slots,
+        one_hot,
+        sample_ids,
+        (h, w),
+        HPARAM
+    )
+
+    # Account for the pruning of outliers
+    is_nan = torch.isnan(pruned_hypothesis)
+    is_outlier = torch.logical_or(is_nan[:,:,0], is_nan[:,:,1])
+    pruned_hypothesis = torch.where(is_nan, torch.zeros_like(pruned_hypothesis), pruned_hypothesis)
+    weights = torch.where(is_outlier, torch.zeros_like(weights), weights)
+
+    # Calculate the weighted means and flip yx to xy
+    weighted_mean = torch.sum(pruned_hypothesis * torch.unsqueeze(weights, dim=-1), dim=1)
+    pixel_xy = weighted_mean[:,[1,0]]
+
+    return pixel_xy, hypothesis, pruned_hypothesis
+
+def intersect_pairs(pts1, uv1, pts2, uv2):
+    """
+    Solves pts1 + x1*uv1 = pts2 + x2*uv2 as batched_pinverse_solver, with the
+    closed form pseudo-inverse of the 2x2 systems A=[uv1, -uv2] and B=pts2-pts1
+
+    Output:
+        Y (torch.Tensor): ...x2 intersection points
+    """
+
+    a, c = uv1[...,0], uv1[...,1]
+    b, d = -uv2[...,0], -uv2[...,1]
+    b0, b1 = pts2[...,0] - pts1[...,0], pts2[...,1] - pts1[...,1]
+
+    det = a * d - b * c
+    frobenius = a * a + b * b + c * c + d * d
+
+    # Invertible A
+    is_regular = torch.abs(det) > 1e-6 * frobenius
+    safe_det = torch.where(is_regular, det, torch.ones_like(det))
+    regular_x1 = (d * b0 - b * b1) / safe_det
+
+    # Rank-deficient A (parallel vectors or the same pixel): pinv(A) = A^T/|A|^2
+    safe_frobenius = torch.where(frobenius > 0, frobenius, torch.ones_like(frobenius))
+    singular_x1 = (a * b0 + c * b1) / safe_frobenius
+
+    x1 = torch.where(is_regular, regular_x1, singular_x1)
+
+    return pts1 + torch.unsqueeze(x1, dim=-1) * uv1
+
+def prun_outliers(Y, HPARAM):
+    """
+    Same as HoughVotingLayer.prun_outliers (NxHx2), with the medians and
+    quartiles indexed from the sorted hypotheses
+    """
+
+    # Sorted hypotheses (per axis) and their median (lower median, as torch.median)
+    num_of_hypotheses = Y.shape[1]
+    sorted_Y = torch.sort(Y, dim=1)[0]
+    q2 = sorted_Y[:, (num_of_hypotheses - 1) // 2]
+
+    # Performed the desired pruning method
+    if HPARAM.PRUN_METHOD == None:
+        return Y
+
+    elif HPARAM.PRUN_METHOD == 'z-score':
+        std = torch.std(Y, dim=1)
+        mean = torch.mean(Y, dim=1)
+        z_score = (Y - torch.unsqueeze(mean, dim=1)) / torch.unsqueeze(std, dim=1)
+        outliers = z_score > HPARAM.PRUN_ZSCORE_THRESHOLD
+
+    elif HPARAM.PRUN_METHOD == 'iqr':
+
+        # Q1 and Q3 are the medians of the values below and above Q2 (the
+        # first and last values of the sorted hypotheses)
+        expanded_q2 = torch.unsqueeze(q2, dim=1)
+        num_of_lower = torch.sum(Y <= expanded_q2, dim=1)
+        num_of_higher = torch.sum(Y >= expanded_q2, dim=1)
+        q1_ids = (num_of_lower - 1) // 2
+        q3_ids = num_of_hypotheses - num_of_higher + (num_of_higher - 1) // 2
+        q1 = torch.squeeze(torch.gather(sorted_Y, 1, torch.unsqueeze(q1_ids, dim=1)), dim=1)
+        q3 = torch.squeeze(torch.gather(sorted_Y, 1, torch.unsqueeze(q3_ids, dim=1)), dim=1)
+
+        # Creating cutoffs (top and bottom)
+        iqr = q3 - q1
+        top_cut = q3 + HPARAM.IQR_MULTIPLIER * iqr
+        bot_cut = q1 - HPARAM.IQR_MULTIPLIER * iqr
+        outliers = torch.logical_or(
+            Y > torch.unsqueeze(top_cut, dim=1),
+            Y < torch.unsqueeze(bot_cut, dim=1)
+        )
+
+    else:
+        raise RuntimeError("Invalid HARAM.PRUN_METHOD")
+
+    # A hypothesis is an outlier in either axis
+    logic_or_outliers = torch.logical_or(outliers[:,:,0], outliers[:,:,1])
+    outliers_idx = torch.unsqueeze(logic_or_outliers, dim=-1).expand(Y.shape)
+
+    # Perform the desired behavior on the outliers
+    if HPARAM.PRUN_OUTLIER_DROP:
+        replace_data = torch.full_like(Y, float('nan'))
+    elif HPARAM.PRUN_OUTLIER_REPLACEMENT_STYLE == 'mean':
+        replace_data = torch.unsqueeze(torch.mean(Y, dim=1), dim=1).expand(Y.shape)
+    elif HPARAM.PRUN_OUTLIER_REPLACEMENT_STYLE == 'median':
+        replace_data = torch.unsqueeze(q2, dim=1).expand(Y.shape)
+    else:
+        raise RuntimeError("Invalid HPARAM.PRUN_OUTLIER_REPLACEMENT_STYLE")
+
+    return torch.where(outliers_idx, replace_data, Y)
+
+def hypothesis_weights(hypothesis, pts, uv, pixel_slots, one_hot, sample_ids, image_shape, HPARAM):
+    """
+    Same as HoughVotingLayer.batchwise_calculate_hypothesis_weights, for all
+    the pixels (in chunks of VOTES_CHUNK_SIZE pixels)
+
+    Output:
+        weights (torch.Tensor): NxH normalized weights
+    """
+
+    max_instances, num_of_hypotheses, _ = hypothesis.shape
+    h, w = image_shape
+    n = pts.shape[0]
+
+    # Hypotheses of each pixel's instance (those of the background are not
+    # counted by the one-hot)
+    safe_slots = torch.clamp(pixel_slots, max=max_instances-1)
+
+    weights = torch.zeros((max_instances, num_of_hypotheses), dtype=one_hot.dtype, device=hypothesis.device)
+    for start in range(0, n, VOTES_CHUNK_SIZE):
+        end = min(start + VOTES_CHUNK_SIZE, n)
+        pixel_hypothesis = take(hypothesis, safe_slots[start:end])
+
+        # Vote of each pixel: its unit vector points to the hypothesis (the
+        # sign of the dot product, the normalization is not needed)
+        a = pixel_hypothesis - torch.unsqueeze(pts[start:end], dim=1)
+        votes = torch.sum(a * torch.unsqueeze(uv[start:end], dim=1), dim=-1) > 0
+        weights = weights + torch.matmul(one_hot[:, start:end], votes.to(one_hot.dtype))
+
+    # Multiply the weight if the hypothesis is inside the mask
+    is_nan = torch.isnan(hypothesis)
+    safe_hypothesis = torch.where(is_nan, torch.full_like(hypothesis, -1), hypothesis).long()
+    ys, xs = safe_hypothesis[...,0], safe_hypothesis[...,1]
+    is_inside = (ys >= 0) & (ys < h) & (xs >= 0) & (xs < w)
+    hypothesis_pixels = torch.unsqueeze(sample_ids, dim=1) * h * w + torch.clamp(ys, 0, h-1) * w + torch.clamp(xs, 0, w-1)
+    slot_ids = torch.unsqueeze(torch.arange(max_instances, device=hypothesis.device), dim=1)
+    h_in_mask = is_inside & (take(pixel_slots, hypothesis_pixels) == slot_ids)
+    factor = torch.where(
+        h_in_mask,
+        torch.full_like(weights, HPARAM.HV_HYPOTHESIS_IN_MASK_MULTIPLIER),
+        torch.ones_like(weights)
+    )
+    weights = factor * weights
+
+    # Normalizing weight
+    return weights / torch.clamp(torch.sum(weights, dim=1, keepdim=True), min=1)
+
+#-------------------------------------------------------------------------------
+# Exportable RT
+
+def get_RT(q, xys, exp_zs, inv_intrinsics):
+    """
+    Same as gtf.batchwise_get_RT (same intrinsics for all), with the inverse of
+    [inv(R) | T] in closed form: [R | -R @ T]
+    """
+
+    # Including the Z component into the projection (2D to 3D)
+    projected_xys = xys * (exp_zs/1000)
+    homogenous_xyzs = torch.cat([projected_xys, exp_zs/1000], dim=1)
+    T = torch.matmul(homogenous_xyzs, inv_intrinsics.t())
+
+    # Then create R
+    norm = q.norm(dim=1)
+    safe_norm = torch.where(norm > 0, norm, torch.ones_like(norm))
+    q = q / torch.unsqueeze(safe_norm, dim=1)
+    R = gtf.batchwise_quat_2_corrected_rotation_matrix(q)
+
+    # Then combining it to the translation vector
+    RT = torch.cat(
+        [
+            torch.cat([R, -torch.matmul(R, torch.unsqueeze(T, dim=-1))], dim=-1),
+            torch.tensor([0,0,0,1], device=q.device, dtype=q.dtype).expand((q.shape[0],1,4))
+        ], dim=1)
+
+    return R, T, RT
+
+#-------------------------------------------------------------------------------
+# Export and Inference Backends
+
+def export_torchscript(exportable, path, image_size, batch_size=1):
+
+    x = torch.rand((batch_size, 3) + tuple(image_size))
+
+    with torch.no_grad():
+        traced = torch.jit.trace(exportable.eval(), x)
+
+    traced.save(str(path))
+
+    return traced
+
+def export_onnx(exportable, path, image_size, batch_size=1, opset_version=12):
+
+    x = torch.rand((batch_size, 3) + tuple(image_size))
+
+    with torch.no_grad():
+        torch.onnx.export(
+            exportable.eval(),
+            x,
+            str(path),
+            input_names=['image'],
+            output_names=OUTPUT_NAMES,
+            opset_version=opset_version
+        )
+
+def unpack_outputs(outputs):
+    """
+    Args:
+        outputs (list): tensors of the exported graph (OUTPUT_NAMES)
+    Output:
+        output (dict): same as the PoseRegressor's output
+    """
+
+    y = dict(zip(OUTPUT_NAMES, outputs))
+    num_of_instances = int(y['valid'].sum())
+
+    if not bool(y['converged']):
+        LOGGER.warning('Instance labeling did not converge, increase EXPORT_LABEL_ITERATIONS and export again')
+
+    # Compact instance masks of the valid instances
+    instance_masks, _ = im.InstanceMasks.from_label_map(y['instance_map'], num_of_instances)
+
+    agg_pred = ct.AggData(
+        instance_masks=instance_masks,
+        xy_img=y['xy_img'],
+        **{k:y[k][:num_of_instances] for k in INSTANCE_OUTPUT_NAMES}
+    )
+
+    output = {
+        'mask': y['mask'],
+        'quaternion': y['quaternion_img'],
+        'scales': y['scales_img'],
+        'xy': y['xy_img'],
+        'z': y['z_img'],
+        'auxilary': {
+            'cat_mask': y['cat_mask'],
+            'agg_pred': agg_pred
+        }
+    }
+
+    return output
+
+class TorchScriptBackend(object):
+
+    def __init__(self, path):
+        self.module = torch.jit.load(str(path), map_location='cpu')
+        self.module.eval()
+
+    def __call__(self, x):
+        return self.forward(x)
+
+    def eval(self):
+        return self
+
+    def forward(self, x):
+
+        with torch.no_grad():
+            outputs = self.module(x.cpu())
+
+        return unpack_outputs(outputs)
+
+class OnnxRuntimeBackend(object):
+
+    def __init__(self, path, num_of_threads=0):
+
+        import onnxruntime
+
+        # CPU inference (0 threads = onnxruntime's default)
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = num_of_threads
+
+        self.session = onnxruntime.InferenceSession(
+            str(path),
+            options,
+            providers=['CPUExecutionProvider']
+        )
+
+    def __call__(self, x):
+        return self.forward(x)
+
+    def eval(self):
+        return self
+
+    def forward(self, x):
+
+        outputs = self.session.run(OUTPUT_NAMES, {'image': x.detach().cpu().numpy()})
+
+        return unpack_outputs([torch.from_numpy(y) for y in outputs])
+
+BACKENDS = {
+    'torchscript': TorchScriptBackend,
+    'onnxruntime': OnnxRuntimeBackend
+}
+
+#-------------------------------------------------------------------------------
+# Functions
+
+def test_exportable(num_of_runs=5, classes=4, image_size=(96, 128)):
+
+    import argparse
+    import tempfile
+    import numpy as np
+
+    import aggregation_layer as al
+    import hough_voting as hv
+    import pose_regressor as pr
+
+    class HPARAM(argparse.Namespace):
+        NUMPY_INTRINSICS = np.array([[577.5, 0, 319.5], [0, 577.5, 239.5], [0, 0, 1]])
+        FUSED_DECODER = False
+        PRECISION = 'fp32'
+        FREEZE_ENCODER = False
+        FREEZE_MASK_TRAINING = False
+        FREEZE_ROTATION_TRAINING = False
+        FREEZE_TRANSLATION_TRAINING = False
+        FREEZE_SCALES_TRAINING = False
+        PERFORM_AGGREGATION = True
+        PERFORM_HOUGH_VOTING = True
+        PERFORM_RT_CALCULATION = True
+        HV_NUM_OF_HYPOTHESES = 51
+        HV_HYPOTHESIS_IN_MASK_MULTIPLIER = 3
+        PRUN_METHOD = 'iqr'
+        PRUN_OUTLIER_DROP = False
+        PRUN_OUTLIER_REPLACEMENT_STYLE = 'median'
+        PRUN_ZSCORE_THRESHOLD = 1
+        IQR_MULTIPLIER = 1.5
+        EXPORT_MAX_INSTANCES = 8
+        EXPORT_LABEL_ITERATIONS = 16
+
+    torch.manual_seed(0)
+    torch.set_grad_enabled(False)
+
+    h, w = image_size
+    inv_intrinsics = torch.inverse(torch.from_numpy(HPARAM.NUMPY_INTRINSICS).float())
+
+    # Post-processing parity with the eager layers: rectangular instances whose
+    # unit vectors point to their centers
+    cat_mask = torch.zeros((2, h, w), dtype=torch.int64)
+    uv_img = torch.zeros((2, 2, h, w))
+    coords = torch.stack(torch.meshgrid(torch.arange(h), torch.arange(w)), dim=0).float()
+    for sample_id, class_id, y0, x0, y1, x1 in [(0,1,5,5,30,40), (0,2,40,60,70,100), (1,1,10,10,20,20), (1,1,50,70,90,120), (1,3,30,30,45,60)]:
+        cat_mask[sample_id, y0:y1, x0:x1] = class_id
+        center = torch.tensor([(y0+y1)/2 + 0.25, (x0+x1)/2 + 0.25]).reshape((2,1,1))
+        uv_img[sample_id, :, y0:y1, x0:x1] = gtf.normalize(center - coords, dim=0)[:, y0:y1, x0:x1]
+
+    data = {
+        'quaternion': gtf.normalize(torch.rand((2, 4, h, w)), dim=1),
+        'scales': torch.rand((2, 3, h, w)),
+        'xy': uv_img,
+        'z': torch.rand((2, h, w)) + 7
+    }
+
+    agg_data = al.AggregationLayer(HPARAM, classes).forward(cat_mask, data)
+    agg_data = hv.HoughVotingLayer(HPARAM)(agg_data)
+    agg_data = gtf.samplewise_get_RT(agg_data, inv_intrinsics)
+
+    labels, converged = label_instances(cat_mask, HPARAM.EXPORT_LABEL_ITERATIONS)
+    assert bool(converged)
+    pixel_slots, valid, class_ids, sample_ids = group_instances(cat_mask, labels, classes, HPARAM.EXPORT_MAX_INSTANCES)
+    one_hot = instances_one_hot(pixel_slots, HPARAM.EXPORT_MAX_INSTANCES, uv_img.dtype)
+    areas, export_agg_data = aggregate_instances(one_hot, data)
+    xy, _, _ = hough_voting(uv_img, pixel_slots, one_hot, areas, sample_ids, HPARAM)
+    R, T, RT = get_RT(export_agg_data['quaternion'], xy, export_agg_data['z'], inv_intrinsics)
+
+    n = int(valid.sum())
+    assert n == len(agg_data['class_ids']) == 5
+    assert torch.equal(class_ids[:n], agg_data['class_ids'])
+    assert torch.equal(sample_ids[:n], agg_data['sample_ids'])
+    assert torch.equal(areas[:n].long(), agg_data['instance_masks'].areas())
+    for key in ['quaternion', 'scales', 'z']:
+        assert torch.allclose(export_agg_data[key][:n], agg_data[key], atol=1e-5), key
+    assert torch.allclose(xy[:n], agg_data['xy'], atol=0.5), (xy[:n] - agg_data['xy']).abs().max()
+    assert torch.allclose(R[:n], agg_data['R'], atol=1e-5)
+    assert torch.allclose(T[:n], agg_data['T'], atol=1e-2) # from xy
+    assert torch.allclose(RT[:n,:3,:3], agg_data['RT'][:,:3,:3], atol=1e-5)
+
+    # Same votes in several chunks, not converged in a single iteration
+    global VOTES_CHUNK_SIZE
+    chunk_size, VOTES_CHUNK_SIZE = VOTES_CHUNK_SIZE, 1000
+    chunked_xy, _, _ = hough_voting(uv_img, pixel_slots, one_hot, areas, sample_ids, HPARAM)
+    VOTES_CHUNK_SIZE = chunk_size
+    assert torch.allclose(chunked_xy, xy)
+    assert not bool(label_instances(cat_mask, 1)[1])
+
+    # Exported end-to-end graphs (random weights) against the eager module
+    model = pr.PoseRegressor(HPARAM, encoder_name='resnet18', encoder_weights=None, classes=classes).eval()
+    exportable = ExportablePoseRegressor(model, HPARAM).eval()
+    x = torch.rand((1, 3) + image_size)
+    eager_outputs = exportable(x)
+
+    # Same network outputs as the PoseRegressor
+    model_outputs = model(x)
+    assert torch.allclose(model_outputs['mask'], eager_outputs[0])
+    assert torch.equal(model_outputs['auxilary']['cat_mask'], eager_outputs[1])
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+
+        export_torchscript(exportable, os.path.join(tmp_dir, 'model.pt'), image_size)
+        export_onnx(exportable, os.path.join(tmp_dir, 'model.onnx'), image_size)
+
+        backends = {'eager': lambda x: unpack_outputs(exportable(x))}
+        backends['torchscript'] = TorchScriptBackend(os.path.join(tmp_dir, 'model.pt'))
+        try:
+            backends['onnxruntime'] = OnnxRuntimeBackend(os.path.join(tmp_dir, 'model.onnx'))
+        except ImportError:
+            LOGGER.warning('onnxruntime is not installed, skipping its parity test')
+
+        for name, backend in backends.items():
+
+            outputs = backend(x)
+            for key, eager_output in zip(OUTPUT_NAMES, eager_outputs):
+                output = outputs['auxilary']['agg_pred'].get(key, None) if key in INSTANCE_OUTPUT_NAMES else None
+                if output is not None:
+                    assert torch.allclose(output.float(), eager_output[:len(output)].float(), atol=1e-3), (name, key)
+
+            assert torch.allclose(outputs['mask'], eager_outputs[0], atol=1e-4), name
+
+            # CPU latency of a batch of 1
+            tic = time.perf_counter()
+            for i in range(num_of_runs):
+                backend(x)
+            toc = time.perf_counter()
+
+            print(f'{name:>12}: {1000*(toc-tic)/num_of_runs:.1f} ms/image')
+
+#-------------------------------------------------------------------------------
+# Main Code
+
+if __name__ == '__main__':
+    test_exportable()
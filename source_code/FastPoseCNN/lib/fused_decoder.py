@@ -0,0 +1,377 @@
+import os
+import sys
+import time
+import logging
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+#-------------------------------------------------------------------------------
+# Constants
+
+# Branches of the PoseRegressor, in the order of the fused channels
+DECODER_NAMES = ['mask_decoder', 'rotation_decoder', 'translation_decoder', 'scales_decoder']
+HEAD_NAMES = ['segmentation_head', 'rotation_head', 'translation_head', 'scales_head']
+
+LOGGER = logging.getLogger('fastposecnn')
+
+#-------------------------------------------------------------------------------
+# Fused FPN Decoder
+
+# The modules mirror smp.fpn.decoder's (same module names), with the channels
+# of the G branches concatenated: branch k owns the channels [k*C, (k+1)*C) of
+# every layer. The convolutions over the shared encoder features are a single
+# convolution with the branches' weights concatenated, the convolutions over
+# the branch-specific features are grouped convolutions (groups=G) and the
+# GroupNorm has G times the groups (the groups never cross the branches).
+
+class FusedConv3x3GNReLU(nn.Module):
+
+    def __init__(self, in_channels, out_channels, num_of_branches, upsample=False):
+        super().__init__()
+        self.upsample = upsample
+        self.block = nn.Sequential(
+            nn.Conv2d(
+                num_of_branches * in_channels,
+                num_of_branches * out_channels,
+                (3, 3),
+                stride=1,
+                padding=1,
+                bias=False,
+                groups=num_of_branches
+            ),
+            nn.GroupNorm(num_of_branches * 32, num_of_branches * out_channels),
+            nn.ReLU(inplace=True),
+        )
+
+    def forward(self, x):
+        x = self.block(x)
+        if self.upsample:
+            x = F.interpolate(x, scale_factor=2, mode="bilinear", align_corners=True)
+        return x
+
+class FusedFPNBlock(nn.Module):
+
+    def __init__(self, pyramid_channels, skip_channels, num_of_branches):
+        super().__init__()
+        self.skip_conv = nn.Conv2d(skip_channels, num_of_branches * pyramid_channels, kernel_size=1)
+
+    def forward(self, x, skip):
+        x = F.interpolate(x, scale_factor=2, mode="nearest")
+        skip = self.skip_conv(skip)
+        x = x + skip
+        return x
+
+class FusedSegmentationBlock(nn.Module):
+
+    def __init__(self, in_channels, out_channels, num_of_branches, n_upsamples=0):
+        super().__init__()
+
+        blocks = [FusedConv3x3GNReLU(in_channels, out_channels, num_of_branches, upsample=bool(n_upsamples))]
+
+        if n_upsamples > 1:
+            for _ in range(1, n_upsamples):
+                blocks.append(FusedConv3x3GNReLU(out_channels, out_channels, num_of_branches, upsample=True))
+
+        self.block = nn.Sequential(*blocks)
+
+    def forward(self, x):
+        return self.block(x)
+
+class FusedFPNDecoder(nn.Module):
+    """G FPNDecoders over the same encoder features, run in a single pass.
+
+    Args:
+        encoder_channels, encoder_depth, pyramid_channels, segmentation_channels,
+        dropout, merge_policy: the FPNDecoder's parameters
+        num_of_branches (int): number of fused decoders (G)
+    Output (forward):
+        x (torch.Tensor): Bx(G*out_channels)xHxW, the output of each decoder
+            concatenated along the channels
+    """
+
+    def __init__(
+        self,
+        encoder_channels,
+        encoder_depth=5,
+        pyramid_channels=256,
+        segmentation_channels=128,
+        dropout=0.2,
+        merge_policy="add",
+        num_of_branches=4
+        ):
+        super().__init__()
+
+        if merge_policy not in ['add', 'cat']:
+            raise ValueError(f"merge_policy must be 'add' or 'cat', got {merge_policy}")
+
+        self.num_of_branches = num_of_branches
+        self.merge_policy = merge_policy
+        self.out_channels = segmentation_channels if merge_policy == "add" else segmentation_channels * 4
+
+        encoder_channels = encoder_channels[::-1]
+        encoder_channels = encoder_channels[:encoder_depth + 1]
+
+        self.p5 = nn.Conv2d(encoder_channels[0], num_of_branches * pyramid_channels, kernel_size=1)
+        self.p4 = FusedFPNBlock(pyramid_channels, encoder_channels[1], num_of_branches)
+        self.p3 = FusedFPNBlock(pyramid_channels, encoder_channels[2], num_of_branches)
+        self.p2 = FusedFPNBlock(pyramid_channels, encoder_channels[3], num_of_branches)
+
+        self.seg_blocks = nn.ModuleList([
+            FusedSegmentationBlock(pyramid_channels, segmentation_channels, num_of_branches, n_upsamples=n_upsamples)
+            for n_upsamples in [3, 2, 1, 0]
+        ])
+
+        self.dropout = nn.Dropout2d(p=dropout, inplace=True)
+
+    def forward(self, *features):
+        c5, c4, c3, c2 = features[-4:][::-1]
+
+        p5 = self.p5(c5)
+        p4 = self.p4(p5, c4)
+        p3 = self.p3(p4, c3)
+        p2 = self.p2(p3, c2)
+
+        feature_pyramid = [seg_block(p) for seg_block, p in zip(self.seg_blocks, [p5, p4, p3, p2])]
+
+        if self.merge_policy == 'add':
+            x = sum(feature_pyramid)
+        else:
+            # Regrouping the levels per branch ([branch][level] channels)
+            b, _, h, w = feature_pyramid[0].shape
+            x = torch.stack(feature_pyramid, dim=1).reshape((b, 4, self.num_of_branches, -1, h, w))
+            x = x.transpose(1, 2).reshape((b, -1, h, w))
+
+        x = self.dropout(x)
+
+        return x
+
+    @classmethod
+    def from_decoders(cls, decoders, **kwargs):
+        """
+        Args:
+            decoders (list): the FPNDecoders, in the order of the branches
+            kwargs: the decoders' parameters (see __init__)
+        Output:
+            fused_decoder (FusedFPNDecoder): with the decoders' weights
+        """
+
+        fused_decoder = cls(num_of_branches=len(decoders), **kwargs)
+        fused_decoder.load_state_dict(fuse_state_dicts([x.state_dict() for x in decoders]))
+
+        return fused_decoder
+
+#-------------------------------------------------------------------------------
+# Fused Segmentation Heads
+
+class FusedSegmentationHeads(nn.Module):
+    """G SegmentationHeads (1x1 convolution, upsampling and activation) of
+    the branches of a FusedFPNDecoder.
+
+    The 1x1 convolutions are a grouped convolution whose groups are padded to
+    the largest number of output channels, the actual channels are gathered
+    before upsampling all of them at once (the 1x1 convolution and the
+    bilinear upsampling commute, as the SegmentationHead's).
+
+    Args:
+        in_channels (int): output channels of each decoder
+        out_channels (list): output channels of each head
+        activation (str or None): smp activation of the heads
+        upsampling (int): upsampling factor of the heads
+    Output (forward):
+        outputs (list): the output of each head
+    """
+
+    def __init__(self, in_channels, out_channels, activation=None, upsampling=4):
+        super().__init__()
+
+        import segmentation_models_pytorch as smp
+
+        self.out_channels = list(out_channels)
+        self.max_out_channels = max(self.out_channels)
+        num_of_branches = len(self.out_channels)
+
+        self.conv = nn.Conv2d(
+            num_of_branches * in_channels,
+            num_of_branches * self.max_out_channels,
+            kernel_size=1,
+            groups=num_of_branches
+        )
+
+        # Actual channels of the padded groups
+        channel_ids = torch.cat([
+            torch.arange(n) + k * self.max_out_channels for k, n in enumerate(self.out_channels)
+        ])
+        self.register_buffer('channel_ids', channel_ids, persistent=False)
+
+        self.upsampling = nn.UpsamplingBilinear2d(scale_factor=upsampling) if upsampling > 1 else nn.Identity()
+        self.activations = nn.ModuleList([smp.base.modules.Activation(activation) for _ in self.out_channels])
+
+    def forward(self, x):
+
+        x = self.conv(x)
+        x = torch.index_select(x, 1, self.channel_ids)
+        x = self.upsampling(x)
+
+        return [activation(y) for activation, y in zip(self.activations, torch.split(x, self.out_channels, dim=1))]
+
+    def remap_state_dicts(self, state_dicts):
+        """
+        Args:
+            state_dicts (list): the SegmentationHeads' state_dicts
+        Output:
+            state_dict (dict): of the fused heads (zero padded groups)
+        """
+
+        weight = self.conv.weight.new_zeros(self.conv.weight.shape)
+        bias = self.conv.bias.new_zeros(self.conv.bias.shape)
+
+        for k, state_dict in enumerate(state_dicts):
+            start = k * self.max_out_channels
+            weight[start:start+self.out_channels[k]] = state_dict['0.weight']
+            bias[start:start+self.out_channels[k]] = state_dict['0.bias']
+
+        return {'conv.weight': weight, 'conv.bias': bias}
+
+    @classmethod
+    def from_heads(cls, heads, **kwargs):
+        """
+        Args:
+            heads (list): the SegmentationHeads, in the order of the branches
+            kwargs: in_channels, activation and upsampling (see __init__)
+        Output:
+            fused_heads (FusedSegmentationHeads): with the heads' weights
+        """
+
+        fused_heads = cls(out_channels=[x[0].out_channels for x in heads], **kwargs)
+        fused_heads.load_state_dict(fused_heads.remap_state_dicts([x.state_dict() for x in heads]))
+
+        return fused_heads
+
+#-------------------------------------------------------------------------------
+# Weight Remapping
+
+def fuse_state_dicts(state_dicts):
+    """
+    Args:
+        state_dicts (list): the FPNDecoders' state_dicts
+    Output:
+        state_dict (dict): of the FusedFPNDecoder (the parameters of every
+            layer concatenated along the output channels)
+    """
+
+    return {key: torch.cat([x[key] for x in state_dicts], dim=0) for key in state_dicts[0].keys()}
+
+def remap_state_dict(state_dict, fused_heads, prefix=''):
+    """
+    Args:
+        state_dict (dict): state_dict of a PoseRegressor with the sequential
+            decoders (e.g. from a checkpoint)
+        fused_heads (FusedSegmentationHeads): the heads of the fused model
+        prefix (str): prefix of the PoseRegressor's keys
+    Objective:
+        Replace (in place) the decoders' and heads' weights by the weights of
+        the fused_decoder and fused_heads. State dicts without the sequential
+        decoders are unchanged.
+    """
+
+    if f'{prefix}{DECODER_NAMES[0]}.p5.weight' not in state_dict:
+        return state_dict
+
+    # Splitting the decoders' and heads' weights per branch
+    decoder_state_dicts = [{} for _ in DECODER_NAMES]
+    head_state_dicts = [{} for _ in HEAD_NAMES]
+
+    for key in list(state_dict.keys()):
+        for names, branch_state_dicts in [(DECODER_NAMES, decoder_state_dicts), (HEAD_NAMES, head_state_dicts)]:
+            for k, name in enumerate(names):
+                if key.startswith(f'{prefix}{name}.'):
+                    branch_state_dicts[k][key[len(f'{prefix}{name}.'):]] = state_dict.pop(key)
+
+    # Fused weights
+    for key, value in fuse_state_dicts(decoder_state_dicts).items():
+        state_dict[f'{prefix}fused_decoder.{key}'] = value
+
+    for key, value in fused_heads.remap_state_dicts(head_state_dicts).items():
+        state_dict[f'{prefix}fused_heads.{key}'] = value
+
+    return state_dict
+
+#-------------------------------------------------------------------------------
+# Functions
+
+def test_fused_decoder(num_of_runs=10, classes=7, image_size=(480, 640)):
+
+    import segmentation_models_pytorch as smp
+
+    torch.manual_seed(0)
+    torch.set_grad_enabled(False)
+
+    # Sequential branches (as the PoseRegressor's)
+    encoder = smp.encoders.get_encoder('resnet18', in_channels=3, depth=5, weights=None).eval()
+    param_dict = {
+        'encoder_channels': encoder.out_channels,
+        'encoder_depth': 5,
+        'pyramid_channels': 256,
+        'segmentation_channels': 128,
+        'dropout': 0.2,
+        'merge_policy': 'add'
+    }
+    decoders = [smp.fpn.decoder.FPNDecoder(**param_dict).eval() for _ in DECODER_NAMES]
+    heads = [
+        smp.base.SegmentationHead(in_channels=128, out_channels=x, kernel_size=1, upsampling=4).eval()
+        for x in [classes, 4*(classes-1), 3*(classes-1), 3*(classes-1)]
+    ]
+
+    # Random weights (including the GroupNorm affine parameters)
+    for module in decoders + heads:
+        for param in module.parameters():
+            param.uniform_(-0.1, 0.1)
+
+    fused_decoder = FusedFPNDecoder.from_decoders(decoders, **param_dict).eval()
+    fused_heads = FusedSegmentationHeads.from_heads(heads, in_channels=128, upsampling=4).eval()
+
+    def run_sequential(features):
+        return [head(decoder(*features)) for decoder, head in zip(decoders, heads)]
+
+    def run_fused(features):
+        return fused_heads(fused_decoder(*features))
+
+    # Numerical equivalence
+    features = encoder(torch.rand((2, 3) + image_size))
+    for y_sequential, y_fused in zip(run_sequential(features), run_fused(features)):
+        assert torch.allclose(y_sequential, y_fused, atol=1e-4), (y_sequential - y_fused).abs().max()
+
+    # Remapping a sequential PoseRegressor's state_dict
+    state_dict = {}
+    for names, modules in [(DECODER_NAMES, decoders), (HEAD_NAMES, heads)]:
+        for name, module in zip(names, modules):
+            state_dict.update({f'model.{name}.{k}':v for k,v in module.state_dict().items()})
+    state_dict = remap_state_dict(state_dict, fused_heads, prefix='model.')
+    assert all([torch.equal(state_dict[f'model.fused_decoder.{k}'], v) for k,v in fused_decoder.state_dict().items()])
+    assert all([torch.equal(state_dict[f'model.fused_heads.{k}'], v) for k,v in fused_heads.state_dict().items()])
+
+    # CPU latency (batch of 1) and throughput (batch of 8) of the decoders
+    # and heads (the encoder's features are shared)
+    for batch_size in [1, 8]:
+
+        features = encoder(torch.rand((batch_size, 3) + image_size))
+
+        for name, function in [('sequential', run_sequential), ('fused', run_fused)]:
+
+            function(features) # warm-up
+
+            tic = time.perf_counter()
+            for i in range(num_of_runs):
+                function(features)
+            toc = time.perf_counter()
+
+            latency = (toc - tic) / num_of_runs
+            print(f'{name:>10} batch={batch_size}: {1000*latency:.1f} ms/batch, {batch_size/latency:.1f} images/s')
+
+#-------------------------------------------------------------------------------
+# Main Code
+
+if __name__ == '__main__':
+    test_fused_decoder()
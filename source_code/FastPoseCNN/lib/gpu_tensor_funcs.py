@@ -22,6 +22,8 @@ except ImportError:
     pass
 
 import hough_voting as hvk
+import instance_masks as im
+import precision as pc
 
 #-------------------------------------------------------------------------------
 # Helper Functions
@@ -92,6 +94,7 @@ def class_compress(num_of_classes, cat_mask, data):
 
     return compressed_data
 
+@pc.fp32_island
 def class_compress2(num_of_classes, cat_mask, logits):
     
     class_compress_logits = {}
@@ -130,6 +133,48 @@ def class_compress2(num_of_classes, cat_mask, logits):
 
     return class_compress_logits
 
+@pc.fp32_island
+def class_compress3(num_of_classes, cat_mask, logits):
+    """
+    Args:
+        num_of_classes: int (including the background)
+        cat_mask: NxHxW categorical mask
+        logits: dict of Nx(A*(num_of_classes-1))xHxW class-specific logits
+    Returns:
+        class_compress_logits: dict of NxAxHxW (NxHxW for z), the channels of
+            each pixel's class (zeros in the background), same as
+            class_compress2 (values and gradients) with a single gather
+    """
+
+    class_compress_logits = {}
+
+    # Class chunk of each pixel (the background is zeroed below)
+    foreground = torch.unsqueeze(cat_mask != 0, dim=1)
+    class_index = torch.unsqueeze(torch.clamp(cat_mask - 1, min=0), dim=1)
+
+    for logit_key, logit in logits.items():
+
+        # Selecting the A channels of each pixel's class
+        num_of_channels = logit.shape[1] // (num_of_classes - 1)
+        channel_offsets = torch.arange(num_of_channels, device=logit.device).reshape((1, -1, 1, 1))
+        selected = torch.gather(logit, 1, class_index * num_of_channels + channel_offsets)
+
+        # Zeroing the background (and its gradients)
+        selected = selected * foreground.type(selected.dtype)
+
+        # Need to squeeze when logit_key == z in dim = 1 to match 
+        # categorical ground truth data
+        if logit_key == 'z':
+            selected = torch.squeeze(selected, dim=1)
+
+        # Normalize quaternion and xy
+        elif logit_key == 'quaternion' or logit_key == 'xy':
+            selected = normalize(selected, dim=1)
+
+        class_compress_logits[logit_key] = selected
+
+    return class_compress_logits
+
 def mask_gradients(to_be_masked, mask):
 
     # Creating a binary mask of all objects
@@ -384,6 +429,7 @@ def transform_3d_camera_coords_to_3d_world_coords(cartesian_camera_coordinates_3
 
     return cartesian_world_coordinates_3d 
 
+@pc.fp32_island
 def batchwise_get_RT(q, xys, exp_zs, inv_intrinsics):
 
     # q = quaternion
@@ -392,27 +438,20 @@ def batchwise_get_RT(q, xys, exp_zs, inv_intrinsics):
 
     # First construct the translation vector matrix
     homogenous_xyzs = torch.vstack([projected_xys.T, exp_zs.T/1000])
-    T = inv_intrinsics @ homogenous_xyzs # torch.inverse(intrinsics) @ homo_xyz
+
+    # Per-instance intrinsics (Nx3x3) or the same intrinsics for all (3x3)
+    if inv_intrinsics.dim() == 3:
+        T = (inv_intrinsics @ homogenous_xyzs.T.unsqueeze(-1)).squeeze(-1).T
+    else:
+        T = inv_intrinsics @ homogenous_xyzs # torch.inverse(intrinsics) @ homo_xyz
 
     # Then create R
     norm = q.norm(dim=1)
     safe_norm = torch.where(norm > 0, norm, torch.ones_like(norm, device=q.device))
     q = q / torch.unsqueeze(safe_norm, dim=1)
 
-    # Creating container for the all R
-    R = torch.zeros((q.shape[0], 3, 3), device=q.device, dtype=q.dtype)
-
-    # Correction matrix
-    x = torch.tensor([
-        [1,-1,1],
-        [1,-1,1],
-        [-1,1,-1]
-    ], device=q.device, dtype=q.dtype)
-
-    # Processing each quaternion individually (too hard)
-    for i in range(q.shape[0]):
-        r = quat_2_rotation_matrix(q[i])
-        R[i] = torch.mul(torch.rot90(r, 2).T, x)
+    # Processing all the quaternions at once
+    R = batchwise_quat_2_corrected_rotation_matrix(q)
     
     # Need the inverse version to combine it with the translation
     inv_R = torch.inverse(R)
@@ -431,6 +470,10 @@ def batchwise_get_RT(q, xys, exp_zs, inv_intrinsics):
 
 def samplewise_get_RT(agg_data, inv_intrinsics):
 
+    # Per-sample intrinsics (Bx3x3, e.g. crops) are selected per instance
+    if inv_intrinsics.dim() == 3:
+        inv_intrinsics = inv_intrinsics[agg_data['sample_ids'].long()]
+
     # Once all the raw data has been aggregated, we need to calculate the 
     # rotation matrix of each instance.
     R_data, T_data, RT_data = batchwise_get_RT(
@@ -498,6 +541,45 @@ def quat_2_rotation_matrix(quaternion):
 
     return R
 
+def batchwise_quat_2_corrected_rotation_matrix(q):
+    """
+    Args:
+        q (torch.Tensor): Nx4 normalized quaternions
+    Output:
+        R (torch.Tensor): Nx3x3, same as torch.rot90(quat_2_rotation_matrix(q[i]), 2).T
+            with the sign correction of batchwise_get_RT (built by stacking, 
+            so that it is traceable)
+    """
+
+    qw, qx, qy, qz = q[:,0], q[:,1], q[:,2], q[:,3]
+
+    # Batched get_q_matrix and get_q_bar_matrix
+    q_matrix = torch.stack([
+        torch.stack([qw, -qx, -qy, -qz], dim=-1),
+        torch.stack([qx,  qw, -qz,  qy], dim=-1),
+        torch.stack([qy,  qz,  qw, -qx], dim=-1),
+        torch.stack([qz, -qy,  qx,  qw], dim=-1)
+    ], dim=1)
+    q_bar_matrix = torch.stack([
+        torch.stack([qw, -qx, -qy, -qz], dim=-1),
+        torch.stack([qx,  qw,  qz, -qy], dim=-1),
+        torch.stack([qy, -qz,  qw,  qx], dim=-1),
+        torch.stack([qz,  qy, -qx,  qw], dim=-1)
+    ], dim=1)
+    r = torch.matmul(q_matrix, q_bar_matrix.transpose(1, 2))[:, 1:, 1:]
+
+    # rot90(r, 2).T reverses both axes and transposes
+    r = r[:, [2,1,0]][:, :, [2,1,0]].transpose(1, 2)
+
+    # Correction matrix
+    x = torch.tensor([
+        [1,-1,1],
+        [1,-1,1],
+        [-1,1,-1]
+    ], device=q.device, dtype=q.dtype)
+
+    return torch.mul(r, x)
+
 def get_q_matrix(q):
 
     return torch.tensor([
@@ -571,6 +653,10 @@ def torch_get_2d_iou(tensor1: torch.Tensor, tensor2: torch.Tensor) -> torch.Tens
 
 def batchwise_get_2d_iou(batch_masks1, batch_masks2):
 
+    # Compact masks only compare the crops of overlapping bounding boxes
+    if isinstance(batch_masks1, im.InstanceMasks):
+        return batch_masks1.iou(batch_masks2)
+
     # Number of masks
     n_of_m1, h, w = batch_masks1.shape
     n_of_m2 = batch_masks2.shape[0]
@@ -979,4 +1065,45 @@ def cupy2tensor_dict(dict1):
     for key in dict1.keys():
         dict2[key] = torch.as_tensor(cp.unpackbits(dict1[key]), device=f'cuda:{first_cupy.device.id}')
 
-    return dict2
\ No newline at end of file
+    return dict2
+
+#-------------------------------------------------------------------------------
+# Test Functions
+
+def test_class_compress_performance(num_of_runs=10, image_size=(120, 160), batch_size=4):
+
+    import time
+
+    torch.manual_seed(0)
+
+    for num_of_classes in [2, 4, 7, 16]:
+
+        cat_mask = torch.randint(0, num_of_classes, (batch_size,) + image_size)
+        logits = {
+            k:torch.rand((batch_size, a*(num_of_classes-1)) + image_size, requires_grad=True) 
+            for k,a in [('quaternion', 4), ('scales', 3), ('xy', 2), ('z', 1)]
+        }
+
+        # Same values and gradients
+        outputs = [f(num_of_classes, cat_mask, logits) for f in [class_compress2, class_compress3]]
+        for key in logits.keys():
+            assert torch.allclose(outputs[0][key], outputs[1][key], atol=1e-6)
+            grads = [torch.autograd.grad(x[key].sum(), logits[key])[0] for x in outputs]
+            assert torch.allclose(grads[0], grads[1], atol=1e-6)
+
+        # Forward and backward timings
+        for f in [class_compress2, class_compress3]:
+
+            tic = time.perf_counter()
+            for i in range(num_of_runs):
+                output = f(num_of_classes, cat_mask, logits)
+                sum([x.sum() for x in output.values()]).backward()
+            toc = time.perf_counter()
+
+            print(f'{f.__name__} classes={num_of_classes}: {1000*(toc-tic)/num_of_runs:.2f} ms')
+
+#-------------------------------------------------------------------------------
+# Main Code
+
+if __name__ == '__main__':
+    test_class_compress_performance()
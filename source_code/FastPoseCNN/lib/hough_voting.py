@@ -21,6 +21,7 @@ except ImportError:
     pass
 
 import gpu_tensor_funcs as gtf
+import precision as pc
 
 #-------------------------------------------------------------------------------
 # Constants
@@ -39,11 +40,12 @@ class HoughVotingLayer(nn.Module):
     def forward(self, agg_data):
 
         # Obtain data needed for hough voting
-        uv_img = agg_data['xy']
+        uv_img = agg_data['xy_img']
         mask = agg_data['instance_masks']
+        sample_ids = agg_data['sample_ids']
         
         # Performing hough voting
-        output = self.batchwise_hough_voting(uv_img, mask)
+        output = self.batchwise_hough_voting(uv_img, mask, sample_ids)
 
         # Store data
         agg_data.update(output)
@@ -53,10 +55,16 @@ class HoughVotingLayer(nn.Module):
     #---------------------------------------------------------------------------
     # Hough Voting per batch
 
-    def batchwise_hough_voting(self, uv_img, mask):
+    def batchwise_hough_voting(self, uv_img, mask, sample_ids):
+        """
+        Args:
+            uv_img (torch.Tensor): Bx2xHxW unit vector images of the batch
+            mask (InstanceMasks): N compact instance masks
+            sample_ids (torch.Tensor): N sample id of each instance
+        """
 
         # If instances exist, perform hough voting
-        if uv_img.shape[0] != 0:
+        if len(mask) != 0:
 
             # dummy_output = {
             #     'xy': 100*torch.ones((uv_img.shape[0], 2), device=uv_img.device),
@@ -70,7 +78,8 @@ class HoughVotingLayer(nn.Module):
             # Generate hypothesis
             hypothesis, all_pts = self.batchwise_generate_hypothesis(
                 uv_img, 
-                mask
+                mask,
+                sample_ids
             )
 
             # Pruning of outliers
@@ -81,6 +90,7 @@ class HoughVotingLayer(nn.Module):
             weights = self.batchwise_calculate_hypothesis_weights(
                 all_pts, 
                 uv_img, 
+                sample_ids,
                 pruned_hypothesis
             )
 
@@ -112,7 +122,6 @@ class HoughVotingLayer(nn.Module):
             # Put all valuable data into dictionary
             output = {
                 'xy': pixel_xy,
-                'xy_mask': uv_img,
                 'hypothesis': hypothesis,
                 'pruned_hypothesis': pruned_hypothesis
             }
@@ -133,23 +142,22 @@ class HoughVotingLayer(nn.Module):
             # Output for no instances
             output = {
                 'xy': torch.zeros((0, 2), device=uv_img.device),
-                'xy_mask': uv_img,
                 'hypothesis': torch.zeros((0, self.HPARAM.HV_NUM_OF_HYPOTHESES, 2), device=uv_img.device),
                 'pruned_hypothesis': torch.zeros((0, self.HPARAM.HV_NUM_OF_HYPOTHESES, 2), device=uv_img.device),
             }
 
         return output
 
-    def batchwise_generate_hypothesis(self, uv_img, mask):
+    def batchwise_generate_hypothesis(self, uv_img, mask, sample_ids):
 
         valid_samples = []
         single_pt_hypothesis = {}
         all_pts = []
 
-        for i in range(uv_img.shape[0]):
+        for i in range(len(mask)):
 
-            # Obtain the pts of the mask
-            pts = torch.stack(torch.where(mask[i]), dim=1)
+            # Obtain the pts of the mask (from the compact mask's bounding box)
+            pts = mask.pixel_coords(i)
 
             # Determining the number of pts present
             num_of_pts = pts.shape[0]
@@ -176,7 +184,7 @@ class HoughVotingLayer(nn.Module):
             pt_pairs = torch.stack([pts[point_pair_idx[:,0]], pts[point_pair_idx[:,1]]])
 
             # Indexing the pts unit vector values
-            uv_pt_pairs = uv_img[i, :, pt_pairs[:,:,0], pt_pairs[:,:,1]]
+            uv_pt_pairs = uv_img[sample_ids[i], :, pt_pairs[:,:,0], pt_pairs[:,:,1]]
             uv_pt_pairs = uv_pt_pairs.permute(1,2,0)
 
             # Construct the system of equations
@@ -218,12 +226,12 @@ class HoughVotingLayer(nn.Module):
 
         # Splitting the total_Y based on the number of instances
         total_Y = torch.zeros(
-            (uv_img.shape[0], self.HPARAM.HV_NUM_OF_HYPOTHESES, 2),
+            (len(mask), self.HPARAM.HV_NUM_OF_HYPOTHESES, 2),
             device=uv_img.device
         )
 
         # Combine all the hypothesis into a single tensor
-        for i in range(uv_img.shape[0]):
+        for i in range(len(mask)):
 
             # Check if this is a valid sample
             if i in valid_samples.keys():
@@ -235,12 +243,12 @@ class HoughVotingLayer(nn.Module):
 
         return total_Y, all_pts
 
-    def batchwise_calculate_hypothesis_weights(self, all_pts, uv_img, hypothesis):
+    def batchwise_calculate_hypothesis_weights(self, all_pts, uv_img, sample_ids, hypothesis):
 
         all_weights = []
 
         # Determine the size
-        for i in range(uv_img.shape[0]):
+        for i in range(len(all_pts)):
 
             h = hypothesis[i]
             pts = all_pts[i]
@@ -248,7 +256,7 @@ class HoughVotingLayer(nn.Module):
             n_of_h = h.shape[0]
             n_of_p = pts.shape[0]
 
-            pts_uv_value = uv_img[i, :, pts[:,0], pts[:,1]]
+            pts_uv_value = uv_img[sample_ids[i], :, pts[:,0], pts[:,1]]
             pts_uv_value = pts_uv_value.permute(1,0)
 
             # Expand data to prepare large computation
@@ -435,6 +443,7 @@ class HoughVotingLayer(nn.Module):
         Y = torch.stack(Y)
         return Y
 
+    @pc.fp32_island
     def batched_pinverse_solver(self, A, B, pt_pairs, uv_pt_pairs):
         """
         Optimized version of lstsq_solver function!
@@ -511,6 +520,7 @@ class HoughVotingLayer(nn.Module):
 
         return outliers_idx
 
+    @pc.fp32_island
     def batchwise_iqr_trimming(self, Y):
 
         # Determine Q2
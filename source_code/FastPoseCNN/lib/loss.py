@@ -220,7 +220,7 @@ class AggregatedLoss(_Loss):
                 raise NotImplementedError("Invalid entered key.")
         else:
             try:
-                return torch.tensor(float('nan'), device=gt_pred_matches['instance_masks'].device).float()   
+                return torch.tensor(float('nan'), device=gt_pred_matches['class_ids'].device).float()   
             except:
                 return torch.tensor(float('nan')).cuda().float()   
 
@@ -272,7 +272,7 @@ class QLoss(_Loss): # Quaternion
 
         else:
             try:
-                return torch.tensor(float('nan'), device=gt_pred_matches['instance_masks'].device).float()   
+                return torch.tensor(float('nan'), device=gt_pred_matches['class_ids'].device).float()   
             except:
                 try:
                     return torch.tensor(float('nan')).cuda().float()
@@ -371,7 +371,7 @@ class RLoss(_Loss): # Rotation Matrix
 
         else:
             try:
-                return torch.tensor(float('nan'), device=gt_pred_matches['instance_masks'].device).float()   
+                return torch.tensor(float('nan'), device=gt_pred_matches['class_ids'].device).float()   
             except:
                 try:
                     return torch.tensor(float('nan')).cuda().float()
@@ -412,7 +412,7 @@ class TLoss(_Loss): # Translation Vector
 
         else:
             try:
-                return torch.tensor(float('nan'), device=gt_pred_matches['instance_masks'].device).float()   
+                return torch.tensor(float('nan'), device=gt_pred_matches['class_ids'].device).float()   
             except:
                 try:
                     return torch.tensor(float('nan')).cuda().float()
@@ -458,7 +458,7 @@ class XYLoss(_Loss): # 2D Center
 
         else:
             try:
-                return torch.tensor(float('nan'), device=gt_pred_matches['instance_masks'].device).float()   
+                return torch.tensor(float('nan'), device=gt_pred_matches['class_ids'].device).float()   
             except:
                 try:
                     return torch.tensor(float('nan')).cuda().float()
@@ -501,7 +501,7 @@ class ZLoss(_Loss): # Z - depth
 
         else:
             try:
-                return torch.tensor(float('nan'), device=gt_pred_matches['instance_masks'].device).float()   
+                return torch.tensor(float('nan'), device=gt_pred_matches['class_ids'].device).float()   
             except:
                 try:
                     return torch.tensor(float('nan')).cuda().float()
@@ -544,7 +544,7 @@ class ScalesLoss(_Loss): # h, w, l scales
 
         else:
             try:
-                return torch.tensor(float('nan'), device=gt_pred_matches['instance_masks'].device).float()   
+                return torch.tensor(float('nan'), device=gt_pred_matches['class_ids'].device).float()   
             except:
                 try:
                     return torch.tensor(float('nan')).cuda().float()
@@ -585,7 +585,7 @@ class Iou3dLoss(_Loss):
 
         else:
             try:
-                return torch.tensor(float('nan'), device=gt_pred_matches['instance_masks'].device).float()   
+                return torch.tensor(float('nan'), device=gt_pred_matches['class_ids'].device).float()   
             except:
                 try:
                     return torch.tensor(float('nan')).cuda().float()
@@ -625,7 +625,7 @@ class OffsetLoss(_Loss):
 
         else:
             try:
-                return torch.tensor(float('nan'), device=gt_pred_matches['instance_masks'].device).float()   
+                return torch.tensor(float('nan'), device=gt_pred_matches['class_ids'].device).float()   
             except:
                 try:
                     return torch.tensor(float('nan')).cuda().float()
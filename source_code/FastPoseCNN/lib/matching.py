@@ -21,6 +21,7 @@ try:
 except ImportError:
     pass
 
+import containers as ct
 import gpu_tensor_funcs as gtf
 
 import hough_voting as hvk
@@ -29,7 +30,6 @@ import hough_voting as hvk
 # Constants
 
 KEYS_TO_STACK = [
-    'instance_masks', # Class
     'quaternion', 'R', # Rotation
     'scales', # Size
     'xy', 'z', 'T', # Translation
@@ -328,7 +328,7 @@ def batchwise_find_matches2(preds, gts):
             axis = 1
         pred_gt_matches[key] = torch.cat(pred_gt_matches[key], dim=axis)
 
-    return pred_gt_matches 
+    return ct.Matches(**pred_gt_matches)
 
 def get_standard_preds(gts, n_of_data):
 
@@ -365,7 +365,7 @@ def get_standard_preds(gts, n_of_data):
             std_preds[data_key] = torch.unsqueeze(
                 get_standard_preds.standard_preds[data_key],
                 dim=0
-            ).repeat_interleave(n_of_data, dim=0).to(gts['instance_masks'].device)
+            ).repeat_interleave(n_of_data, dim=0).to(gts['class_ids'].device)
 
     return std_preds
             
@@ -382,20 +382,9 @@ def batchwise_find_matches(preds, gts):
     if preds['class_ids'].shape[0] == 0:
         return None
 
-    pred_gt_matches = {
-        'sample_ids': [],
-        'class_ids': [],
-        'symmetric_ids': []
-    }
-
-    keys_to_stack = [
-        'instance_masks', # Class
-        'quaternion', 'R', # Rotation
-        'scales', # Size
-        'xy', 'z', 'T', # Translation
-        'RT', # Transformation
-        'xy_mask', 'hypothesis', 'pruned_hypothesis' # Hough Voting
-    ]
+    # The matched instances of all the classes, gathered once at the end
+    matched_gt_ids = []
+    matched_pred_ids = []
 
     # For each class
     for class_id in torch.unique(gts['class_ids']):
@@ -424,45 +413,34 @@ def batchwise_find_matches(preds, gts):
 
         # Pair ground truth and predictions based on their iou_2ds
         max_v, max_pred_id = torch.max(iou_2ds, dim=1)
-        max_gt_id = torch.arange(n_of_m1)
 
         # Removing those whose max iou2d was zero
         valid_max_id = max_v > 0
 
-        # Check that there is true matches to begin
-        if (valid_max_id == False).all():
-            continue            
-
         # Keep only good matches
-        max_v = max_v[valid_max_id]
-        max_pred_id = max_pred_id[valid_max_id]
-        max_gt_id = max_gt_id[valid_max_id]
+        matched_gt_ids.append(gts_class_instances[valid_max_id])
+        matched_pred_ids.append(preds_class_instances[max_pred_id[valid_max_id]])
 
-        # Storing shared data
-        class_instance_identifiers = torch.tensor(
-            [class_id], device=gts_class_instances.device
-        ).repeat(max_gt_id.shape[0])
-
-        # Storing data that is shared between ground truth and pred agg data
-        pred_gt_matches['sample_ids'].append(gts['sample_ids'][gts_class_instances][max_gt_id])
-        pred_gt_matches['symmetric_ids'].append(gts['symmetric_ids'][gts_class_instances][max_gt_id])
-        pred_gt_matches['class_ids'].append(class_instance_identifiers)
-
-        # Stacking and storing data
-        stack_and_store_data(
-            pred_gt_matches,
-            gts,
-            preds,
-            gts_class_instances[max_gt_id],
-            preds_class_instances[max_pred_id]
-        )
+    # Check that there is true matches to begin
+    if not matched_gt_ids:
+        return None
 
-    # Concatinating the results
-    for key in pred_gt_matches.keys():
-        if key in ['sample_ids', 'class_ids', 'symmetric_ids']:
-            axis = 0
-        else:
-            axis = 1
-        pred_gt_matches[key] = torch.cat(pred_gt_matches[key], dim=axis)
+    gt_ids = torch.cat(matched_gt_ids)
+    pred_ids = torch.cat(matched_pred_ids)
+
+    if gt_ids.shape[0] == 0:
+        return None
 
-    return pred_gt_matches   
+    # Storing data that is shared between ground truth and pred agg data
+    pred_gt_matches = ct.Matches(
+        sample_ids=gts['sample_ids'][gt_ids],
+        class_ids=gts['class_ids'][gt_ids],
+        symmetric_ids=gts['symmetric_ids'][gt_ids]
+    )
+
+    # Stacking the ground truth and pred data (2xN)
+    for data_key in KEYS_TO_STACK:
+        if data_key in gts and data_key in preds:
+            pred_gt_matches[data_key] = torch.stack((gts[data_key][gt_ids], preds[data_key][pred_ids]))
+
+    return pred_gt_matches
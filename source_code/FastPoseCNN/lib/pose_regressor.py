@@ -26,6 +26,8 @@ import gpu_tensor_funcs as gtf
 import aggregation_layer as al
 import hough_voting as hv
 import matching as mg
+import fused_decoder as fd
+import precision as pc
 
 #-------------------------------------------------------------------------------
 # Constants
@@ -54,12 +56,15 @@ def compress_dict(my_dict, additional_subkey=None):
 
 class PoseRegressionTask(pl.LightningModule):
 
-    def __init__(self, conf, model, criterion, metrics, HPARAM):
+    def __init__(self, conf, model, criterion, metrics, HPARAM, batch_augmentation=None):
         super().__init__()
 
         # Saving parameters
         self.model = model
 
+        # Augmentation of the training batches (already in the device)
+        self.batch_augmentation = batch_augmentation
+
         # Saving the configuration (additional hyperparameters)
         self.save_hyperparameters(conf)
         self.HPARAM = HPARAM
@@ -74,10 +79,13 @@ class PoseRegressionTask(pl.LightningModule):
         self.past_inf_flag = False
 
     @pl.core.decorators.auto_move_data
-    def forward(self, x):
+    def forward(self, x, intrinsics=None):
 
-        # Feed in the input to the actual model
-        y = self.model(x)
+        # Feed in the input to the actual model (intrinsics of each sample, e.g.
+        # for the crops, else the model's intrinsics). With PRECISION='bf16' the
+        # network runs in bf16 autocast, its outputs (and so the losses and
+        # metrics) are in fp32 and no loss scaling is needed.
+        y = self.model(x, intrinsics)
 
         # Ensuring that the first-level outputs (mostly the image-size outputs)
         # do not have nans for visualization and metric purposes
@@ -99,6 +107,10 @@ class PoseRegressionTask(pl.LightningModule):
         if not batch:
             LOGGER.debug("EMPTY BATCH, SKIPPED!")
             return None
+
+        # Augmenting the entire batch (image, mask and agg_data)
+        if self.batch_augmentation:
+            batch = self.batch_augmentation(batch)
         
         # Calculate the loss and metrics
         multi_task_losses, multi_task_metrics = self.shared_step('train', batch, batch_idx)
@@ -164,7 +176,7 @@ class PoseRegressionTask(pl.LightningModule):
         #batch = torch.load('/home/students/edavalos/GitHub/FastPoseCNN/source_code/FastPoseCNN/logs/21-03-04/18-43-INF_CATCH1-CAMERA-resnet18-imagenet/inf_batch_epoch=1.pth', map_location = self.device)
 
         # Forward pass the input and generate the prediction of the NN
-        outputs = self.forward(batch['image'])
+        outputs = self.forward(batch['image'], batch.get('intrinsics', None))
 
         # Matching aggregated data between ground truth and predicted
         if self.HPARAM.PERFORM_AGGREGATION and self.HPARAM.PERFORM_MATCHING:
@@ -431,7 +443,7 @@ class PoseRegressionTask(pl.LightningModule):
 class Model(object):
 
     # Shared aggregation, hough voting and RT generation function
-    def agg_hough_and_generate_RT(self, cat_mask, data):
+    def agg_hough_and_generate_RT(self, cat_mask, data, inv_intrinsics=None):
 
         # If aggregation is wanted, perform it
         if self.HPARAM.PERFORM_AGGREGATION:
@@ -446,7 +458,9 @@ class Model(object):
                 # If RT calculation is wanted, perform it
                 if self.HPARAM.PERFORM_RT_CALCULATION:
                     # Calculate RT
-                    agg_data = gtf.samplewise_get_RT(agg_data, self.inv_intrinsics)
+                    if inv_intrinsics is None:
+                        inv_intrinsics = self.inv_intrinsics
+                    agg_data = gtf.samplewise_get_RT(agg_data, inv_intrinsics)
 
         else:
             return None 
@@ -534,8 +548,13 @@ class PoseRegressor(Model, torch.nn.Module):
         # Storing crucial parameters
         self.HPARAM = HPARAM # other algorithm and run hyperparameters
         self.classes = classes # includes background
+        # Intrinsics of the input resolution (scaled with RESOLUTION_SCALE), 
+        # so that the RTs from the projected xy are metrically correct
         self.intrinsics = torch.from_numpy(HPARAM.NUMPY_INTRINSICS).float()
         self.inv_intrinsics = torch.inverse(self.intrinsics)
+        # Precision of the encoder, decoders and heads (see precision.py)
+        self.precision = HPARAM.PRECISION
+        pc.check_precision(self.precision)
 
         # Obtain encoder
         self.encoder = smp.encoders.get_encoder(
@@ -622,10 +641,17 @@ class PoseRegressor(Model, torch.nn.Module):
         init.initialize_decoder(self.scales_decoder)
         init.initialize_head(self.scales_head)
 
+        # Running the four branches in a single pass (see fused_decoder)
+        self.fused = HPARAM.FUSED_DECODER
+        if self.fused:
+            self.fuse_branches(param_dict, activation, upsampling)
+
         # Use the HPARAM variables to freeze certain components
         # Freeze any components of the model
         if HPARAM.FREEZE_ENCODER:
             gtf.freeze(self.encoder)
+        if self.fused and (HPARAM.FREEZE_MASK_TRAINING or HPARAM.FREEZE_ROTATION_TRAINING or HPARAM.FREEZE_TRANSLATION_TRAINING or HPARAM.FREEZE_SCALES_TRAINING):
+            raise RuntimeError('Freezing the branches requires the sequential decoders (FUSED_DECODER=False)')
         if HPARAM.FREEZE_MASK_TRAINING:
             gtf.freeze(self.mask_decoder)
             gtf.freeze(self.segmentation_head)
@@ -639,42 +665,54 @@ class PoseRegressor(Model, torch.nn.Module):
             gtf.freeze(self.scales_decoder)
             gtf.freeze(self.scales_head)
 
-    def forward(self, x):
+        # Convolution weights in channels-last (fp32_channels_last and bf16)
+        if pc.channels_last(self.precision):
+            pc.to_channels_last(self)
+
+    def fuse_branches(self, param_dict, activation, upsampling):
+
+        # Replacing the four decoders and heads by their fused version (same
+        # weights)
+        decoders = [getattr(self, name) for name in fd.DECODER_NAMES]
+        heads = [getattr(self, name) for name in fd.HEAD_NAMES]
+
+        self.fused_decoder = fd.FusedFPNDecoder.from_decoders(decoders, **param_dict)
+        self.fused_heads = fd.FusedSegmentationHeads.from_heads(
+            heads,
+            in_channels=decoders[0].out_channels,
+            activation=activation,
+            upsampling=upsampling
+        )
+
+        for name in fd.DECODER_NAMES + fd.HEAD_NAMES:
+            delattr(self, name)
+
+        # The checkpoints of the sequential decoders are remapped when loaded
+        self._register_load_state_dict_pre_hook(self.remap_sequential_state_dict)
+
+    def remap_sequential_state_dict(self, state_dict, prefix, *args):
+        fd.remap_state_dict(state_dict, self.fused_heads, prefix)
+
+    def forward(self, x, intrinsics=None):
 
         # Ensuring that intrinsics is in the same device
         if self.intrinsics.device != x.device:
             self.intrinsics = self.intrinsics.to(x.device)
             self.inv_intrinsics = torch.inverse(self.intrinsics)
 
-        # Encoder
-        features = self.encoder(x)
-        
-        # Decoders
-        mask_decoder_output = self.mask_decoder(*features)
-        rotation_decoder_output = self.rotation_decoder(*features)
-        translation_decoder_output = self.translation_decoder(*features)
-        scales_decoder_output = self.scales_decoder(*features)
-
-        # Heads 
-        mask_logits = self.segmentation_head(mask_decoder_output)
-        quat_logits = self.rotation_head(rotation_decoder_output)
-        xyz_logits = self.translation_head(translation_decoder_output)
-        scales_logits = self.scales_head(scales_decoder_output)
-
-        # Spliting the (xyz) to (xy, z) since they will eventually have different
-        # ways of computing the loss.
-        xy_index = np.array([i for i in range(xyz_logits.shape[1]) if i%3!=0]) - 1
-        z_index = np.array([i for i in range(xyz_logits.shape[1]) if i%3==0]) + 2
-        xy_logits = xyz_logits[:,xy_index,:,:]
-        z_logits = xyz_logits[:,z_index,:,:]
-
-        # Storing all logits in a dictionary
-        logits = {
-            'quaternion': quat_logits,
-            'scales': scales_logits,
-            'xy': xy_logits,
-            'z': z_logits
-        }
+        # Per-sample intrinsics (Bx3x3), e.g. of the object-centric crops
+        inv_intrinsics = None
+        if intrinsics is not None:
+            inv_intrinsics = torch.inverse(intrinsics.to(x.device).float())
+
+        # Network (encoder, decoders and heads), in channels-last with
+        # PRECISION='fp32_channels_last' and also in bf16 autocast with
+        # PRECISION='bf16'. The post-processing is in fp32.
+        with pc.autocast(self.precision, x.device.type):
+            mask_logits, logits = self.forward_logits(
+                pc.to_channels_last(x) if pc.channels_last(self.precision) else x
+            )
+        mask_logits, logits = pc.to_fp32((mask_logits, logits))
 
         # ! Debugging only
         #return logits
@@ -683,13 +721,14 @@ class PoseRegressor(Model, torch.nn.Module):
         cat_mask = torch.argmax(torch.nn.LogSoftmax(dim=1)(mask_logits), dim=1)
 
         # Class compression of the data
-        cc_logits = gtf.class_compress2(self.classes, cat_mask, logits)
+        cc_logits = gtf.class_compress3(self.classes, cat_mask, logits)
 
         # Perform aggregation, hough voting, and generate RT matrix given the 
         # results o f previous operations.
         agg_pred = self.agg_hough_and_generate_RT(
             cat_mask,
-            cc_logits
+            cc_logits,
+            inv_intrinsics
         )
 
         # Generating complete output
@@ -704,6 +743,45 @@ class PoseRegressor(Model, torch.nn.Module):
 
         return output
 
+    def forward_logits(self, x):
+
+        # Encoder
+        features = self.encoder(x)
+
+        # Fused decoders and heads
+        if self.fused:
+            mask_logits, quat_logits, xyz_logits, scales_logits = self.fused_heads(self.fused_decoder(*features))
+
+        else:
+            # Decoders
+            mask_decoder_output = self.mask_decoder(*features)
+            rotation_decoder_output = self.rotation_decoder(*features)
+            translation_decoder_output = self.translation_decoder(*features)
+            scales_decoder_output = self.scales_decoder(*features)
+
+            # Heads 
+            mask_logits = self.segmentation_head(mask_decoder_output)
+            quat_logits = self.rotation_head(rotation_decoder_output)
+            xyz_logits = self.translation_head(translation_decoder_output)
+            scales_logits = self.scales_head(scales_decoder_output)
+
+        # Spliting the (xyz) to (xy, z) since they will eventually have different
+        # ways of computing the loss (constant indices, also when traced).
+        xy_index = [i-1 for i in range(xyz_logits.shape[1]) if i%3!=0]
+        z_index = [i+2 for i in range(xyz_logits.shape[1]) if i%3==0]
+        xy_logits = xyz_logits[:,xy_index,:,:]
+        z_logits = xyz_logits[:,z_index,:,:]
+
+        # Storing all logits in a dictionary
+        logits = {
+            'quaternion': quat_logits,
+            'scales': scales_logits,
+            'xy': xy_logits,
+            'z': z_logits
+        }
+
+        return mask_logits, logits
+
 class PoseRegressor2(Model, torch.nn.Module):
 
     # Inspired by 
@@ -733,8 +811,13 @@ class PoseRegressor2(Model, torch.nn.Module):
         # Storing crucial parameters
         self.HPARAM = HPARAM # other algorithm and run hyperparameters
         self.classes = classes # includes background
+        # Intrinsics of the input resolution (scaled with RESOLUTION_SCALE), 
+        # so that the RTs from the projected xy are metrically correct
         self.intrinsics = torch.from_numpy(HPARAM.NUMPY_INTRINSICS).float()
         self.inv_intrinsics = torch.inverse(self.intrinsics)
+        # Precision of the encoder, decoders and heads (see precision.py)
+        self.precision = HPARAM.PRECISION
+        pc.check_precision(self.precision)
 
         # Obtain encoder
         self.encoder = smp.encoders.get_encoder(
@@ -825,37 +908,30 @@ class PoseRegressor2(Model, torch.nn.Module):
         if HPARAM.FREEZE_SCALES_TRAINING:
             gtf.freeze(self.scales_head)
 
-    def forward(self, x):
+        # Convolution weights in channels-last (fp32_channels_last and bf16)
+        if pc.channels_last(self.precision):
+            pc.to_channels_last(self)
+
+    def forward(self, x, intrinsics=None):
 
         # Ensuring that intrinsics is in the same device
         if self.intrinsics.device != x.device:
             self.intrinsics = self.intrinsics.to(x.device)
             self.inv_intrinsics = torch.inverse(self.intrinsics)
 
-        # Encoder
-        features = self.encoder(x)
-        decoder_output = self.decoder(*features)
-
-        # Heads 
-        mask_logits = self.segmentation_head(decoder_output)
-        quat_logits = self.rotation_head(decoder_output)
-        xyz_logits = self.translation_head(decoder_output)
-        scales_logits = self.scales_head(decoder_output)
-
-        # Spliting the (xyz) to (xy, z) since they will eventually have different
-        # ways of computing the loss.
-        xy_index = np.array([i for i in range(xyz_logits.shape[1]) if i%3!=0]) - 1
-        z_index = np.array([i for i in range(xyz_logits.shape[1]) if i%3==0]) + 2
-        xy_logits = xyz_logits[:,xy_index,:,:]
-        z_logits = xyz_logits[:,z_index,:,:]
-
-        # Storing all logits in a dictionary
-        logits = {
-            'quaternion': quat_logits,
-            'scales': scales_logits,
-            'xy': xy_logits,
-            'z': z_logits
-        }
+        # Per-sample intrinsics (Bx3x3), e.g. of the object-centric crops
+        inv_intrinsics = None
+        if intrinsics is not None:
+            inv_intrinsics = torch.inverse(intrinsics.to(x.device).float())
+
+        # Network (encoder, decoder and heads), in channels-last with
+        # PRECISION='fp32_channels_last' and also in bf16 autocast with
+        # PRECISION='bf16'. The post-processing is in fp32.
+        with pc.autocast(self.precision, x.device.type):
+            mask_logits, logits = self.forward_logits(
+                pc.to_channels_last(x) if pc.channels_last(self.precision) else x
+            )
+        mask_logits, logits = pc.to_fp32((mask_logits, logits))
 
         # ! Debugging only
         #return logits
@@ -864,13 +940,14 @@ class PoseRegressor2(Model, torch.nn.Module):
         cat_mask = torch.argmax(torch.nn.LogSoftmax(dim=1)(mask_logits), dim=1)
 
         # Class compression of the data
-        cc_logits = gtf.class_compress2(self.classes, cat_mask, logits)
+        cc_logits = gtf.class_compress3(self.classes, cat_mask, logits)
 
         # Perform aggregation, hough voting, and generate RT matrix given the 
         # results o f previous operations.
         agg_pred = self.agg_hough_and_generate_RT(
             cat_mask,
-            cc_logits
+            cc_logits,
+            inv_intrinsics
         )
 
         # Generating complete output
@@ -885,6 +962,35 @@ class PoseRegressor2(Model, torch.nn.Module):
 
         return output
 
+    def forward_logits(self, x):
+
+        # Encoder
+        features = self.encoder(x)
+        decoder_output = self.decoder(*features)
+
+        # Heads 
+        mask_logits = self.segmentation_head(decoder_output)
+        quat_logits = self.rotation_head(decoder_output)
+        xyz_logits = self.translation_head(decoder_output)
+        scales_logits = self.scales_head(decoder_output)
+
+        # Spliting the (xyz) to (xy, z) since they will eventually have different
+        # ways of computing the loss (constant indices, also when traced).
+        xy_index = [i-1 for i in range(xyz_logits.shape[1]) if i%3!=0]
+        z_index = [i+2 for i in range(xyz_logits.shape[1]) if i%3==0]
+        xy_logits = xyz_logits[:,xy_index,:,:]
+        z_logits = xyz_logits[:,z_index,:,:]
+
+        # Storing all logits in a dictionary
+        logits = {
+            'quaternion': quat_logits,
+            'scales': scales_logits,
+            'xy': xy_logits,
+            'z': z_logits
+        }
+
+        return mask_logits, logits
+
 #-------------------------------------------------------------------------------
 # Available models (after model definitions)
 
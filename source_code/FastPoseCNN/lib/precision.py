@@ -0,0 +1,197 @@
+import os
+import sys
+import time
+import contextlib
+import functools
+
+import torch
+import torch.nn as nn
+
+#-------------------------------------------------------------------------------
+# Constants
+
+# Options of HPARAM.PRECISION: the encoder, decoders and heads run in fp32, in
+# fp32 with channels-last activations, or in bf16 autocast with channels-last
+# activations
+PRECISIONS = ['fp32', 'fp32_channels_last', 'bf16']
+
+#-------------------------------------------------------------------------------
+# Autocast
+
+# The CPU autocast (and bf16 autocast) is torch.autocast (torch>=1.10), older
+# versions only have the fp16 torch.cuda.amp.autocast
+BF16_AUTOCAST_AVAILABLE = hasattr(torch, 'autocast')
+
+def check_precision(precision):
+
+    if precision not in PRECISIONS:
+        raise RuntimeError(f'Invalid HPARAM.PRECISION: {precision}, available: {PRECISIONS}')
+
+    if precision == 'bf16' and not BF16_AUTOCAST_AVAILABLE:
+        raise RuntimeError(f'PRECISION=bf16 requires torch.autocast (torch>=1.10, found {torch.__version__}), use PRECISION=fp32_channels_last')
+
+def channels_last(precision):
+    return precision != 'fp32'
+
+def autocast(precision, device_type='cpu'):
+    """
+    Args:
+        precision (str): HPARAM.PRECISION
+        device_type (str): 'cpu' or 'cuda', the device of the input
+    Output:
+        context manager: bf16 autocast (or nothing for the fp32 precisions)
+    """
+
+    check_precision(precision)
+
+    if precision == 'bf16':
+        return torch.autocast(device_type, dtype=torch.bfloat16)
+
+    return contextlib.nullcontext()
+
+def autocast_disabled():
+
+    stack = contextlib.ExitStack()
+
+    if hasattr(torch, 'autocast'):
+        stack.enter_context(torch.autocast('cpu', enabled=False))
+        if torch.cuda.is_available():
+            stack.enter_context(torch.autocast('cuda', enabled=False))
+    elif torch.cuda.is_available():
+        stack.enter_context(torch.cuda.amp.autocast(enabled=False))
+
+    return stack
+
+def to_fp32(data):
+
+    if isinstance(data, torch.Tensor):
+        return data.float() if data.is_floating_point() else data
+    elif isinstance(data, dict):
+        return {k:to_fp32(v) for k,v in data.items()}
+    elif isinstance(data, (list, tuple)):
+        return type(data)(to_fp32(v) for v in data)
+
+    return data
+
+def fp32_island(function):
+    """Runs the function in fp32 inside an autocast region: autocast is
+    disabled and its floating point tensors (also in dicts, lists and tuples)
+    are cast to fp32. For the numerically sensitive steps (class compression,
+    aggregation, pinverse, IQR, RT).
+    """
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with autocast_disabled():
+            return function(*to_fp32(args), **to_fp32(kwargs))
+
+    return wrapper
+
+#-------------------------------------------------------------------------------
+# Memory Format
+
+def to_channels_last(data):
+
+    # Only the 4D tensors (NCHW images and conv weights) have the channels-last
+    # format
+    if isinstance(data, nn.Module):
+        return data.to(memory_format=torch.channels_last)
+    elif isinstance(data, torch.Tensor) and data.dim() == 4:
+        return data.contiguous(memory_format=torch.channels_last)
+
+    return data
+
+#-------------------------------------------------------------------------------
+# Functions
+
+def test_precision(num_of_runs=5, classes=4, image_size=(256, 320)):
+
+    import argparse
+    import numpy as np
+
+    import pose_regressor as pr
+    import gpu_tensor_funcs as gtf
+
+    class HPARAM(argparse.Namespace):
+        NUMPY_INTRINSICS = np.array([[577.5, 0, 319.5], [0, 577.5, 239.5], [0, 0, 1]])
+        FUSED_DECODER = False
+        PRECISION = 'fp32'
+        FREEZE_ENCODER = False
+        FREEZE_MASK_TRAINING = False
+        FREEZE_ROTATION_TRAINING = False
+        FREEZE_TRANSLATION_TRAINING = False
+        FREEZE_SCALES_TRAINING = False
+        PERFORM_AGGREGATION = False
+        PERFORM_HOUGH_VOTING = False
+        PERFORM_RT_CALCULATION = False
+
+    # bf16 only with torch.autocast, else its clear error
+    precisions = ['fp32_channels_last']
+    if BF16_AUTOCAST_AVAILABLE:
+        precisions.append('bf16')
+    else:
+        try:
+            check_precision('bf16')
+            assert False
+        except RuntimeError as e:
+            print(f'skipping bf16: {e}')
+
+    torch.manual_seed(0)
+
+    models = {'fp32': pr.PoseRegressor(HPARAM, encoder_name='resnet18', encoder_weights=None, classes=classes).eval()}
+    for precision in precisions:
+        precision_hparam = type('PRECISION_HPARAM', (HPARAM,), {'PRECISION': precision})
+        models[precision] = pr.PoseRegressor(precision_hparam, encoder_name='resnet18', encoder_weights=None, classes=classes).eval()
+        models[precision].load_state_dict(models['fp32'].state_dict())
+
+        # Weights in channels-last, same values
+        assert models[precision].encoder.conv1.weight.is_contiguous(memory_format=torch.channels_last)
+
+    x = torch.rand((1, 3) + image_size)
+    with torch.no_grad():
+        outputs = {k:m(x) for k,m in models.items()}
+
+    # Accuracy regression: the outputs are fp32 and close to the fp32 outputs
+    # (same up to the summation order in channels-last)
+    max_errors = {'fp32_channels_last': 1e-4, 'bf16': 5e-2}
+    y = outputs['fp32']
+    for precision in precisions:
+        for key in ['mask', 'quaternion', 'scales', 'xy', 'z']:
+            assert outputs[precision][key].dtype == torch.float32
+            error = (y[key] - outputs[precision][key]).abs().mean() / y[key].abs().mean()
+            print(f'{precision:>18} {key:>10}: relative error {error:.5f}')
+            assert error < max_errors[precision], (precision, key)
+
+        agreement = (y['auxilary']['cat_mask'] == outputs[precision]['auxilary']['cat_mask']).float().mean()
+        print(f'{precision:>18}   cat_mask: {100*agreement:.1f}% agreement')
+        assert agreement > 0.95, precision
+
+    # The fp32 islands compute in fp32 (inside the bf16 autocast if available)
+    logits = {k:torch.rand((1, 4*(classes-1), 8, 8)) for k in ['quaternion', 'xy']}
+    cat_mask = torch.randint(classes, (1, 8, 8))
+    with autocast('bf16') if BF16_AUTOCAST_AVAILABLE else contextlib.nullcontext():
+        cc_logits = gtf.class_compress3(classes, cat_mask, {k:v.bfloat16() for k,v in logits.items()})
+        R, T, RT = gtf.batchwise_get_RT(
+            torch.rand((3, 4)).bfloat16(),
+            torch.rand((3, 2)).bfloat16() * 100,
+            torch.rand((3, 1)).bfloat16() * 1000,
+            torch.inverse(torch.from_numpy(HPARAM.NUMPY_INTRINSICS).float())
+        )
+
+    assert all(v.dtype == torch.float32 for v in cc_logits.values())
+    assert RT.dtype == torch.float32
+
+    for name, m in models.items():
+        with torch.no_grad():
+            m(x) # warm-up
+            tic = time.perf_counter()
+            for i in range(num_of_runs):
+                m(x)
+            toc = time.perf_counter()
+        print(f"{name}: {1000 * (toc - tic) / num_of_runs:.1f} ms/image")
+
+#-------------------------------------------------------------------------------
+# Main Code
+
+if __name__ == '__main__':
+    test_precision()
@@ -0,0 +1,335 @@
+import os
+import sys
+import time
+import logging
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import torch.quantization
+
+import torchvision.models.resnet
+import segmentation_models_pytorch as smp
+
+# Local imports
+import pose_regressor as pr
+
+#-------------------------------------------------------------------------------
+# Constants
+
+# Decoders of the PoseRegressor (four branches) and of the PoseRegressor2
+DECODER_NAMES = ['mask_decoder', 'rotation_decoder', 'translation_decoder', 'scales_decoder', 'decoder']
+
+# Hyperparameters needed to construct the quantized model again
+MODEL_HPARAMS = ['MODEL', 'BACKBONE_ARCH', 'ENCODER', 'ENCODER_WEIGHTS', 'SELECTED_CLASSES']
+
+LOGGER = logging.getLogger('fastposecnn')
+
+#-------------------------------------------------------------------------------
+# Quantizable Modules
+
+# Eager mode quantization (torch 1.7) needs the residual additions and the
+# pyramid merge as FloatFunctional modules. The ResNet and FPN blocks are
+# swapped in place (same parameters) by these classes, see swap_blocks.
+
+class QuantizableBasicBlock(nn.Module):
+
+    def forward(self, x):
+
+        identity = x
+
+        out = self.relu(self.bn1(self.conv1(x)))
+        out = self.bn2(self.conv2(out))
+
+        if self.downsample is not None:
+            identity = self.downsample(x)
+
+        return self.skip_add_relu.add_relu(out, identity)
+
+    def fuse_model(self):
+
+        torch.quantization.fuse_modules(self, [['conv1', 'bn1', 'relu'], ['conv2', 'bn2']], inplace=True)
+        if self.downsample is not None:
+            torch.quantization.fuse_modules(self.downsample, ['0', '1'], inplace=True)
+
+class QuantizableBottleneck(nn.Module):
+
+    def forward(self, x):
+
+        identity = x
+
+        out = self.relu1(self.bn1(self.conv1(x)))
+        out = self.relu2(self.bn2(self.conv2(out)))
+        out = self.bn3(self.conv3(out))
+
+        if self.downsample is not None:
+            identity = self.downsample(x)
+
+        return self.skip_add_relu.add_relu(out, identity)
+
+    def fuse_model(self):
+
+        torch.quantization.fuse_modules(
+            self,
+            [['conv1', 'bn1', 'relu1'], ['conv2', 'bn2', 'relu2'], ['conv3', 'bn3']],
+            inplace=True
+        )
+        if self.downsample is not None:
+            torch.quantization.fuse_modules(self.downsample, ['0', '1'], inplace=True)
+
+class QuantizableFPNBlock(nn.Module):
+
+    def forward(self, x, skip=None):
+        x = F.interpolate(x, scale_factor=2, mode="nearest")
+        skip = self.skip_conv(skip)
+        return self.skip_add.add(x, skip)
+
+class QuantizableMergeBlock(nn.Module):
+
+    def forward(self, x):
+
+        if self.policy == 'add':
+            merged = x[0]
+            for add, y in zip(self.adds, x[1:]):
+                merged = add.add(merged, y)
+            return merged
+
+        return self.cat.cat(x, dim=1)
+
+def swap_blocks(module):
+
+    # Collecting the blocks first, the swap adds submodules
+    for block in list(module.modules()):
+
+        if isinstance(block, torchvision.models.resnet.BasicBlock):
+            block.__class__ = QuantizableBasicBlock
+            block.skip_add_relu = nn.quantized.FloatFunctional()
+
+        elif isinstance(block, torchvision.models.resnet.Bottleneck):
+            block.__class__ = QuantizableBottleneck
+            block.relu1 = nn.ReLU(inplace=True)
+            block.relu2 = nn.ReLU(inplace=True)
+            block.skip_add_relu = nn.quantized.FloatFunctional()
+
+        elif isinstance(block, smp.fpn.decoder.FPNBlock):
+            block.__class__ = QuantizableFPNBlock
+            block.skip_add = nn.quantized.FloatFunctional()
+
+        elif isinstance(block, smp.fpn.decoder.MergeBlock):
+            block.__class__ = QuantizableMergeBlock
+            block.adds = nn.ModuleList([nn.quantized.FloatFunctional() for _ in range(3)]) # 4 pyramid levels
+            block.cat = nn.quantized.FloatFunctional()
+
+#-------------------------------------------------------------------------------
+# Quantized Encoder and Decoders
+
+class QuantizedEncoder(nn.Module):
+    """Quantizes the input of the smp ResNet encoder, its features stay
+    quantized for the QuantizedDecoders.
+    """
+
+    def __init__(self, encoder):
+        super().__init__()
+        self.encoder = encoder
+        self.out_channels = encoder.out_channels
+        self.quant = torch.quantization.QuantStub()
+
+    def forward(self, x):
+        return self.encoder(self.quant(x))
+
+    def fuse_model(self):
+
+        # Conv-BN-ReLU of the stem and the residual blocks
+        torch.quantization.fuse_modules(self.encoder, ['conv1', 'bn1', 'relu'], inplace=True)
+        for block in self.encoder.modules():
+            if isinstance(block, (QuantizableBasicBlock, QuantizableBottleneck)):
+                block.fuse_model()
+
+class QuantizedDecoder(nn.Module):
+    """FPNDecoder over the quantized features, its output is dequantized for
+    the (fp32) heads.
+    """
+
+    def __init__(self, decoder):
+        super().__init__()
+        self.decoder = decoder
+        self.out_channels = decoder.out_channels
+        self.dequant = torch.quantization.DeQuantStub()
+
+    def forward(self, *features):
+        return self.dequant(self.decoder(*features))
+
+#-------------------------------------------------------------------------------
+# Post-Training Static Quantization
+
+def prepare_quantization(model, backend='fbgemm'):
+    """
+    Wraps the encoder and decoders of the model (in place) with observers. The
+    heads, aggregation, hough voting and RT stay in fp32.
+
+    Args:
+        model (PoseRegressor or PoseRegressor2): fp32 model (in the cpu)
+        backend (str): quantized engine, 'fbgemm' for x86 CPUs
+    Output:
+        model: ready for calibrate and convert_quantization
+    """
+
+    if getattr(model, 'fused', False):
+        raise RuntimeError('Quantization requires the sequential decoders (FUSED_DECODER=False)')
+    if getattr(model, 'precision', 'fp32') != 'fp32':
+        raise RuntimeError('Quantization requires the fp32 model (PRECISION=fp32)')
+
+    torch.backends.quantized.engine = backend
+
+    # Histogram observers of the activations and per-channel weights
+    qconfig = torch.quantization.get_default_qconfig(backend)
+
+    model.eval()
+
+    swap_blocks(model.encoder)
+    model.encoder = QuantizedEncoder(model.encoder)
+    model.encoder.fuse_model()
+    model.encoder.qconfig = qconfig
+
+    for name in DECODER_NAMES:
+        if hasattr(model, name):
+            swap_blocks(getattr(model, name))
+            decoder = QuantizedDecoder(getattr(model, name))
+            decoder.qconfig = qconfig
+            setattr(model, name, decoder)
+
+    torch.quantization.prepare(model, inplace=True)
+
+    return model
+
+def calibrate(model, dataloader, num_of_batches, normalize_batch=None):
+    """
+    Args:
+        model: from prepare_quantization
+        dataloader: e.g. the datamodule's val_dataloader
+        num_of_batches (int): batches observed
+        normalize_batch (callable): e.g. the datamodule's normalize_batch
+    """
+
+    model.eval()
+
+    with torch.no_grad():
+        for batch_id, batch in enumerate(dataloader):
+
+            if batch_id >= num_of_batches:
+                break
+
+            if not batch:
+                continue
+
+            if normalize_batch:
+                batch = normalize_batch(batch)
+
+            # Only the quantized modules need the observations
+            model.forward_logits(batch['image'].cpu())
+
+    return model
+
+def convert_quantization(model):
+    return torch.quantization.convert(model.eval(), inplace=True)
+
+def save_quantized_model(model, path, HPARAM):
+
+    torch.save({
+        'hyper_parameters': {k:getattr(HPARAM, k) for k in MODEL_HPARAMS},
+        'state_dict': model.state_dict()
+    }, str(path))
+
+def load_quantized_model(path, HPARAM):
+
+    checkpoint = torch.load(str(path), map_location='cpu')
+
+    # Merge the model's hyperparameters (as Model.load_from_ckpt)
+    for attr, value in checkpoint['hyper_parameters'].items():
+        setattr(HPARAM, attr, value)
+
+    # Same quantized modules (their scales and weights come from the state_dict)
+    model = pr.MODELS[HPARAM.MODEL].construct_model(HPARAM)
+    prepare_quantization(model)
+    convert_quantization(model)
+
+    model.load_state_dict(checkpoint['state_dict'])
+
+    return model.eval()
+
+#-------------------------------------------------------------------------------
+# Functions
+
+def measure_latency(model, x, num_of_runs=20):
+    """
+    Output:
+        latencies (dict): ms of the network (encoder, decoders and heads) and
+            of the complete forward (with aggregation, hough voting and RT)
+    """
+
+    latencies = {}
+
+    with torch.no_grad():
+        for name, function in [('network', model.forward_logits), ('total', model.forward)]:
+
+            function(x) # warm-up
+
+            tic = time.perf_counter()
+            for i in range(num_of_runs):
+                function(x)
+            toc = time.perf_counter()
+
+            latencies[name] = 1000 * (toc - tic) / num_of_runs
+
+    return latencies
+
+def test_quantization(num_of_runs=5, classes=4, image_size=(256, 320)):
+
+    import argparse
+    import copy
+    import numpy as np
+
+    class HPARAM(argparse.Namespace):
+        NUMPY_INTRINSICS = np.array([[577.5, 0, 319.5], [0, 577.5, 239.5], [0, 0, 1]])
+        FUSED_DECODER = False
+        PRECISION = 'fp32'
+        FREEZE_ENCODER = False
+        FREEZE_MASK_TRAINING = False
+        FREEZE_ROTATION_TRAINING = False
+        FREEZE_TRANSLATION_TRAINING = False
+        FREEZE_SCALES_TRAINING = False
+        PERFORM_AGGREGATION = False
+        PERFORM_HOUGH_VOTING = False
+        PERFORM_RT_CALCULATION = False
+
+    torch.manual_seed(0)
+
+    model = pr.PoseRegressor(HPARAM, encoder_name='resnet18', encoder_weights=None, classes=classes).eval()
+    quantized_model = prepare_quantization(copy.deepcopy(model))
+
+    # Calibration on random images, then the quantized outputs are close to
+    # the fp32 outputs
+    calibrate(quantized_model, [{'image': torch.rand((2, 3) + image_size)} for _ in range(4)], 4)
+    convert_quantization(quantized_model)
+
+    x = torch.rand((1, 3) + image_size)
+    with torch.no_grad():
+        mask_logits, logits = model.forward_logits(x)
+        q_mask_logits, q_logits = quantized_model.forward_logits(x)
+
+    for key, y, q_y in [('mask', mask_logits, q_mask_logits)] + [(k, logits[k], q_logits[k]) for k in logits.keys()]:
+        error = (y - q_y).abs().mean() / y.abs().mean()
+        print(f'{key:>10}: relative error {error:.3f}')
+
+    # Encoder and decoders are quantized, the heads are not
+    assert isinstance(quantized_model.encoder.encoder.conv1, nn.intrinsic.quantized.ConvReLU2d)
+    assert isinstance(quantized_model.segmentation_head[0], nn.Conv2d)
+
+    for name, m in [('fp32', model), ('int8', quantized_model)]:
+        print(f"{name}: {measure_latency(m, x, num_of_runs)['network']:.1f} ms/image")
+
+#-------------------------------------------------------------------------------
+# Main Code
+
+if __name__ == '__main__':
+    test_quantization()
@@ -0,0 +1,120 @@
+# External Imports
+import os
+import sys
+import copy
+import pathlib
+import torch
+import argparse
+import pandas as pd
+
+os.environ['CUDA_VISIBLE_DEVICES'] = ''
+
+# Local Imports
+import setup_env
+import tools
+import config
+import lib
+
+#-------------------------------------------------------------------------------
+# Constants
+
+PATH = pathlib.Path('/home/students/edavalos/GitHub/FastPoseCNN/source_code/FastPoseCNN/logs/21-03-06/16-36-BASE_TEST-CAMERA-resnet18-imagenet/_/checkpoints/last.ckpt')
+HPARAM = config.DEFAULT_POSE_HPARAM()
+HPARAM.DATASET_NAME = 'CAMERA'
+
+# Input resolution of the latency report (before RESOLUTION_SCALE and the
+# pyramid padding)
+IMAGE_SIZE = (480, 640)
+LATENCY_NUM_OF_RUNS = 20
+
+#-------------------------------------------------------------------------------
+# File Main
+
+if __name__ == '__main__':
+
+    # Parse arguments and replace global variables if needed
+    parser = argparse.ArgumentParser(description='INT8 post-training static quantization of the encoder and decoders')
+
+    # Automatically adding all the attributes of the HPARAM to the parser
+    for attr in dir(HPARAM):
+        if '__' in attr or attr[0] == '_': # Private or magic attributes
+            continue
+
+        parser.add_argument(f'--{attr}', type=type(getattr(HPARAM, attr)), default=getattr(HPARAM, attr))
+
+    # Updating the HPARAMs
+    parser.parse_args(namespace=HPARAM)
+
+    # Getting the intrinsics for the dataset selected
+    HPARAM.NUMPY_INTRINSICS = tools.pt.scale_intrinsics(
+        tools.pj.constants.INTRINSICS[HPARAM.DATASET_NAME],
+        HPARAM.RESOLUTION_SCALE
+    )
+    HPARAM.VALID_SIZE = HPARAM.QUANT_CALIBRATION_BATCHES * HPARAM.BATCH_SIZE
+
+    # Construct the fp32 model and its quantized copy
+    model = lib.pose_regressor.MODELS[HPARAM.MODEL].load_from_ckpt(
+        PATH,
+        HPARAM
+    )
+    model.eval()
+    quantized_model = lib.quantization.prepare_quantization(copy.deepcopy(model))
+
+    # Load the PyTorch Lightning dataset (validation batches for the calibration)
+    datamodule = tools.ds.PoseRegressionDataModule(
+        dataset_name=HPARAM.DATASET_NAME,
+        selected_classes=HPARAM.SELECTED_CLASSES,
+        batch_size=HPARAM.BATCH_SIZE,
+        num_workers=HPARAM.NUM_WORKERS,
+        encoder=HPARAM.ENCODER,
+        encoder_weights=HPARAM.ENCODER_WEIGHTS,
+        train_size=HPARAM.TRAIN_SIZE,
+        valid_size=HPARAM.VALID_SIZE,
+        use_shards=HPARAM.USE_SHARDS,
+        use_streaming=HPARAM.USE_STREAMING,
+        subset_strategy=HPARAM.SUBSET_STRATEGY,
+        subset_seed=HPARAM.SUBSET_SEED,
+        cache_splits=[],
+        device_normalization=HPARAM.DEVICE_NORMALIZATION,
+        resolution_scale=HPARAM.RESOLUTION_SCALE,
+        readahead_depth=HPARAM.READAHEAD_DEPTH,
+        readahead_threads=HPARAM.READAHEAD_THREADS,
+        staging_bytes=int(HPARAM.STAGING_GB * 1024**3),
+        staging_check_source=HPARAM.STAGING_CHECK_SOURCE,
+        check_targets=HPARAM.CHECK_TARGETS
+    )
+    datamodule.setup()
+
+    # Calibration of the activations' observers and conversion to INT8
+    lib.quantization.calibrate(
+        quantized_model,
+        datamodule.val_dataloader(),
+        HPARAM.QUANT_CALIBRATION_BATCHES,
+        datamodule.normalize_batch
+    )
+    lib.quantization.convert_quantization(quantized_model)
+
+    # Saving the quantized checkpoint next to the fp32 checkpoint (QUANTIZED
+    # in evaluate.py and inference.py)
+    quantized_path = PATH.with_name(f'{PATH.stem}_int8.pth')
+    lib.quantization.save_quantized_model(quantized_model, quantized_path, HPARAM)
+
+    # Latency report (single image, CPU)
+    image_size = tools.pt.get_scaled_image_size(IMAGE_SIZE, HPARAM.RESOLUTION_SCALE)
+    x = torch.rand((1, 3) + image_size)
+
+    latencies = {}
+    for name, m in [('fp32', model), ('int8', quantized_model)]:
+        latencies[name] = lib.quantization.measure_latency(m, x, LATENCY_NUM_OF_RUNS)
+
+    df = pd.DataFrame(latencies).T
+    df['network speedup'] = df.loc['fp32', 'network'] / df['network']
+    df['total speedup'] = df.loc['fp32', 'total'] / df['total']
+
+    latency_path = PATH.with_name(f'{PATH.stem}_int8_latency.csv')
+    df.to_csv(latency_path)
+
+    print(f'Saved {quantized_path}')
+    print(f'Latency (ms/image, {torch.get_num_threads()} threads, {image_size[0]}x{image_size[1]}):')
+    print(df)
+    print("Accuracy: run evaluate.py, then evaluate.py --QUANTIZED True, with the same VALID_SIZE")
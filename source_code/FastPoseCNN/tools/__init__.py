@@ -9,5 +9,14 @@ import draw as dr
 import visualize as vz
 import project as pj
 import json_tools as jt
+import shard_tools as st
+import manifest_tools as mt
+import instance_masks as im
+import containers as ct
+import sample_cache as sc
+import readahead as ra
+import staging_cache as sg
+import target_tools as tt
+import pyramid_tools as pt
 import excel_tools as et
 import transforms
\ No newline at end of file
@@ -0,0 +1,344 @@
+import os
+import sys
+
+import torch
+
+# Local Imports
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import instance_masks as im
+
+#-------------------------------------------------------------------------------
+# Classes
+
+class Container(object):
+    """Base of the slotted batch containers (Batch, AggData and Matches).
+
+    The data is stored in a fixed set of slots (FIELDS) instead of a dict,
+    while keeping the dict interface (string keys, keys, items, get, update,
+    etc.) of the previous nested dicts, so that the datasets, layers, losses,
+    metrics and visualizations accept either. Only the fields that were set
+    are keys of the container.
+
+    The tensors, InstanceMasks and nested containers are moved and pinned
+    together (to, cpu, pin_memory), which is what the DataLoader's pinning
+    thread and PyTorch-Lightning's transfer_batch_to_device use.
+    """
+
+    __slots__ = ()
+    FIELDS = ()
+
+    def __init__(self, **kwargs):
+        for key, value in kwargs.items():
+            self[key] = value
+
+    #---------------------------------------------------------------------------
+    # Dict Interface
+
+    def __getitem__(self, key):
+
+        if key not in self.FIELDS:
+            raise KeyError(key)
+
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+
+        if key not in self.FIELDS:
+            raise KeyError(f'{type(self).__name__} has no field {key}')
+
+        setattr(self, key, value)
+
+    def __delitem__(self, key):
+
+        if key not in self:
+            raise KeyError(key)
+
+        delattr(self, key)
+
+    def __contains__(self, key):
+        return key in self.FIELDS and hasattr(self, key)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def keys(self):
+        return [key for key in self.FIELDS if hasattr(self, key)]
+
+    def values(self):
+        return [getattr(self, key) for key in self.keys()]
+
+    def items(self):
+        return [(key, getattr(self, key)) for key in self.keys()]
+
+    def get(self, key, default=None):
+        return getattr(self, key, default) if key in self.FIELDS else default
+
+    def update(self, data):
+        for key, value in data.items():
+            self[key] = value
+
+    def pop(self, key, *default):
+
+        if key not in self:
+            if default:
+                return default[0]
+            raise KeyError(key)
+
+        value = getattr(self, key)
+        delattr(self, key)
+
+        return value
+
+    def __repr__(self):
+
+        def describe(value):
+            if isinstance(value, torch.Tensor):
+                return f'Tensor{tuple(value.shape)}'
+            return repr(value) if isinstance(value, (Container, im.InstanceMasks)) else type(value).__name__
+
+        fields = ', '.join([f'{key}={describe(value)}' for key, value in self.items()])
+
+        return f'{type(self).__name__}({fields})'
+
+    #---------------------------------------------------------------------------
+    # Tensor Interface
+
+    def get_slots(self):
+        return [x for x in type(self).__slots__ if hasattr(self, x)]
+
+    def apply(self, function):
+        """
+        Args:
+            function (callable): applied to each torch.Tensor and InstanceMasks
+                (and recursively to the nested containers)
+        Output:
+            container (Container): a new container of the same type, the other
+                values (e.g. paths) are shared
+        """
+
+        container = type(self).__new__(type(self))
+
+        for slot in self.get_slots():
+            value = getattr(self, slot)
+            if isinstance(value, Container):
+                value = value.apply(function)
+            elif isinstance(value, (torch.Tensor, im.InstanceMasks)):
+                value = function(value)
+            setattr(container, slot, value)
+
+        return container
+
+    def to(self, *args, **kwargs):
+        return self.apply(lambda x: x.to(*args, **kwargs))
+
+    def cpu(self):
+        return self.apply(lambda x: x.cpu())
+
+    def pin_memory(self):
+        return self.apply(lambda x: x.pin_memory())
+
+class AggData(Container):
+    """Instance-lead data of a batch (ground truth or predictions), stored as
+    flat per-instance tensors with the sample id of each instance.
+
+    The CSR-style offsets (B+1) are the start of each sample's instances, they
+    are only available when the instances are ordered by sample (e.g. the
+    collated ground truth, see set_offsets), otherwise the per-sample views
+    select the instances by their sample ids.
+    """
+
+    FIELDS = (
+        'sample_ids', 'class_ids', 'symmetric_ids', 'instance_masks',
+        'quaternion', 'R', # Rotation
+        'scales', # Size
+        'xy', 'z', 'T', # Translation
+        'RT', # Transformation
+        'hypothesis', 'pruned_hypothesis', # Hough Voting
+        'xy_img' # Per image (BxCxHxW) unit vectors of the hough voting
+    )
+    __slots__ = FIELDS + ('offsets',)
+
+    # The fields that are not per-instance
+    IMAGE_FIELDS = ('xy_img',)
+
+    def __init__(self, offsets=None, **kwargs):
+        super().__init__(**kwargs)
+        self.offsets = offsets
+
+    @property
+    def num_of_instances(self):
+        return self.sample_ids.shape[0]
+
+    def set_offsets(self, num_of_samples):
+        """
+        Args:
+            num_of_samples (int): size of the batch
+        Objective:
+            Compute the offsets from the sample ids (the instances must be
+            ordered by sample)
+        """
+
+        counts = torch.bincount(self.sample_ids.long(), minlength=num_of_samples)
+        self.offsets = torch.cat([counts.new_zeros((1,)), torch.cumsum(counts, dim=0)])
+
+    def select(self, ids):
+        """
+        Args:
+            ids (torch.Tensor, slice): instances to select (indices or boolean)
+        Output:
+            agg_data (AggData): the data of the selected instances, with their
+                offsets if the container had them
+        """
+
+        agg_data = AggData()
+
+        for key, value in self.items():
+            agg_data[key] = value if key in self.IMAGE_FIELDS else value[ids]
+
+        if self.offsets is not None:
+            agg_data.set_offsets(self.offsets.shape[0] - 1)
+
+        return agg_data
+
+    def sample(self, i):
+        """
+        Args:
+            i (int): sample id within the batch
+        Output:
+            agg_data (AggData): view of the instances of the sample (slices of
+                the flat tensors when the offsets are available)
+        """
+
+        if self.offsets is not None:
+            agg_data = self.select(slice(int(self.offsets[i]), int(self.offsets[i+1])))
+        else:
+            agg_data = self.select(self.sample_ids == i)
+
+        agg_data.offsets = None
+
+        return agg_data
+
+class Batch(Container):
+    """Collated batch (see dataset.my_collate_fn) with its AggData"""
+
+    FIELDS = ('path', 'image', 'clean_image', 'mask', 'intrinsics', 'agg_data')
+    __slots__ = FIELDS
+
+    @property
+    def batch_size(self):
+        return self.image.shape[0]
+
+    def sample(self, i):
+        """
+        Args:
+            i (int): sample id within the batch
+        Output:
+            batch (Batch): view of the sample (without the batch dimension)
+        """
+
+        batch = Batch()
+
+        for key, value in self.items():
+            if key == 'agg_data':
+                batch[key] = value.sample(i)
+            else:
+                batch[key] = value[i]
+
+        return batch
+
+class Matches(Container):
+    """Matched ground truth and predicted instances (see matching.py). The
+    stacked fields are 2xN (ground truth, prediction) and the shared fields
+    (sample, class and symmetric ids) are N."""
+
+    SHARED_FIELDS = ('sample_ids', 'class_ids', 'symmetric_ids')
+    FIELDS = SHARED_FIELDS + (
+        'quaternion', 'R', # Rotation
+        'scales', # Size
+        'xy', 'z', 'T', # Translation
+        'RT', # Transformation
+        'hypothesis', 'pruned_hypothesis' # Hough Voting
+    )
+    __slots__ = FIELDS
+
+    @property
+    def num_of_matches(self):
+        return self.sample_ids.shape[0]
+
+    def select(self, ids):
+        """
+        Args:
+            ids (torch.Tensor): matches to select (indices or boolean)
+        Output:
+            matches (Matches): the selected matches
+        """
+
+        matches = Matches()
+
+        for key, value in self.items():
+            matches[key] = value[ids] if key in self.SHARED_FIELDS else value[:, ids]
+
+        return matches
+
+    def sample(self, i):
+        return self.select(self.sample_ids == i)
+
+#-------------------------------------------------------------------------------
+# Functions
+
+def test_containers():
+
+    masks = torch.zeros((3, 8, 8), dtype=torch.bool)
+    masks[0, :2, :2] = True
+    masks[1, 4:, 4:] = True
+    masks[2, 2:4, :] = True
+
+    agg_data = AggData(
+        sample_ids=torch.tensor([0, 0, 1]),
+        class_ids=torch.tensor([1., 2., 1.]),
+        xy=torch.rand((3, 2)),
+        instance_masks=im.InstanceMasks.from_dense(masks)
+    )
+    agg_data.set_offsets(2)
+
+    batch = Batch(path=['a', 'b'], image=torch.rand((2, 3, 8, 8)), agg_data=agg_data)
+
+    # Dict interface
+    assert 'xy' in agg_data and 'z' not in agg_data and agg_data.get('z') is None
+    assert batch.keys() == ['path', 'image', 'agg_data']
+    agg_data.update({'z': torch.rand((3, 1))})
+
+    # Per-sample views
+    sample = batch.sample(1)
+    assert sample['path'] == 'b' and sample['image'].shape == (3, 8, 8)
+    assert torch.equal(sample['agg_data']['instance_masks'].to_dense(), masks[2:])
+    assert torch.equal(agg_data.select(agg_data['class_ids'] == 1)['xy'], agg_data['xy'][[0, 2]])
+
+    # Moving and pinning
+    moved_batch = batch.to('cpu', non_blocking=True)
+    assert isinstance(moved_batch['agg_data'], AggData) and torch.equal(moved_batch['agg_data'].offsets, agg_data.offsets)
+
+    if torch.cuda.is_available():
+        assert batch.pin_memory()['image'].is_pinned()
+
+    # Slots only
+    try:
+        batch['unknown'] = 0
+        assert False
+    except KeyError:
+        pass
+
+    print(batch)
+
+#-------------------------------------------------------------------------------
+# Main Code
+
+if __name__ == '__main__':
+    test_containers()
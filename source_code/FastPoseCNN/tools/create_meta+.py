@@ -1,6 +1,13 @@
 import os
 import sys
+import time
+import hashlib
 import pathlib
+import argparse
+import collections
+import contextlib
+import multiprocessing
+import traceback
 import tqdm
 import pdb
 
@@ -33,6 +40,14 @@ import draw as dr
 DEBUG = False
 FAULTY_IMAGES = []
 
+# Journal of the completed color images (relative to the DATASET_DIR), the
+# journal of an overwrite run starts with the OVERWRITE_HEADER
+JOURNAL_FILENAME = '.create_meta+_journal.txt'
+OVERWRITE_HEADER = '# overwrite'
+
+# Accumulated time per stage of the current image (see timed_stage)
+STAGE_TIMES = collections.Counter()
+
 # Obtaining information paths
 DATASET_NAME = 'real'
 SUBSET_DATASET_NAME = 'test'
@@ -40,6 +55,13 @@ SUBSET_DATASET_NAME = 'test'
 DATASET_DIR = root.parents[1] / 'datasets' / 'NOCS' / DATASET_NAME / SUBSET_DATASET_NAME
 OBJ_MODEL_DIR = root.parents[1] / 'networks' / 'NOCS_CVPR2019' / 'data' / 'obj_models' / DATASET_NAME / SUBSET_DATASET_NAME
 
+# Content-addressed cache of the nocs_utils.align results (shared by all the
+# datasets, since the key includes all the inputs of the alignment)
+ALIGN_CACHE_DIR = root.parents[1] / 'datasets' / 'NOCS' / '.align_cache'
+ALIGN_CACHE_MAX_BYTES = 1 * 1024**3
+ALIGN_CACHE_EVICT_INTERVAL = 256
+ALIGN_CACHE_INSERTIONS = 0
+
 #-------------------------------------------------------------------------------
 # Small Helper Functions
 
@@ -49,6 +71,128 @@ def disable_print():
 def enable_print():
     sys.stdout = sys.__stdout__
 
+@contextlib.contextmanager
+def timed_stage(stage_name):
+    tic = time.time()
+    yield
+    STAGE_TIMES[stage_name] += time.time() - tic
+
+def atomic_save(save_function, file_path, data):
+
+    # Writing into a temporary file (same suffix) and then renaming it, so that
+    # interrupted runs never leave partially written files
+    tmp_path = file_path.with_name(file_path.stem + f'.{os.getpid()}.tmp' + file_path.suffix)
+    save_function(tmp_path, data)
+    os.replace(tmp_path, file_path)
+
+#-------------------------------------------------------------------------------
+# Alignment Cache
+
+def get_align_cache_key(*arrays):
+    """
+    Args:
+        arrays (np.ndarrays): inputs of the alignment (class_ids, masks, coords,
+            depth and intrinsics)
+    Output:
+        key (str): sha1 of the contents, shapes and dtypes of the arrays
+    """
+
+    hasher = hashlib.sha1()
+
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        hasher.update(f'{array.dtype.str}{array.shape}'.encode())
+        hasher.update(array.tobytes())
+
+    return hasher.hexdigest()
+
+def evict_align_cache(cache_dir=None, max_bytes=None):
+    """
+    Args:
+        cache_dir (pathlib object): directory of the cache
+        max_bytes (int): size cap of the cache
+    Objective:
+        Remove the least recently used entries (oldest mtime, which is updated
+        on every hit) until the cache fits in max_bytes. Entries removed by
+        other workers in the meantime are ignored.
+    """
+
+    cache_dir = ALIGN_CACHE_DIR if cache_dir is None else cache_dir
+    max_bytes = ALIGN_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+
+    if cache_dir.exists() is False:
+        return None
+
+    entries = []
+    for entry_path in cache_dir.glob('*/*.npy'):
+        try:
+            stat = entry_path.stat()
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, entry_path))
+
+    total_bytes = sum([x[1] for x in entries])
+
+    for _, size, path in sorted(entries):
+
+        if total_bytes <= max_bytes:
+            break
+
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+        total_bytes -= size
+
+    return None
+
+def cached_align(class_ids, masks, coords, depth_image, intrinsics, class_names):
+    """
+    Args:
+        same as nocs_utils.align
+    Objective:
+        Wrapper of nocs_utils.align that stores the RTs in the ALIGN_CACHE_DIR,
+        keyed by the hash of its inputs. The entries are written atomically, so
+        the cache can be shared by the parallel workers.
+    Output:
+        RTs (np.ndarray): Nx4x4 transformation matrices
+    """
+
+    key = get_align_cache_key(class_ids, masks, coords, depth_image, intrinsics)
+    entry_path = ALIGN_CACHE_DIR / key[:2] / f'{key}.npy'
+
+    # Cache hit (updating the mtime to keep track of the recently used entries)
+    try:
+        with timed_stage('align (cached)'):
+            RTs = np.load(str(entry_path))
+            os.utime(entry_path)
+        return RTs
+    except (FileNotFoundError, ValueError, OSError):
+        pass
+
+    # Cache miss
+    disable_print()
+
+    with timed_stage('align'):
+        RTs, _, _, _ = nocs_utils.align(class_ids, masks, coords, depth_image, intrinsics,
+                                        class_names, ".", None)
+
+    enable_print()
+
+    RTs = np.asarray(RTs, dtype=np.float64)
+
+    entry_path.parent.mkdir(parents=True, exist_ok=True)
+    atomic_save(lambda path, data: np.save(str(path), data), entry_path, RTs)
+
+    # Checking the size of the cache every few insertions (per process)
+    global ALIGN_CACHE_INSERTIONS
+    ALIGN_CACHE_INSERTIONS += 1
+    if ALIGN_CACHE_INSERTIONS % ALIGN_CACHE_EVICT_INTERVAL == 0:
+        evict_align_cache()
+
+    return RTs
+
 def get_image_paths_in_dir(dir_path, max_size=None):
     """
     Args:
@@ -218,27 +362,9 @@ def get_camera_original_information(color_image):
     bboxes = dm.extract_2d_bboxes_from_masks(masks)
     scores = [100 for j in range(len(class_ids))]
 
-    # RT pickled
-    RT_json_path = pathlib.Path.cwd() / f'RT_{data_id}.json'
-
-    # now obtaining the rotation and translation
-    if RT_json_path.exists():
-        data = jt.load_from_json(RT_json_path)
-        RTs = data['RTs']
-        
-    else:
-
-        # Disable print
-        disable_print()
-
-        RTs, _, _, _ = nocs_utils.align(class_ids, masks, coords, depth_image, pj.constants.INTRINSICS['CAMERA'],
-                                        pj.constants.CAMERA_CLASSES, ".", None)
-
-        # Enable print
-        enable_print()
-
-        data = {'RTs': RTs}
-        #jt.save_to_json(RT_json_path, data)
+    # now obtaining the rotation and translation (cached by content)
+    RTs = cached_align(class_ids, masks, coords, depth_image, pj.constants.INTRINSICS['CAMERA'],
+                       pj.constants.CAMERA_CLASSES)
 
     return class_ids, bboxes, masks, coords, RTs, scores, scales, instance_dict
 
@@ -356,27 +482,9 @@ def get_real_original_information(color_path):
     bboxes = dm.extract_2d_bboxes_from_masks(masks)
     scores = [100 for j in range(len(class_ids))]
 
-    # RT pickled
-    RT_json_path = pathlib.Path.cwd() / f'RT_{data_id}.json'
-
-    # now obtaining the rotation and translation
-    if RT_json_path.exists():
-        data = jt.load_from_json(RT_json_path)
-        RTs = data['RTs']
-        
-    else:
-
-        # Disable print
-        disable_print()
-
-        RTs, _, _, _ = nocs_utils.align(class_ids, masks, coords, depth_image, pj.constants.INTRINSICS['REAL'],
-                                        pj.constants.REAL_CLASSES, ".", None)
-
-        # Enable print
-        enable_print()
-
-        data = {'RTs': RTs}
-        #jt.save_to_json(RT_json_path, data)
+    # now obtaining the rotation and translation (cached by content)
+    RTs = cached_align(class_ids, masks, coords, depth_image, pj.constants.INTRINSICS['REAL'],
+                       pj.constants.REAL_CLASSES)
 
     return class_ids, bboxes, masks, coords, RTs, scores, scales, instance_dict
 
@@ -605,22 +713,25 @@ def manual_data_handling():
 #-------------------------------------------------------------------------------
 # Generating Modified Dataset
 
-def create_new_dataset():
-
-    all_color_img_paths = get_image_paths_in_dir(DATASET_DIR, max_size=None)
+def process_color_image(color_path):
+    """
+    Args:
+        color_path (pathlib object): color image of the sample
+    Objective:
+        Generate and save the meta+ data (json and binary) of a single sample
+    Output:
+        result (dict): color_path, stage times and the error (if failed)
+    """
 
-    print(f'dataset size: {len(all_color_img_paths)}')
+    STAGE_TIMES.clear()
 
-    for color_path in tqdm.tqdm(all_color_img_paths, bar_format='{l_bar}{bar:40}{r_bar}{bar:-10b}'):
+    try:
 
-        #disable_print()
         data_id = color_path.name.replace('_color.png', '')
         new_meta_filepath = color_path.parent / f'{data_id}_meta+.json'
 
-        if new_meta_filepath.exists():
-            continue
-
-        # Obtain the ground truth data for the image
+        # Obtain the ground truth data for the image (load + align)
+        tic = time.time()
         if DATASET_NAME == 'camera':
             class_ids, bboxes, masks, coords, RTs, scores, scales, instance_dict = get_camera_original_information(color_path)
             intrinsics = pj.constants.INTRINSICS['CAMERA']
@@ -629,6 +740,7 @@ def create_new_dataset():
             intrinsics = pj.constants.INTRINSICS['REAL']
         else:
             raise NotImplementedError("Invalid dataset_type parameter value")
+        STAGE_TIMES['load'] += time.time() - tic - STAGE_TIMES['align'] - STAGE_TIMES['align (cached)']
 
         new_RTs = []
         old_RTs = []
@@ -638,49 +750,49 @@ def create_new_dataset():
         translation_vectors = []
 
         # Convert RT into quaternion
-        for i, RT in enumerate(RTs):
-
-            # Making RT match the following scheme
-            """
-            CAMERA SPACE --- inverse RT ---> WORLD SPACE
-            WORLD SPACE  ---     RT     ---> CAMERA SPACE
-            """
-            RT = np.linalg.inv(RT)
-
-            # Obtaining the 3D objects that will be drawn
-            xyz_axis = 0.3*np.array([[0, 0, 0], [0, 0, 1], [0, 1, 0], [1, 0, 0]]).transpose()
-            bbox_3d = dm.get_3d_bbox(scales[i,:],0)
-
-            perfect_projected_axes = dm.transform_3d_camera_coords_to_2d_quantized_projections(xyz_axis, RT, intrinsics)
-
-            # Converting transformation matrix into quaterion with translation vector
-            quaternion, translation_vector, normalizing_factor = dm.RT_2_quat(RT.copy(), normalize=True)
-            
-            # Need to fix the translation vector, to account for the orthogonalization of the rotation matrix
-            new_RT = dm.quat_2_RT_given_T_in_camera(quaternion, translation_vector)
-
-            # Method 1 (low accuracy)
-            #new_RT = dm.fix_quaternion_T(pj.constants.INTRINSICS, RT, new_RT, normalizing_factor)
-            
-            # Method 2 (high accuracy)
-            projected_origin = perfect_projected_axes[0,:].reshape((-1, 1))
-            #origin_z = (np.linalg.inv(new_RT)[2, 3] * 1000)
-            origin_z = (np.linalg.inv(new_RT)[2, 3] * 1000)
-
-
-            new_translation_vector = dm.create_translation_vector(projected_origin, origin_z, intrinsics)
-            new_RT = dm.quat_2_RT_given_T_in_world(quaternion, new_translation_vector)
-
-            # Need to fix the rotation matrix, to account for the small error introducted by the orthogonalization of the rotation matrix
-            #new_RT = dm.fix_quat_RT_matrix(pj.constants.INTRINSICS, RT, new_RT, pts=bbox_3d)
-
-            # Saving parameters
-            old_RTs.append(RT)
-            new_RTs.append(new_RT)
-            quaternions.append(quaternion)
-            translation_vectors.append(new_translation_vector)
-            normalizing_factors.append(normalizing_factor)
-            norm_scales[i,:] = scales[i,:] / normalizing_factor
+        with timed_stage('convert'):
+            for i, RT in enumerate(RTs):
+
+                # Making RT match the following scheme
+                """
+                CAMERA SPACE --- inverse RT ---> WORLD SPACE
+                WORLD SPACE  ---     RT     ---> CAMERA SPACE
+                """
+                RT = np.linalg.inv(RT)
+
+                # Obtaining the 3D objects that will be drawn
+                xyz_axis = 0.3*np.array([[0, 0, 0], [0, 0, 1], [0, 1, 0], [1, 0, 0]]).transpose()
+                bbox_3d = dm.get_3d_bbox(scales[i,:],0)
+
+                perfect_projected_axes = dm.transform_3d_camera_coords_to_2d_quantized_projections(xyz_axis, RT, intrinsics)
+
+                # Converting transformation matrix into quaterion with translation vector
+                quaternion, translation_vector, normalizing_factor = dm.RT_2_quat(RT.copy(), normalize=True)
+                
+                # Need to fix the translation vector, to account for the orthogonalization of the rotation matrix
+                new_RT = dm.quat_2_RT_given_T_in_camera(quaternion, translation_vector)
+
+                # Method 1 (low accuracy)
+                #new_RT = dm.fix_quaternion_T(pj.constants.INTRINSICS, RT, new_RT, normalizing_factor)
+                
+                # Method 2 (high accuracy)
+                projected_origin = perfect_projected_axes[0,:].reshape((-1, 1))
+                #origin_z = (np.linalg.inv(new_RT)[2, 3] * 1000)
+                origin_z = (np.linalg.inv(new_RT)[2, 3] * 1000)
+
+                new_translation_vector = dm.create_translation_vector(projected_origin, origin_z, intrinsics)
+                new_RT = dm.quat_2_RT_given_T_in_world(quaternion, new_translation_vector)
+
+                # Need to fix the rotation matrix, to account for the small error introducted by the orthogonalization of the rotation matrix
+                #new_RT = dm.fix_quat_RT_matrix(pj.constants.INTRINSICS, RT, new_RT, pts=bbox_3d)
+
+                # Saving parameters
+                old_RTs.append(RT)
+                new_RTs.append(new_RT)
+                quaternions.append(quaternion)
+                translation_vectors.append(new_translation_vector)
+                normalizing_factors.append(normalizing_factor)
+                norm_scales[i,:] = scales[i,:] / normalizing_factor
         
         """
         # Checking output
@@ -694,15 +806,113 @@ def create_new_dataset():
         #output = dr.draw_quat_detections(image, intrinsics, quaternions, translation_vectors, norm_scales)
         
         plt.imshow(output); plt.show()
-        continue
         """
         
-        # Saving output into a meta+.json
-        data = {'instance_dict': instance_dict, 'scales': scales, 'RTs': new_RTs, 'norm_factors': normalizing_factors, 'quaternions': quaternions}
-        jt.save_to_json(new_meta_filepath, data)
+        # Saving output into a meta+.bin and a meta+.json (the json last, as it
+        # marks the sample as complete for the previous versions of this script)
+        with timed_stage('save'):
+            data = {'instance_dict': instance_dict, 'scales': scales, 'RTs': new_RTs, 'norm_factors': normalizing_factors, 'quaternions': quaternions}
+            atomic_save(jt.save_to_meta_bin, new_meta_filepath.with_suffix('.bin'), data)
+            atomic_save(jt.save_to_json, new_meta_filepath, data)
+
+        error = None
+
+    except Exception:
+        error = traceback.format_exc()
 
+    finally:
         enable_print()
 
+    return {'color_path': color_path, 'stage_times': dict(STAGE_TIMES), 'error': error}
+
+def create_new_dataset(num_of_workers=0, chunk_size=16, overwrite=False, restart=False):
+    """
+    Args:
+        num_of_workers (int): number of processes (0 = run in this process)
+        chunk_size (int): number of images given to a worker at a time
+        overwrite (bool): regenerate all the existing meta+ data (e.g. after
+            a change in the scale normalization), starts a fresh journal
+        restart (bool): ignore (and clear) the journal of previous runs
+    Objective:
+        Generate the meta+ data of the DATASET_DIR. Each completed image is
+        appended to the journal, so an interrupted run resumes exactly where
+        it stopped (an interrupted overwrite run is resumed without
+        overwrite).
+    """
+
+    all_color_img_paths = get_image_paths_in_dir(DATASET_DIR, max_size=None)
+
+    print(f'dataset size: {len(all_color_img_paths)}')
+
+    # Loading the journal of the completed images
+    journal_path = DATASET_DIR / JOURNAL_FILENAME
+    if (restart or overwrite) and journal_path.exists():
+        journal_path.unlink()
+
+    if overwrite:
+        with open(journal_path, 'w') as journal:
+            journal.write(f'{OVERWRITE_HEADER}\n')
+
+    completed = set()
+    if journal_path.exists():
+        with open(journal_path, 'r') as f:
+            lines = [line.strip() for line in f if line.strip()]
+
+        # Resuming an overwrite run: the existing meta+ data not yet
+        # journaled is regenerated too
+        if lines and lines[0] == OVERWRITE_HEADER:
+            overwrite = True
+
+        completed = set(line for line in lines if not line.startswith('#'))
+
+    # Selecting the remaining images
+    remaining_color_img_paths = []
+    for color_path in all_color_img_paths:
+        if str(color_path.relative_to(DATASET_DIR)) in completed:
+            continue
+        if not overwrite and pathlib.Path(str(color_path).replace('_color.png', '_meta+.json')).exists():
+            continue
+        remaining_color_img_paths.append(color_path)
+
+    print(f'remaining: {len(remaining_color_img_paths)}')
+
+    # Accumulated stage times
+    total_stage_times = collections.Counter()
+    num_of_completed = 0
+    tic = time.time()
+
+    with open(journal_path, 'a') as journal, contextlib.ExitStack() as stack:
+
+        # Process pool (or serial) execution
+        if num_of_workers > 0:
+            pool = stack.enter_context(multiprocessing.Pool(num_of_workers))
+            results = pool.imap_unordered(process_color_image, remaining_color_img_paths, chunksize=chunk_size)
+        else:
+            results = map(process_color_image, remaining_color_img_paths)
+
+        for result in tqdm.tqdm(results, total=len(remaining_color_img_paths), bar_format='{l_bar}{bar:40}{r_bar}{bar:-10b}'):
+
+            # Failed images are not journaled, they are retried in the next run
+            if result['error'] is not None:
+                FAULTY_IMAGES.append(result['color_path'])
+                tqdm.tqdm.write(f"FAILED: {result['color_path']}\n{result['error']}")
+                continue
+
+            journal.write(f"{result['color_path'].relative_to(DATASET_DIR)}\n")
+            journal.flush()
+
+            total_stage_times.update(result['stage_times'])
+            num_of_completed += 1
+
+    # Enforcing the size cap of the alignment cache
+    evict_align_cache()
+
+    # Reporting the throughput
+    toc = time.time()
+    print(f'completed: {num_of_completed}, failed: {len(FAULTY_IMAGES)}, time: {toc-tic:.1f} s ({num_of_completed/max(toc-tic, 1e-6):.2f} images/s)')
+    for stage_name, stage_time in total_stage_times.items():
+        print(f'    {stage_name}: {stage_time/max(num_of_completed,1)*1000:.1f} ms/image (worker time), {num_of_completed/max(stage_time, 1e-6):.2f} images/s per worker')
+
     return None
 
 #-------------------------------------------------------------------------------
@@ -857,7 +1067,31 @@ def load_new_dataset(dataset_path, obj_model_dir):
 
 if __name__ == '__main__':
 
+    parser = argparse.ArgumentParser(description='Generate the meta+ data of a NOCS dataset')
+    parser.add_argument('--DATASET_NAME', type=str, default=DATASET_NAME, choices=['camera', 'real'])
+    parser.add_argument('--SUBSET_DATASET_NAME', type=str, default=SUBSET_DATASET_NAME)
+    parser.add_argument('--NUM_WORKERS', type=int, default=0)
+    parser.add_argument('--CHUNK_SIZE', type=int, default=16)
+    parser.add_argument('--OVERWRITE', action='store_true')
+    parser.add_argument('--RESTART', action='store_true')
+    parser.add_argument('--ALIGN_CACHE_DIR', type=str, default=str(ALIGN_CACHE_DIR))
+    parser.add_argument('--ALIGN_CACHE_SIZE_GB', type=float, default=ALIGN_CACHE_MAX_BYTES / 1024**3)
+    args = parser.parse_args()
+
+    # Updating the dataset paths (inherited by the worker processes)
+    DATASET_NAME = args.DATASET_NAME
+    SUBSET_DATASET_NAME = args.SUBSET_DATASET_NAME
+    DATASET_DIR = root.parents[1] / 'datasets' / 'NOCS' / DATASET_NAME / SUBSET_DATASET_NAME
+    OBJ_MODEL_DIR = root.parents[1] / 'networks' / 'NOCS_CVPR2019' / 'data' / 'obj_models' / DATASET_NAME / SUBSET_DATASET_NAME
+    ALIGN_CACHE_DIR = pathlib.Path(args.ALIGN_CACHE_DIR)
+    ALIGN_CACHE_MAX_BYTES = int(args.ALIGN_CACHE_SIZE_GB * 1024**3)
+
     # Create new dataset 
-    create_new_dataset()
+    create_new_dataset(
+        num_of_workers=args.NUM_WORKERS,
+        chunk_size=args.CHUNK_SIZE,
+        overwrite=args.OVERWRITE,
+        restart=args.RESTART
+    )
 
 
@@ -1,11 +1,17 @@
 import os
 import sys
+import json
 import shutil
 import pathlib
 import collections
 from typing import List, Union
 import abc
 import pprint
+import time
+import math
+import queue
+import threading
+import concurrent.futures
 import tqdm
 
 import pdb
@@ -42,6 +48,15 @@ root = next(path for path in pathlib.Path(os.path.abspath(__file__)).parents if
 sys.path.append(str(pathlib.Path(__file__).parent))
 
 import json_tools as jt
+import shard_tools as st
+import manifest_tools as mt
+import instance_masks as im
+import containers as ct
+import sample_cache as sc
+import readahead as ra
+import staging_cache as sg
+import target_tools as tt
+import pyramid_tools as pt
 import data_manipulation as dm
 import project as pj
 import draw as dr
@@ -63,6 +78,63 @@ def seed_worker(worker_id):
     np.random.seed(worker_seed)
     random.seed(worker_seed)
 
+def get_distributed_split():
+    """
+    Output:
+        rank (int): rank of this process (0 if not distributed)
+        world_size (int): number of processes (1 if not distributed)
+    """
+
+    if torch.distributed.is_available() and torch.distributed.is_initialized():
+        return torch.distributed.get_rank(), torch.distributed.get_world_size()
+
+    return 0, 1
+
+def create_remap_lut(instance_dict, class_values_map=None):
+    """
+    Args:
+        instance_dict (dict): {instance id: class id} of the meta+ data
+        class_values_map (dict): {class id: selected class id}, None keeps all
+            the classes
+    Objective:
+        Create a 256-entry lookup table for uint8 masks. Any value not in the
+        instance_dict (background = 255, distraction objects) or that belongs
+        to an unwanted class is mapped to 0.
+    Output:
+        lut (np.ndarray): 3x256 uint8 table, rows: instance id, class id and
+            instance number (1-N, in the order of the kept instances)
+        good_instance_dict (dict): {instance id (int): selected class id}
+    """
+
+    lut = np.zeros((3, 256), dtype=np.uint8)
+    good_instance_dict = {}
+
+    for id_value, class_id in instance_dict.items():
+
+        # If the class is not in the wanted class values, skip it
+        if class_values_map is not None and class_id not in class_values_map.keys():
+            continue
+
+        selected_class_id = class_id if class_values_map is None else class_values_map[class_id]
+        good_instance_dict[int(id_value)] = selected_class_id
+        lut[:, int(id_value)] = [int(id_value), selected_class_id, len(good_instance_dict)]
+
+    return lut, good_instance_dict
+
+def remap_mask(mask, lut):
+    """
+    Args:
+        mask (np.ndarray): HxW uint8 mask
+        lut (np.ndarray): 3x256 uint8 table (see create_remap_lut)
+    Output:
+        instances_mask, class_mask, instance_numbers (np.ndarray): HxW uint8
+    """
+
+    # Single indexed pass over the mask for all the rows of the table
+    remapped = lut[:, mask]
+
+    return remapped[0], remapped[1], remapped[2]
+
 #-------------------------------------------------------------------------------
 # Custom Abstract Dataset
 
@@ -105,7 +177,34 @@ class NOCSDataset(Dataset, torch.utils.data.Dataset):
             (e.g. flip, scale, etc.)
         preprocessing (albumentations.Compose): data preprocessing 
             (e.g. noralization, shape manipulation, etc.)
+        subset_strategy (str): how max_size samples are selected ('ordered',
+            'random' or 'stratified', see manifest_tools.select_samples)
+        subset_seed (int): seed of the random and stratified subsets
+        exclude_invalid (bool): never schedule the samples that were marked as
+            invalid (z <= 0) when the manifest or the shards were indexed
+        resolution_scale (float): resolution of the (pre-downsampled) split,
+            the intrinsics are scaled accordingly (see pyramid_tools.py)
     """
+
+    # Optional cache of the decoded samples (see set_sample_cache)
+    sample_cache = None
+
+    # Optional precomputed targets (see target_tools.py)
+    target_store_dir = None
+    target_store = None
+
+    # Optional device-side normalization (see set_image_normalization)
+    image_normalization = None
+
+    # Optional readahead of the raw files (see set_readahead)
+    readahead = None
+
+    # Optional local copies of the files (see set_staging_cache)
+    staging_cache = None
+
+    # Optional object-centric crops (see set_crop)
+    crop_size = 0
+    context_margin = 0.25
     
     def __init__(
         self,
@@ -113,30 +212,224 @@ class NOCSDataset(Dataset, torch.utils.data.Dataset):
         max_size: Union[int, None] = None,
         classes: Union[List, None] = None,
         augmentation: Union[albu.Compose, None] = None,
-        preprocessing: Union[albu.Compose, None] = None
+        preprocessing: Union[albu.Compose, None] = None,
+        subset_strategy: str = 'ordered',
+        subset_seed: int = 0,
+        exclude_invalid: bool = True,
+        resolution_scale: float = 1.0
         ):
 
         # ! Debugging
         self.counter = 0
 
-        # If None or just all the classes, no nead of class values map
-        if classes is None:
-            self.classes = self.CLASSES
-        
-        # then create class values map
-        self.classes = classes
-        self.class_values_map = {self.CLASSES.index(cls.lower()):self.classes.index(cls) for cls in self.classes}
-        self.symmetric_classes = [self.classes.index(cls.lower()) for cls in self.SYMMETRIC_CLASSES if cls in self.classes]
+        # Creating the class values map and symmetric classes
+        self.set_classes(classes)
+
+        # Scaling the intrinsics to the resolution of the split
+        self.set_resolution_scale(resolution_scale)
+
+        # Subset selection parameters
+        self.subset_strategy = subset_strategy
+        self.subset_seed = subset_seed
+        self.exclude_invalid = exclude_invalid
 
         # Obtaining the filepaths for the images
+        self.dataset_dir = pathlib.Path(dataset_dir)
         self.images_fps = self.get_image_paths_in_dir(dataset_dir, max_size=max_size)
 
+        # Locating the samples in the precomputed target store (if available),
+        # the store is memory-mapped lazily by each worker
+        target_index = tt.load_target_index(self.dataset_dir, self.INTRINSICS)
+        if target_index is not None:
+            self.target_store_dir, rows = target_index
+            self.target_rows = np.array([rows.get(str(x), -1) for x in self.images_fps], dtype=np.int64)
+
         # Saving parameters
         self.augmentation = augmentation
         self.preprocessing = preprocessing
 
+    def set_resolution_scale(self, resolution_scale):
+
+        # The class intrinsics are the full resolution ones
+        self.resolution_scale = resolution_scale
+        self.INTRINSICS = pt.scale_intrinsics(type(self).INTRINSICS, resolution_scale)
+
+    def set_classes(self, classes):
+
+        # If None or just all the classes, no nead of class values map
+        if classes is None:
+            classes = self.CLASSES
+
+        # then create class values map
+        self.classes = classes
+        self.class_values_map = {self.CLASSES.index(cls.lower()):self.classes.index(cls) for cls in self.classes}
+        self.symmetric_classes = [self.classes.index(cls.lower()) for cls in self.SYMMETRIC_CLASSES if cls in self.classes]
+
     def __getitem__(self, i):
 
+        # Reading the decoded data from the cache shared by the workers
+        if self.sample_cache is not None:
+            cached_data = self.sample_cache.get(i)
+            if cached_data is not None:
+                return self.create_sample(i, **cached_data)
+
+        # Reading the raw data (image, mask and meta+ data)
+        image, mask, json_data = self.load_raw_sample(i)
+
+        # Converting the raw data into a training sample
+        if self.sample_cache is None:
+            return self.process_raw_sample(i, image, mask, json_data)
+
+        targets = self.create_targets(i, mask, json_data)
+        
+        if targets is None:
+            return None
+
+        class_mask, agg_data = targets
+        self.sample_cache.put(i, {'image': image, 'class_mask': class_mask, 'agg_data': agg_data})
+
+        return self.create_sample(i, image, class_mask, agg_data)
+
+    def set_sample_cache(self, sample_cache):
+        """
+        Args:
+            sample_cache (sample_cache.SharedSampleCache): cache of the decoded
+                images, class masks and agg_data (None to disable it)
+        """
+        self.sample_cache = sample_cache
+
+    def set_crop(self, crop_size, context_margin=0.25):
+        """
+        Args:
+            crop_size (int): size of the square crops around a random instance
+                of each sample (0 to use the full images), the samples carry
+                the intrinsics of their crop
+            context_margin (float): context around the instance's bounding box
+                (fraction of its size) kept within the crop when possible
+        """
+        self.crop_size = crop_size
+        self.context_margin = context_margin
+
+    def set_staging_cache(self, staging_cache):
+        """
+        Args:
+            staging_cache (staging_cache.StagingCache): local copies of the
+                dataset files (None to read the original files)
+        """
+        self.staging_cache = staging_cache
+
+    def resolve_path(self, path):
+
+        if self.staging_cache is None:
+            return pathlib.Path(path)
+
+        return self.staging_cache.resolve(path)
+
+    def get_meta_plus_path(self, i):
+        """
+        Output:
+            meta_plus_path (pathlib object): the (staged) meta+ file of the 
+                sample, see json_tools.get_meta_plus_path
+        """
+
+        # The staged meta+ files are found without accessing the source
+        if self.staging_cache is not None:
+            for suffix in ['_meta+.bin', '_meta+.json']:
+                source_path = str(self.images_fps[i]).replace('_color.png', suffix)
+                staged_path = self.staging_cache.get_staged_path(source_path)
+                if staged_path is not None and self.staging_cache.is_valid(staged_path, source_path):
+                    return staged_path
+
+        meta_plus_path = jt.get_meta_plus_path(self.images_fps[i])
+
+        return None if meta_plus_path is None else self.resolve_path(meta_plus_path)
+
+    def set_readahead(self, readahead):
+        """
+        Args:
+            readahead (readahead.SampleReadahead): readahead of the raw files 
+                of the upcoming samples (None to read them on demand), the
+                loader needs its readahead.ReadaheadSampler
+        """
+        self.readahead = readahead
+
+    def get_record_paths(self, i):
+        """
+        Args:
+            i (int): sample index
+        Output:
+            record_paths (dict): the files of the sample (the meta+ file is not
+                needed with the precomputed targets)
+        """
+
+        color_path = self.images_fps[i]
+        record_paths = {
+            'color.png': self.resolve_path(color_path),
+            'mask.png': self.resolve_path(str(color_path).replace('_color.png', '_mask.png'))
+        }
+
+        if self.target_store_dir is None or self.target_rows[i] < 0:
+            meta_plus_path = self.get_meta_plus_path(i)
+            if meta_plus_path is not None:
+                record_paths[f'meta{meta_plus_path.suffix}'] = meta_plus_path
+
+        return record_paths
+
+    def decode_record(self, record):
+        """
+        Args:
+            record (dict): the bytes of the sample's files ('color.png', 
+                'mask.png' and 'meta.bin' or 'meta.json')
+        Output:
+            image (np.ndarray): HxWx3 uint8 color image
+            mask (np.ndarray): HxW uint8 instance mask (255 = background)
+            json_data (dict): the sample's meta+ data (None if not in the record)
+        """
+
+        image = cv2.imdecode(np.frombuffer(record['color.png'], dtype=np.uint8), cv2.IMREAD_COLOR)
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+        # CAMERA masks have 3 (equal) channels, the first one (RGB) is used
+        mask = cv2.imdecode(np.frombuffer(record['mask.png'], dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+        if mask.ndim == 3:
+            mask = mask[:,:,2]
+
+        if 'meta.bin' in record:
+            json_data = jt.decode_meta_bin(record['meta.bin'])
+        elif 'meta.json' in record:
+            json_data = json.loads(record['meta.json'])
+        else:
+            json_data = None
+
+        return image, mask, json_data
+
+    def set_image_normalization(self, image_normalization):
+        """
+        Args:
+            image_normalization (transforms.pose.ImageNormalization): when 
+                given, the samples' images are kept as HxWx3 uint8 (no 
+                preprocessing) and are normalized in batch by the module
+                (see normalize_batch), None to preprocess each sample
+        """
+        self.image_normalization = image_normalization
+
+    def normalize_batch(self, batch):
+        
+        if self.image_normalization is None:
+            return batch
+
+        return transforms.pose.normalize_batch(batch, self.image_normalization)
+
+    def load_raw_sample(self, i):
+        """
+        Args:
+            i (int): sample index
+        Output:
+            image (np.ndarray): HxWx3 uint8 color image
+            mask (np.ndarray): HxW uint8 instance mask (255 = background)
+            json_data (dict): the sample's meta+ data
+        """
+
         # DEBUGGING
         """
         if self.counter == 0:
@@ -153,22 +446,30 @@ class NOCSDataset(Dataset, torch.utils.data.Dataset):
 
         #LOGGER.debug(f"LOADING IMAGE: {str(self.images_fps[i])}")
 
+        # Decoding the files from memory (read ahead by the worker's threads)
+        if self.readahead is not None:
+            
+            image, mask, meta_data = self.decode_record(self.readahead.get(i, self.get_record_paths))
+
+            json_data = self.load_sample_targets(i)
+            if json_data is None:
+                json_data = meta_data if meta_data is not None else self.load_meta_plus(i)
+
+            return image, mask, json_data
+
         # Reading data
         # Image
-        image = skimage.io.imread(str(self.images_fps[i]))
+        image = skimage.io.imread(str(self.resolve_path(self.images_fps[i])))
 
         # Mask
-        mask_fp = str(self.images_fps[i]).replace('_color.png', '_mask.png')
-        
+        mask_fp = str(self.resolve_path(str(self.images_fps[i]).replace('_color.png', '_mask.png')))
+
         if isinstance(self, CAMERADataset):
-            mask = skimage.io.imread(mask_fp, 0)[:,:,0].astype('float')
+            mask = skimage.io.imread(mask_fp, 0)[:,:,0]
         elif isinstance(self, REALDataset):
-            mask = skimage.io.imread(mask_fp, 0).astype('float')
+            mask = skimage.io.imread(mask_fp, 0)
         else:
             raise NotImplementedError("Invalid dataset type")
-        
-        # Change the background from 255 to 0
-        mask[mask == 255] = 0
 
         # Depth
         """
@@ -177,28 +478,147 @@ class NOCSDataset(Dataset, torch.utils.data.Dataset):
         depth = dm.standardize_depth(depth)
         """
 
-        # Other data
-        json_fp = str(self.images_fps[i]).replace('_color.png', '_meta+.json')
-        json_data = jt.load_from_json(json_fp)
+        # Other data (precomputed targets if available, else binary meta+ or json)
+        json_data = self.load_sample_targets(i)
+        if json_data is None:
+            json_data = self.load_meta_plus(i)
 
-        # Removing distraction objects
-        instances_mask = np.zeros_like(mask)
-        for instance_id in json_data['instance_dict'].keys():
-            instances_mask[mask == int(instance_id)] = int(instance_id)
+        return image, mask, json_data
 
-        # Removing unwanted classes
-        good_json_data = {'instance_dict': {}}
-        good_instances_mask = np.zeros_like(instances_mask)
+    def load_meta_plus(self, i):
 
-        # Iterating through all json data and keeping only data that is the selected class
-        for enumerate_id, (id_value, class_id) in enumerate(json_data['instance_dict'].items()):
+        meta_plus_path = self.get_meta_plus_path(i)
 
-            # If the class is in the wanted class values, then keep it
-            if class_id in self.class_values_map.keys():
-                good_instances_mask[instances_mask == int(id_value)] = int(id_value)
+        if meta_plus_path is None:
+            raise FileNotFoundError(f'No meta+ data for {self.images_fps[i]}')
+
+        return jt.load_meta_plus_file(meta_plus_path)
+
+    def load_sample_targets(self, i):
+        """
+        Args:
+            i (int): sample index
+        Output:
+            json_data (dict): the instance_dict and the precomputed 'targets' of
+                the sample (see target_tools.py), or None if they are not
+                available (or outdated, see check_target_store)
+        """
+
+        if self.target_store_dir is None or self.target_rows[i] < 0:
+            return None
+
+        if self.target_store is None:
+            self.target_store = tt.open_target_store(self.target_store_dir)
+
+        # The store is trusted (no access to the meta+ file)
+        targets = tt.get_sample_targets(self.target_store, self.target_rows[i])
+        instance_dict = {int(k):int(v) for k,v in zip(targets['instance_id'], targets['class_id'])}
+
+        return {'instance_dict': instance_dict, 'targets': targets}
+
+    def check_target_store(self, num_of_threads=16):
+        """
+        Objective:
+            Compare the mtimes of the meta+ files with the ones of the target
+            store, once (one stat per sample, in a thread pool). The outdated
+            samples load their meta+ file instead.
+        Output:
+            num_of_outdated (int): number of outdated samples
+        """
+
+        if self.target_store_dir is None:
+            return 0
+
+        meta_mtimes = tt.open_target_store(self.target_store_dir)['meta_mtimes']
+        ids = np.where(self.target_rows >= 0)[0]
+
+        def get_meta_plus_mtime(i):
+            meta_plus_path = jt.get_meta_plus_path(self.images_fps[i])
+            return -1 if meta_plus_path is None else meta_plus_path.stat().st_mtime_ns
+
+        with concurrent.futures.ThreadPoolExecutor(num_of_threads) as pool:
+            mtimes = np.fromiter(pool.map(get_meta_plus_mtime, ids), dtype=np.int64, count=ids.shape[0])
+
+        is_outdated = mtimes != meta_mtimes[self.target_rows[ids]]
+        self.target_rows[ids[is_outdated]] = -1
+
+        if is_outdated.any():
+            LOGGER.warning(f'{int(is_outdated.sum())} outdated samples in the target store at {self.target_store_dir}, run target_tools.py again')
+
+        return int(is_outdated.sum())
+
+    def __getstate__(self):
+
+        # Memory maps are re-opened by each worker
+        state = self.__dict__.copy()
+        state['target_store'] = None
+
+        return state
+
+    def process_raw_sample(self, i, image, mask, json_data):
+        """
+        Args:
+            i (int): sample index
+            image (np.ndarray): HxWx3 uint8 color image
+            mask (np.ndarray): HxW uint8 instance mask (255 = background)
+            json_data (dict): the sample's meta+ data
+        Output:
+            sample (dict): the training sample or None if the sample is invalid
+        """
+
+        targets = self.create_targets(i, mask, json_data)
+
+        if targets is None:
+            return None
 
-                good_json_data['instance_dict'][int(id_value)] = self.class_values_map[class_id]
+        class_mask, agg_data = targets
 
+        return self.create_sample(i, image, class_mask, agg_data)
+
+    def create_targets(self, i, mask, json_data):
+        """
+        Args:
+            i (int): sample index
+            mask (np.ndarray): HxW uint8 instance mask (255 = background)
+            json_data (dict): the sample's meta+ data
+        Output:
+            class_mask (np.ndarray): HxW uint8 class mask
+            agg_data (dict): instance-lead data
+            (or None if the sample is invalid)
+        """
+
+        # Remapping the mask in a single indexed pass: removing distraction
+        # objects (and the 255 background), removing unwanted classes and
+        # generating the class mask with the desired object class
+        lut, good_instance_dict = create_remap_lut(json_data['instance_dict'], self.class_values_map)
+        good_instances_mask, class_mask, _ = remap_mask(np.asarray(mask, dtype=np.uint8), lut)
+
+        # Slicing the precomputed targets of the selected instances
+        if 'targets' in json_data:
+            agg_data = self.select_instance_targets(json_data['targets'])
+            agg_data['instance_masks'] = self.generate_instance_masks(good_instances_mask, good_instance_dict)
+
+        else:
+            agg_data = self.generate_agg_data(good_instances_mask, self.select_json_data(json_data, good_instance_dict))
+
+        # Check if any data is invalid, if it is, simply return None for the sample
+        # (normally excluded upfront, see exclude_invalid, and replaced by the
+        # RefillCollate of the training loader otherwise)
+        if (agg_data['z'] <= 0).any():
+            LOGGER.debug(f"{str(self.images_fps[i])} -> INVALID/CORRUPT SAMPLE: z <= 0, class_ids: {agg_data['class_ids']}")
+            return None
+
+        return class_mask, agg_data
+
+    def select_json_data(self, json_data, good_instance_dict):
+
+        # Keeping only the json data of the selected instances
+        good_json_data = {'instance_dict': good_instance_dict}
+
+        for enumerate_id, class_id in enumerate(json_data['instance_dict'].values()):
+
+            # If the class is in the wanted class values, then keep it
+            if class_id in self.class_values_map.keys():
                 for key in json_data.keys():
                     if key != 'instance_dict':
                         if key in good_json_data.keys():
@@ -211,23 +631,72 @@ class NOCSDataset(Dataset, torch.utils.data.Dataset):
             if key != 'instance_dict':
                 good_json_data[key] = np.stack(good_json_data[key])
 
-        # Generate the aggregated data (instance-lead data)
-        agg_data = self.generate_agg_data(good_instances_mask, good_json_data)
+        return good_json_data
 
-        # Check if any data is invalid, if it is, simply return None for the sample
-        if (agg_data['z'] <= 0).any():
-            LOGGER.debug(f"{str(self.images_fps[i])} -> INVALID/CORRUPT SAMPLE: z <= 0, class_ids: {agg_data['class_ids']}")
-            return None
+    def select_instance_targets(self, targets):
+        """
+        Args:
+            targets (dict): precomputed targets of all the sample's instances
+                (see target_tools.get_sample_targets)
+        Output:
+            agg_data (dict): the targets of the selected classes, identical to
+                generate_agg_data's (without the instance_masks)
+        """
+
+        # Selected class id of each original class id
+        class_values = np.zeros((256,), dtype=np.int64)
+        is_selected_class = np.zeros((256,), dtype=bool)
+        for class_id, selected_class_id in self.class_values_map.items():
+            class_values[class_id] = selected_class_id
+            is_selected_class[class_id] = True
+
+        is_selected = is_selected_class[targets['class_id']]
+        class_ids = class_values[targets['class_id'][is_selected]]
+
+        agg_data = {
+            'class_ids': class_ids.astype(np.float64),
+            'symmetric_ids': np.isin(class_ids, self.symmetric_classes).astype(np.float64)
+        }
+
+        for key in ['quaternion', 'scales', 'xy', 'z', 'T', 'R', 'RT']:
+            agg_data[key] = np.array(targets[key][is_selected], dtype=np.float64)
+
+        return agg_data
+
+    def create_sample(self, i, image, class_mask, agg_data):
+        """
+        Args:
+            i (int): sample index
+            image (np.ndarray): HxWx3 uint8 color image
+            class_mask (np.ndarray): HxW uint8 class mask
+            agg_data (dict): instance-lead data
+        Output:
+            sample (dict): the training sample
+        """
 
         # Create dense representation of the data (class type is instances)
         #quaternions = dm.create_dense_quaternion(good_instances_mask, good_json_data)
         #scales = dm.create_dense_scales(good_instances_mask, good_json_data)
         #xy, z = dm.create_dense_3d_centers(good_instances_mask, good_json_data, self.INTRINSICS)
 
-        # Generating class mask with the desired object class
-        class_mask = np.zeros_like(good_instances_mask)
-        for instance_id, class_id in good_json_data['instance_dict'].items():
-            class_mask[good_instances_mask == int(instance_id)] = class_id
+        # Object-centric crop, with the intrinsics of the crop
+        extra_data = {}
+        if self.crop_size:
+            cropped_data = self.crop_sample(image, class_mask, agg_data)
+            if cropped_data is None:
+                return None
+            image, class_mask, agg_data, extra_data['intrinsics'] = cropped_data
+
+        # Shipping the uint8 image, normalized later in batch (the uint8 image
+        # is also the clean image)
+        if self.image_normalization is not None:
+            return {
+                'path': self.images_fps[i],
+                'image': image,
+                'mask': class_mask.astype('long'),
+                'agg_data': agg_data,
+                **extra_data
+            }
 
         # Storing mask and image into sample
         sample = {
@@ -240,7 +709,8 @@ class NOCSDataset(Dataset, torch.utils.data.Dataset):
             #'z': z
         }
 
-        # apply augmentations
+        # apply augmentations (replaced by the batched augmentation, see
+        # transforms.pose.BatchPoseAugmentation)
         """
         if self.augmentation:
             sample = self.augmentation(**sample)
@@ -266,95 +736,111 @@ class NOCSDataset(Dataset, torch.utils.data.Dataset):
             #'scales': skimage.img_as_float32(sample['scales']),
             #'xy': skimage.img_as_float32(sample['xy']),
             #'z': skimage.img_as_float32(sample['z']),
-            'agg_data': agg_data
+            'agg_data': agg_data,
+            **extra_data
         })
 
         return sample
 
-    def __len__(self):
-        return len(self.images_fps)
-
-    def get_image_paths_in_dir(self, dir_path, max_size=None):
+    def crop_sample(self, image, class_mask, agg_data):
         """
         Args:
-            dir_path (pathlib object): The directory to be search for all possible
-                color images
+            image (np.ndarray): HxWx3 uint8 color image
+            class_mask (np.ndarray): HxW uint8 class mask
+            agg_data (dict): instance-lead data
         Objective:
-            Perform a search inside dir_path to collect all available color images
-            and save them into a list
+            Crop the sample around a random instance (see set_crop), keeping
+            the instances whose center is within the crop
         Output:
-            total_path_list (list): A list of all collected color images
+            cropped_data (tuple): the cropped image, class mask, agg_data and
+                the 3x3 intrinsics of the crop (None if no instances)
         """
 
-        total_path_list = [] # [[color, depth], ...]
-        
-        # handling additional directories
-        eval_paths = [dir_path]
-        i = 0
-
-        while True:
+        instance_masks = agg_data['instance_masks']
 
-            # Break condition: if no more directories to evaluate, end
-            if len(eval_paths) <= i:
-                break
+        if len(instance_masks) == 0:
+            return None
 
-            # Selecting the new path to evaluate
-            eval_path = eval_paths[i]
-            i += 1
+        h, w = class_mask.shape[:2]
+        crop_h, crop_w = min(self.crop_size, h), min(self.crop_size, w)
 
-            # for all the evaluate paths, do the following
-            files = [x for x in eval_path.iterdir() if x.is_file()]
+        # Random placement of the crop around the instance's bounding box
+        y0, x0, y1, x1 = instance_masks.bboxes[random.randrange(len(instance_masks))].tolist()
+        top = self.sample_crop_offset(y0, y1, crop_h, h)
+        left = self.sample_crop_offset(x0, x1, crop_w, w)
 
-            # Adding all the color images into the total_path_list
-            color_images = [x for x in files if x.name.find('color') != -1 and x.suffix == '.png']
+        # Cropping the instance-lead data (xy in [x, y] pixels)
+        cropped_instance_masks = instance_masks.crop(top, left, crop_h, crop_w)
+        xy = agg_data['xy'] - np.array([left, top], dtype=agg_data['xy'].dtype)
 
-            # Removing empty color images that do not have instances
-            good_color_images = self.remove_empty_samples(color_images)
-            total_path_list += good_color_images
+        keep = (cropped_instance_masks.areas().numpy() > 0) & \
+            (xy[:,0] >= 0) & (xy[:,0] < crop_w) & (xy[:,1] >= 0) & (xy[:,1] < crop_h)
 
-            directories = [x for x in eval_path.iterdir() if x.is_dir()]
-            eval_paths += directories
+        if not keep.any():
+            return None
 
-            # If max size is reached or overpassed, break from loop
-            if max_size != None:
-                if len(total_path_list) >= max_size:
-                    break
+        cropped_agg_data = {k:v[keep] for k,v in agg_data.items() if k not in ['xy', 'instance_masks']}
+        cropped_agg_data['xy'] = xy[keep]
+        cropped_agg_data['instance_masks'] = cropped_instance_masks[torch.from_numpy(keep)]
 
-        # removing any falsy elements
-        total_path_list = [x for x in total_path_list if x]
+        # Shifting the principal point to the crop's origin
+        intrinsics = np.array(self.INTRINSICS, dtype=np.float32)
+        intrinsics[0,2] -= left
+        intrinsics[1,2] -= top
 
-        # Trimming excess if dataset_max_size is set
-        if max_size != None:
-            total_path_list = total_path_list[:max_size]
+        return (
+            np.ascontiguousarray(image[top:top+crop_h, left:left+crop_w]),
+            np.ascontiguousarray(class_mask[top:top+crop_h, left:left+crop_w]),
+            cropped_agg_data,
+            intrinsics
+        )
 
-        return total_path_list
+    def sample_crop_offset(self, low, high, crop_size, size):
 
-    def remove_empty_samples(self, file_paths):
+        # Keeping the context margin around the instance when it fits
+        margin = int(self.context_margin * (high - low))
+        low, high = max(low - margin, 0), min(high + margin, size)
 
-        good_samples_fps = []
+        if high - low <= crop_size:
+            offset = random.randint(high - crop_size, low)
+        else:
+            offset = (low + high - crop_size) // 2
 
-        for i in range(len(file_paths)):
+        return int(np.clip(offset, 0, size - crop_size))
 
-            # Obtain the json data
-            json_fp = str(file_paths[i]).replace('_color.png', '_meta+.json')
-            json_data = jt.load_from_json(json_fp)
+    def __len__(self):
+        return len(self.images_fps)
 
-            # Get the instance data
-            instance_dict = json_data['instance_dict']
+    def get_image_paths_in_dir(self, dir_path, max_size=None):
+        """
+        Args:
+            dir_path (pathlib object): The directory to be search for all possible
+                color images
+        Objective:
+            Select the color images with instances of the selected classes from
+            the dataset's manifest (see manifest_tools.py), which is only
+            rescanned for directories that changed since the last run
+        Output:
+            total_path_list (list): A list of all collected color images
+        """
 
-            # Trim the classes that are not wanted
-            good_instance_dict = {}
-            for id_value, class_value in json_data['instance_dict'].items():
+        dir_path = pathlib.Path(dir_path)
+        manifest = mt.get_manifest(dir_path)
 
-                # If the class is in the wanted class values, then keep it
-                if class_value in self.class_values_map.keys():
-                    good_instance_dict[int(id_value)] = self.class_values_map[class_value]
+        # Selecting the subset of samples
+        sample_ids = mt.select_samples(
+            manifest['class_counts'],
+            manifest['invalid_z_counts'],
+            list(self.class_values_map.keys()),
+            max_size=max_size,
+            strategy=self.subset_strategy,
+            seed=self.subset_seed,
+            exclude_invalid_z=self.exclude_invalid
+        )
 
-            # If instances, save them as good samples
-            if good_instance_dict:
-                good_samples_fps.append(file_paths[i])
+        total_path_list = [dir_path / manifest['paths'][i] for i in sample_ids]
 
-        return good_samples_fps
+        return total_path_list
 
     def get_random_batched_sample(self, batch_size=1, device=None):
 
@@ -368,21 +854,25 @@ class NOCSDataset(Dataset, torch.utils.data.Dataset):
         # Collate the samples
         batch = my_collate_fn(all_samples, device)
 
-        return batch        
+        return self.normalize_batch(batch)
 
     def generate_agg_data(self, instances_mask, json_data):
 
-        # Obtaing the size of the images
-        h, w = instances_mask.shape
+        # Per-instance targets and their compact instance masks
+        agg_data = self.generate_instance_targets(json_data)
+        agg_data['instance_masks'] = self.generate_instance_masks(instances_mask, json_data['instance_dict'])
+
+        return agg_data
+
+    def generate_instance_targets(self, json_data):
 
         # Determining the number of instances
-        num_of_instances = np.unique(instances_mask).shape[0] - 1
+        num_of_instances = len(json_data['instance_dict'])
 
         # Creating a pure instances image
         agg_data = {
             'class_ids': np.zeros((num_of_instances,)),
             'symmetric_ids': np.zeros((num_of_instances,)),
-            'instance_masks': np.zeros((num_of_instances, h, w)),
             'quaternion': np.zeros((num_of_instances, 4)),
             'scales': np.zeros((num_of_instances, 3)),
             'xy': np.zeros((num_of_instances, 2)),
@@ -412,10 +902,6 @@ class NOCSDataset(Dataset, torch.utils.data.Dataset):
                     symmetric_ids = 1 * (json_data['instance_dict'][instance_id] in self.symmetric_classes)
                     agg_data[data_name][enumerate_id] = symmetric_ids
 
-                # Use the mask instead of json_data
-                elif data_name == 'instance_masks': 
-                    agg_data[data_name][enumerate_id] = np.where(instances_mask == instance_id, 1, 0)
-                
                 else:
                     # Grabbing the data to test data type
                     insert_data = json_data[data_name]
@@ -433,6 +919,18 @@ class NOCSDataset(Dataset, torch.utils.data.Dataset):
 
         return agg_data
 
+    def generate_instance_masks(self, instances_mask, instance_dict):
+
+        # Creating the compact instance masks from the instance numbers (1-N)
+        lut, _ = create_remap_lut(instance_dict)
+        _, _, instance_numbers = remap_mask(instances_mask, lut)
+        instance_masks, _ = im.InstanceMasks.from_label_map(
+            torch.from_numpy(instance_numbers[np.newaxis]),
+            len(instance_dict)
+        )
+
+        return instance_masks
+
 class CAMERADataset(NOCSDataset):
 
     CLASSES = pj.constants.CAMERA_CLASSES
@@ -448,21 +946,439 @@ class REALDataset(NOCSDataset):
     INTRINSICS = pj.constants.INTRINSICS['REAL']
 
 #-------------------------------------------------------------------------------
-# Dataloader
+# Sharded Pose Regression Datasets
 
-def my_collate_fn(batch, device=None):
-
-    # Filtering any samples that were deemed corrupted or invalid
-    batch = list(filter(lambda x : x is not None, batch))
+class ShardedNOCSDataset(NOCSDataset):
+    """NOCS Dataset read from the memory-mapped shards created by shard_tools.py.
+    The images, masks and pose data are sliced directly from the shards without
+    decoding any PNG or JSON files.
 
-    # If the batch is empty, simply return None
-    if not batch:
-        return None
+    Args:
+        shards_dir (str): filepath to the shards (train, valid, or test)
+        max_size (int): maximum number of samples
+        augmentation (albumentations.Compose): data transfromation pipeline
+            (e.g. flip, scale, etc.)
+        preprocessing (albumentations.Compose): data preprocessing
+            (e.g. noralization, shape manipulation, etc.)
+        subset_strategy (str): how max_size samples are selected ('ordered',
+            'random' or 'stratified', see manifest_tools.select_samples)
+        subset_seed (int): seed of the random and stratified subsets
+        exclude_invalid (bool): never schedule the samples that were marked as
+            invalid (z <= 0) when the manifest or the shards were indexed
+        resolution_scale (float): resolution of the (pre-downsampled) split,
+            the intrinsics are scaled accordingly (see pyramid_tools.py)
+    """
 
-    collate_batch = {}
-    agg_data = {
-        'sample_ids': []
-    }
+    def __init__(
+        self,
+        shards_dir: pathlib.Path,
+        max_size: Union[int, None] = None,
+        classes: Union[List, None] = None,
+        augmentation: Union[albu.Compose, None] = None,
+        preprocessing: Union[albu.Compose, None] = None,
+        subset_strategy: str = 'ordered',
+        subset_seed: int = 0,
+        exclude_invalid: bool = True,
+        resolution_scale: float = 1.0
+        ):
+
+        # ! Debugging
+        self.counter = 0
+
+        # Creating the class values map and symmetric classes
+        self.set_classes(classes)
+
+        # Scaling the intrinsics to the resolution of the split
+        self.set_resolution_scale(resolution_scale)
+
+        # Subset selection parameters
+        self.subset_strategy = subset_strategy
+        self.subset_seed = subset_seed
+        self.exclude_invalid = exclude_invalid
+
+        # Loading the index of the shards (the shards are opened lazily, to
+        # avoid pickling memory maps when sending the dataset to the workers)
+        self.shards_dir = pathlib.Path(shards_dir)
+        self.index = st.load_shard_index(self.shards_dir)
+        self.shards = {}
+
+        # Obtaining the location of the samples within the shards
+        self.sample_locations, self.images_fps = self.get_shard_samples(max_size=max_size)
+
+        # Saving parameters
+        self.augmentation = augmentation
+        self.preprocessing = preprocessing
+
+    def __getstate__(self):
+
+        # Memory maps are re-opened by each worker
+        state = super().__getstate__()
+        state['shards'] = {}
+
+        return state
+
+    def get_shard(self, shard_id):
+
+        if shard_id not in self.shards:
+            self.shards[shard_id] = st.open_shard(
+                self.shards_dir,
+                self.index['shards'][shard_id]['name'],
+                None if self.staging_cache is None else self.staging_cache.resolve
+            )
+
+        return self.shards[shard_id]
+
+    def get_shard_samples(self, max_size=None):
+        """
+        Objective:
+            Select the samples that contain at least one instance of the
+            selected classes, with the same subset strategies as the manifest
+        Output:
+            sample_locations (np.ndarray): Nx2 (shard id, id within the shard)
+            images_fps (list): the original color image path of each sample
+        """
+
+        num_of_samples = self.index['num_of_samples']
+        class_counts = np.zeros((num_of_samples, mt.NUM_OF_CLASSES), dtype=np.int64)
+        invalid_z_counts = np.zeros((num_of_samples, mt.NUM_OF_CLASSES), dtype=np.int64)
+        sample_locations = np.zeros((num_of_samples, 2), dtype=np.int64)
+
+        for shard_id, shard_info in enumerate(self.index['shards']):
+
+            shard = self.get_shard(shard_id)
+            offsets = np.asarray(shard['offsets'])
+            poses = np.asarray(shard['poses'])
+
+            # Sample id (within the split) of each instance
+            sample_ids = shard_info['start'] + np.repeat(np.arange(offsets.shape[0] - 1), np.diff(offsets))
+            class_ids = poses['class_id'].astype(np.int64)
+
+            # Counting the instances (and the invalid instances) per class
+            np.add.at(class_counts, (sample_ids, class_ids), 1)
+            is_invalid_z = np.linalg.inv(poses['RT'])[:, 2, 3] <= 0
+            np.add.at(invalid_z_counts, (sample_ids[is_invalid_z], class_ids[is_invalid_z]), 1)
+
+            start = shard_info['start']
+            end = start + shard_info['num_of_samples']
+            sample_locations[start:end, 0] = shard_id
+            sample_locations[start:end, 1] = np.arange(shard_info['num_of_samples'])
+
+        # Only the index is kept in the main process
+        self.shards = {}
+
+        sample_ids = mt.select_samples(
+            class_counts,
+            invalid_z_counts,
+            list(self.class_values_map.keys()),
+            max_size=max_size,
+            strategy=self.subset_strategy,
+            seed=self.subset_seed,
+            exclude_invalid_z=self.exclude_invalid
+        )
+
+        # Recovering the original paths (used for logging and debugging)
+        images_fps = [pathlib.Path(self.index['paths'][i]) for i in sample_ids]
+
+        return sample_locations[sample_ids], images_fps
+
+    def load_raw_sample(self, i):
+
+        # Locating the sample
+        shard_id, local_id = self.sample_locations[i]
+        shard = self.get_shard(shard_id)
+
+        # Slicing the instances of the sample
+        start, end = shard['offsets'][local_id], shard['offsets'][local_id+1]
+        json_data = st.poses_to_json_data(shard['poses'][start:end])
+
+        # np.asarray provides a view of the memory map (no copy)
+        image = np.asarray(shard['images'][local_id])
+        mask = np.asarray(shard['masks'][local_id])
+
+        return image, mask, json_data
+
+class ShardedCAMERADataset(ShardedNOCSDataset, CAMERADataset):
+    pass
+
+class ShardedREALDataset(ShardedNOCSDataset, REALDataset):
+    pass
+
+#-------------------------------------------------------------------------------
+# Streaming Pose Regression Datasets
+
+class StreamingNOCSDataset(NOCSDataset, torch.utils.data.IterableDataset):
+    """NOCS Dataset streamed sequentially from the tar shards created by
+    shard_tools.py (--FORMAT tar), for storage where random access to the 
+    small files is slow.
+
+    The shards are shuffled every epoch and split across the DataLoader
+    workers and the DDP ranks, then the samples are shuffled with an 
+    in-memory buffer (of the undecoded records). Every rank streams the same
+    number of samples (len, the workers that run out of samples stream their
+    shards again), so that the DDP ranks run the same number of steps. The
+    samples and agg_data are the same as NOCSDataset's, so my_collate_fn and
+    the models are unchanged.
+    
+    Args:
+        shards_dir (str): filepath to the tar shards (train, valid, or test)
+        max_size (int): maximum number of samples
+        preprocessing (albumentations.Compose): data preprocessing 
+            (e.g. noralization, shape manipulation, etc.)
+        subset_strategy (str): how max_size samples are selected ('ordered',
+            'random' or 'stratified', see manifest_tools.select_samples)
+        subset_seed (int): seed of the random and stratified subsets
+        exclude_invalid (bool): never stream the samples with z <= 0
+        resolution_scale (float): resolution of the (pre-downsampled) split,
+            the intrinsics are scaled accordingly (see pyramid_tools.py)
+        shuffle (bool): shuffle the shards and the samples every epoch
+        shuffle_buffer_size (int): number of records in the shuffle buffer
+        seed (int): seed of the shuffling (combined with the epoch)
+    """
+
+    def __init__(
+        self,
+        shards_dir: pathlib.Path,
+        max_size: Union[int, None] = None,
+        classes: Union[List, None] = None,
+        augmentation: Union[albu.Compose, None] = None,
+        preprocessing: Union[albu.Compose, None] = None,
+        subset_strategy: str = 'ordered',
+        subset_seed: int = 0,
+        exclude_invalid: bool = True,
+        resolution_scale: float = 1.0,
+        shuffle: bool = True,
+        shuffle_buffer_size: int = 256,
+        seed: int = 0
+        ):
+
+        # Creating the class values map and symmetric classes
+        self.set_classes(classes)
+
+        # Scaling the intrinsics to the resolution of the split
+        self.set_resolution_scale(resolution_scale)
+
+        # Loading the index of the tar shards
+        self.shards_dir = pathlib.Path(shards_dir)
+        self.index, samples = st.load_tar_index(self.shards_dir)
+
+        # Selecting the samples (same subset strategies as the manifest)
+        sample_ids = mt.select_samples(
+            samples['class_counts'],
+            samples['invalid_z_counts'],
+            list(self.class_values_map.keys()),
+            max_size=max_size,
+            strategy=subset_strategy,
+            seed=subset_seed,
+            exclude_invalid_z=exclude_invalid
+        )
+
+        self.is_selected = np.zeros((self.index['num_of_samples'],), dtype=bool)
+        self.is_selected[sample_ids] = True
+        self.num_of_selected = int(sample_ids.shape[0])
+
+        # The shards with at least one selected sample
+        self.shard_ids = [
+            shard_id for shard_id, shard_info in enumerate(self.index['shards'])
+            if self.is_selected[shard_info['start']:shard_info['start']+shard_info['num_of_samples']].any()
+        ]
+
+        # The original paths (indexed by the sample id of the shards)
+        self.images_fps = [pathlib.Path(x) for x in self.index['paths']]
+
+        # Shuffling and resuming parameters
+        self.shuffle = shuffle
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.seed = seed
+        self.epoch = 0
+        self.num_of_skipped_samples = 0
+
+        # Saving parameters
+        self.augmentation = augmentation
+        self.preprocessing = preprocessing
+
+    def __len__(self):
+
+        # Number of samples of this rank (padded, same in all the ranks)
+        rank, world_size = get_distributed_split()
+
+        return math.ceil(self.num_of_selected / world_size)
+
+    def __getitem__(self, i):
+        raise NotImplementedError('StreamingNOCSDataset does not support random access')
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def resume(self, epoch, num_of_batches, batch_size):
+        """
+        Args:
+            epoch (int): the interrupted epoch
+            num_of_batches (int): number of batches (of this rank) already used
+            batch_size (int): the batch size of the DataLoader
+        Objective:
+            Continue the interrupted epoch where it stopped, the already used
+            records are skipped before being decoded. The DataLoader takes
+            the batches from the workers in a round-robin fashion, so each
+            worker skips its share of the batches (see __iter__).
+        """
+        self.epoch = epoch
+        self.num_of_skipped_samples = num_of_batches * batch_size
+        self.skip_batch_size = batch_size
+
+    def get_worker_split(self):
+        """
+        Output:
+            global_worker_id (int): id of this worker among all the ranks
+            num_of_global_workers (int): number of workers of all the ranks
+            worker_id (int): id of this worker within the rank
+            num_of_workers (int): number of workers of the rank
+        """
+
+        worker_info = torch.utils.data.get_worker_info()
+        worker_id, num_of_workers = (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+
+        rank, world_size = get_distributed_split()
+
+        return rank * num_of_workers + worker_id, world_size * num_of_workers, worker_id, num_of_workers
+
+    def __iter__(self):
+
+        global_worker_id, num_of_global_workers, worker_id, num_of_workers = self.get_worker_split()
+
+        # Same shard order in all the workers and ranks (seed and epoch)
+        rng = np.random.RandomState(self.seed + self.epoch)
+        shard_ids = list(rng.permutation(self.shard_ids)) if self.shuffle else list(self.shard_ids)
+        worker_shard_ids = shard_ids[global_worker_id::num_of_global_workers]
+
+        # With fewer shards than workers, the workers without shards share
+        # one (they only pad their share of the rank's samples)
+        if not worker_shard_ids and shard_ids:
+            LOGGER.warning(f'Worker {global_worker_id} has no shards ({len(shard_ids)} shards, {num_of_global_workers} workers), streaming a shared shard')
+            worker_shard_ids = [shard_ids[global_worker_id % len(shard_ids)]]
+
+        # Samples of this worker: its share of the rank's samples
+        num_of_rank_samples = len(self)
+        num_of_worker_samples = num_of_rank_samples // num_of_workers + int(worker_id < num_of_rank_samples % num_of_workers)
+
+        # Samples already used by this worker (round-robin batches)
+        num_of_skipped_samples = 0
+        if self.num_of_skipped_samples > 0:
+            num_of_batches = self.num_of_skipped_samples // self.skip_batch_size
+            worker_batches = max(0, (num_of_batches - worker_id + num_of_workers - 1) // num_of_workers)
+            num_of_skipped_samples = min(worker_batches * self.skip_batch_size, num_of_worker_samples)
+
+        # Different (but deterministic) shuffle buffer per worker
+        buffer_rng = np.random.RandomState((self.seed + self.epoch) * num_of_global_workers + global_worker_id)
+
+        return self.generate_samples(worker_shard_ids, num_of_worker_samples, num_of_skipped_samples, buffer_rng)
+
+    def iterate_records(self, shard_ids):
+
+        for shard_id in shard_ids:
+            shard_path = self.resolve_path(self.shards_dir / self.index['shards'][shard_id]['name'])
+            for sample_id, record in st.iterate_tar_shard(shard_path):
+                if self.is_selected[sample_id]:
+                    yield sample_id, record
+
+    def shuffle_records(self, records, rng):
+
+        if not self.shuffle or self.shuffle_buffer_size <= 1:
+            yield from records
+            return
+
+        buffer = []
+
+        for record in records:
+
+            if len(buffer) < self.shuffle_buffer_size:
+                buffer.append(record)
+                continue
+
+            # Replacing a random record of the buffer with the new one
+            j = rng.randint(len(buffer))
+            yield buffer[j]
+            buffer[j] = record
+
+        rng.shuffle(buffer)
+        yield from buffer
+
+    def generate_samples(self, shard_ids, num_of_samples, num_of_skipped_samples, rng):
+        """
+        Args:
+            shard_ids (list): the shards of this worker
+            num_of_samples (int): number of samples of this worker (including
+                the skipped ones), its shards are streamed again if needed
+            num_of_skipped_samples (int): samples used before resuming
+            rng (np.random.RandomState): the shuffle buffer's random state
+        """
+
+        count = 0
+
+        while count < num_of_samples:
+
+            num_of_pass_samples = 0
+
+            for sample_id, record in self.shuffle_records(self.iterate_records(shard_ids), rng):
+
+                if count >= num_of_samples:
+                    return
+
+                image, mask, json_data = self.decode_record(record)
+
+                # Skipping the samples used before resuming (the invalid
+                # samples are not counted, the augmentations are not applied)
+                if count < num_of_skipped_samples:
+                    if self.create_targets(sample_id, mask, json_data) is not None:
+                        count += 1
+                        num_of_pass_samples += 1
+                    continue
+
+                sample = self.process_raw_sample(sample_id, image, mask, json_data)
+
+                # Invalid samples are skipped, so the batches remain full
+                if sample is not None:
+                    count += 1
+                    num_of_pass_samples += 1
+                    yield sample
+
+            # No valid sample in the shards of this worker
+            if num_of_pass_samples == 0:
+                LOGGER.warning(f'No valid samples in shards {shard_ids}, streamed {count}/{num_of_samples} samples')
+                return
+
+    def get_random_batched_sample(self, batch_size=1, device=None):
+
+        all_samples = []
+
+        for sample in self:
+            all_samples.append(sample)
+            if len(all_samples) == batch_size:
+                break
+
+        return self.normalize_batch(my_collate_fn(all_samples, device))
+
+class StreamingCAMERADataset(StreamingNOCSDataset, CAMERADataset):
+    pass
+
+class StreamingREALDataset(StreamingNOCSDataset, REALDataset):
+    pass
+
+#-------------------------------------------------------------------------------
+# Dataloader
+
+def my_collate_fn(batch, device=None):
+
+    # Filtering any samples that were deemed corrupted or invalid
+    batch = list(filter(lambda x : x is not None, batch))
+
+    # If the batch is empty, simply return None
+    if not batch:
+        return None
+
+    collate_batch = {}
+    agg_data = {
+        'sample_ids': []
+    }
 
     # Iterating overall the data input data
     for sample_id, single_sample in enumerate(batch):
@@ -508,7 +1424,10 @@ def my_collate_fn(batch, device=None):
 
         # Now concatinating all non-uniform data
         for subkey in agg_data.keys():
-            concated_agg_data[subkey] = torch.from_numpy(np.concatenate(agg_data[subkey], axis=0)).to(device)
+            if isinstance(agg_data[subkey][0], im.InstanceMasks):
+                concated_agg_data[subkey] = im.InstanceMasks.cat(agg_data[subkey]).to(device)
+            else:
+                concated_agg_data[subkey] = torch.from_numpy(np.concatenate(agg_data[subkey], axis=0)).to(device)
     
     # If no device is specified
     else:
@@ -521,12 +1440,373 @@ def my_collate_fn(batch, device=None):
 
         # Now concatinating all non-uniform data
         for subkey in agg_data.keys():
-            concated_agg_data[subkey] = torch.from_numpy(np.concatenate(agg_data[subkey], axis=0))
+            if isinstance(agg_data[subkey][0], im.InstanceMasks):
+                concated_agg_data[subkey] = im.InstanceMasks.cat(agg_data[subkey])
+            else:
+                concated_agg_data[subkey] = torch.from_numpy(np.concatenate(agg_data[subkey], axis=0))
+
+    # Now storing agg data (ordered by sample) into the collate batch
+    stacked_collate_batch['agg_data'] = ct.AggData(**concated_agg_data)
+    stacked_collate_batch['agg_data'].set_offsets(len(batch))
+
+    return ct.Batch(**stacked_collate_batch)
+
+def new_batch_tensor(shape, dtype):
+    """
+    Args:
+        shape (tuple): shape of the batch tensor
+        dtype (torch.dtype): its data type
+    Output:
+        tensor (torch.Tensor): uninitialized tensor, in shared memory when
+            created within a DataLoader worker (sent to the main process
+            without further copies)
+    """
+
+    if torch.utils.data.get_worker_info() is None:
+        return torch.empty(shape, dtype=dtype)
+
+    numel = int(np.prod(shape))
+    storage = torch.empty((0,), dtype=dtype).storage()._new_shared(numel)
+
+    return torch.empty((0,), dtype=dtype).set_(storage).view(shape)
+
+def collate_arrays(arrays, concatenate=False):
+    """
+    Args:
+        arrays (list): the np.ndarray (or torch.Tensor) of each sample
+        concatenate (bool): concatenate along the first axis, else stack
+    Output:
+        tensor (torch.Tensor): the arrays written into a single batch tensor
+            (see new_batch_tensor), with a single copy of each array
+    """
+
+    arrays = [x.numpy() if isinstance(x, torch.Tensor) else np.asarray(x) for x in arrays]
+    dtype = torch.from_numpy(np.empty((0,), dtype=arrays[0].dtype)).dtype
+
+    if concatenate:
+        sizes = [x.shape[0] for x in arrays]
+        tensor = new_batch_tensor((sum(sizes),) + arrays[0].shape[1:], dtype)
+        offsets = np.cumsum([0] + sizes)
+    else:
+        tensor = new_batch_tensor((len(arrays),) + arrays[0].shape, dtype)
+
+    # Writing each array in place (numpy handles any strides, e.g. flips)
+    numpy_tensor = tensor.numpy()
+    for k, array in enumerate(arrays):
+        if concatenate:
+            numpy_tensor[offsets[k]:offsets[k+1]] = array
+        else:
+            numpy_tensor[k] = array
+
+    return tensor
+
+def shared_collate_fn(batch):
+    """
+    Args:
+        batch (list): the samples (None for invalid samples)
+    Objective:
+        Same output as my_collate_fn, but the samples are written directly
+        into the batch tensors (in shared memory within the workers), instead
+        of stacking them and copying the result into shared memory when it is
+        sent to the main process. The per-instance agg_data is concatenated
+        in place too, its offsets (B+1) being the start of each sample's
+        instances.
+    Output:
+        batch (Batch): the collated batch (None if empty)
+    """
+
+    # Filtering any samples that were deemed corrupted or invalid
+    batch = [x for x in batch if x is not None]
+
+    if not batch:
+        return None
+
+    collate_batch = ct.Batch()
+
+    # Uniform data (stacked) and other data (lists, e.g. paths)
+    for key in batch[0].keys():
+        
+        if key == 'agg_data':
+            continue
+
+        values = [x[key] for x in batch]
+        if isinstance(values[0], (np.ndarray, torch.Tensor)):
+            collate_batch[key] = collate_arrays(values)
+        else:
+            collate_batch[key] = values
+
+    if 'agg_data' not in batch[0]:
+        return collate_batch
+
+    # Ragged offset table of the instances of each sample
+    agg_datas = [x['agg_data'] for x in batch]
+    num_of_instances = [x['class_ids'].shape[0] for x in agg_datas]
+    agg_data = ct.AggData(
+        offsets=torch.from_numpy(np.cumsum([0] + num_of_instances)),
+        sample_ids=collate_arrays([np.full((n,), k, dtype=np.int64) for k, n in enumerate(num_of_instances)], concatenate=True)
+    )
+
+    for subkey in agg_datas[0].keys():
+
+        values = [x[subkey] for x in agg_datas]
+
+        if isinstance(values[0], im.InstanceMasks):
+            # Shifting the crops' offsets of each sample
+            crop_offsets = np.cumsum([0] + [x.crops.shape[0] for x in values])
+            agg_data[subkey] = im.InstanceMasks(
+                collate_arrays([x.bboxes for x in values], concatenate=True),
+                collate_arrays([x.crops for x in values], concatenate=True),
+                collate_arrays([torch.zeros((1,), dtype=torch.int64)] + [x.offsets[1:] + int(crop_offsets[k]) for k, x in enumerate(values)], concatenate=True),
+                values[0].image_shape
+            )
+        else:
+            agg_data[subkey] = collate_arrays(values, concatenate=True)
+
+    collate_batch['agg_data'] = agg_data
+
+    return collate_batch
+
+class RefillCollate(object):
+    """Collate function (see my_collate_fn) that tops up the batches with
+    invalid samples (None) from a small reserve of random samples of the
+    dataset, so that every batch has batch_size samples. The reserve is only
+    decoded when a sample is missing.
+
+    Args:
+        dataset (NOCSDataset): the dataset of the loader
+        batch_size (int): the desired batch size
+        reserve_size (int): number of random sample ids in the reserve
+        collate_fn (function): my_collate_fn or shared_collate_fn
+    """
+
+    def __init__(self, dataset, batch_size, reserve_size=16, collate_fn=my_collate_fn):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.reserve_size = reserve_size
+        self.collate_fn = collate_fn
+
+        # Created lazily, so that each worker has its own random reserve
+        self.rng = None
+        self.reserve = []
+        self.invalid_ids = set()
+
+    def get_reserve_id(self):
+
+        if self.rng is None:
+            self.rng = np.random.RandomState(torch.initial_seed() % 2**32)
+
+        if not self.reserve:
+            self.reserve = list(self.rng.randint(0, len(self.dataset), size=self.reserve_size))
+
+        return int(self.reserve.pop())
+
+    def __call__(self, batch):
+
+        # Filtering any samples that were deemed corrupted or invalid
+        valid_batch = [x for x in batch if x is not None]
+
+        # Limiting the attempts, in case most of the dataset is invalid
+        attempts = 0
+        while len(valid_batch) < min(self.batch_size, len(batch)) and attempts < self.reserve_size:
+
+            attempts += 1
+            sample_id = self.get_reserve_id()
+            
+            if sample_id in self.invalid_ids:
+                continue
+            
+            sample = self.dataset[sample_id]
+
+            if sample is None:
+                self.invalid_ids.add(sample_id)
+            else:
+                LOGGER.debug(f"REFILLED BATCH WITH: {sample['path']}")
+                valid_batch.append(sample)
+
+        return self.collate_fn(valid_batch)
+
+class StreamingDataLoader(torch.utils.data.DataLoader):
+    """DataLoader of the StreamingNOCSDataset that advances the dataset's epoch
+    (the shuffling seed) after starting the workers of each epoch. The
+    workers receive the dataset's state when they are started."""
+
+    def __iter__(self):
+
+        iterator = super().__iter__()
+
+        # The resumed epoch is only skipped once
+        self.dataset.set_epoch(self.dataset.epoch + 1)
+        self.dataset.num_of_skipped_samples = 0
+
+        return iterator
+
+def apply_to_batch(data, function):
+    """
+    Args:
+        data (Container, dict, list, torch.Tensor or InstanceMasks): (nested)
+            batch data
+        function (callable): applied to each torch.Tensor and InstanceMasks
+    Output:
+        data: with the same structure as the input
+    """
+
+    if isinstance(data, (torch.Tensor, im.InstanceMasks)):
+        return function(data)
+    elif isinstance(data, ct.Container):
+        return data.apply(function)
+    elif isinstance(data, dict):
+        return {k:apply_to_batch(v, function) for k,v in data.items()}
+    elif isinstance(data, list) and data and isinstance(data[0], (torch.Tensor, im.InstanceMasks, dict)):
+        return [apply_to_batch(x, function) for x in data]
+    else:
+        return data
+
+class PrefetchLoader(object):
+    """Wrapper of a DataLoader that keeps num_prefetch batches in flight.
+
+    A background thread iterates over the loader (overlapping the collate of
+    the next batches with the training step), pins the collated batches
+    (including the nested agg_data) and, if a CUDA device is given, copies
+    them to the device with non-blocking transfers in a separate stream.
+
+    Args:
+        loader (torch.utils.data.DataLoader): the wrapped loader
+        num_prefetch (int): number of batches in flight
+        device (str or torch.device): target device (None = CPU-only mode)
+    """
+
+    def __init__(self, loader, num_prefetch=2, device=None):
+        self.loader = loader
+        self.num_prefetch = num_prefetch
+        self.device = device
+
+        # Time (in seconds) that the consumer waited for each batch
+        self.wait_times = []
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __getattr__(self, name):
+        # Exposing the attributes of the DataLoader (dataset, batch_size, etc.)
+        if name == 'loader':
+            raise AttributeError(name)
+        return getattr(self.loader, name)
+
+    def get_device(self):
+
+        if self.device is None or not torch.cuda.is_available():
+            return None
+
+        device = torch.device(self.device)
+
+        # Using the current device of the process (one per process in ddp)
+        if device.type == 'cuda' and device.index is None:
+            device = torch.device('cuda', torch.cuda.current_device())
+
+        return device if device.type == 'cuda' else None
+
+    def producer(self, output_queue, stop_event, device):
+
+        stream = torch.cuda.Stream(device) if device is not None else None
+
+        def put(item):
+            # Avoiding blocking forever if the consumer stopped early
+            while not stop_event.is_set():
+                try:
+                    output_queue.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        try:
+            for batch in self.loader:
+
+                event = None
+
+                if batch is not None and device is not None:
+                    with torch.cuda.stream(stream):
+                        batch = apply_to_batch(batch, lambda x: x.pin_memory().to(device, non_blocking=True))
+                        event = torch.cuda.Event()
+                        event.record(stream)
+
+                elif batch is not None:
+                    batch = apply_to_batch(batch, lambda x: x.pin_memory() if torch.cuda.is_available() else x)
+
+                if not put((batch, event, None)):
+                    return
+
+        except Exception as e:
+            put((None, None, e))
+            return
+
+        put(StopIteration)
+
+    def __iter__(self):
+
+        device = self.get_device()
+        output_queue = queue.Queue(maxsize=max(self.num_prefetch, 1))
+        stop_event = threading.Event()
+        self.wait_times = []
+
+        thread = threading.Thread(target=self.producer, args=(output_queue, stop_event, device), daemon=True)
+        thread.start()
+
+        try:
+            while True:
+
+                tic = time.time()
+                item = output_queue.get()
+                wait_time = time.time() - tic
+                
+                if item is StopIteration:
+                    break
+
+                batch, event, error = item
+
+                if error is not None:
+                    raise error
+
+                # Ensuring that the copy finished before the batch is used in the
+                # current stream (and that the memory is not reused before)
+                if event is not None:
+                    current_stream = torch.cuda.current_stream(device)
+                    current_stream.wait_event(event)
+                    apply_to_batch(batch, lambda x: record_stream(x, current_stream))
+
+                self.wait_times.append(wait_time)
+                LOGGER.debug(f'PREFETCH WAIT: {wait_time*1000:.2f} ms')
+
+                yield batch
+
+        finally:
+            stop_event.set()
 
-    # Now storing agg data into the collate batch
-    stacked_collate_batch['agg_data'] = concated_agg_data
+    def get_wait_time_stats(self):
+        """
+        Output:
+            stats (dict): total, mean and max wait time (in seconds) of the
+                consumer in the last iteration over the loader
+        """
+
+        if not self.wait_times:
+            return {'total': 0, 'mean': 0, 'max': 0}
+
+        return {
+            'total': float(np.sum(self.wait_times)),
+            'mean': float(np.mean(self.wait_times)),
+            'max': float(np.max(self.wait_times))
+        }
 
-    return stacked_collate_batch
+def record_stream(data, stream):
+
+    if isinstance(data, im.InstanceMasks):
+        for x in [data.bboxes, data.crops, data.offsets]:
+            x.record_stream(stream)
+    else:
+        data.record_stream(stream)
+
+    return data
 
 #-------------------------------------------------------------------------------
 # PyTorch-Lightning DataModule
@@ -543,7 +1823,25 @@ class PoseRegressionDataModule(pl.LightningDataModule):
         encoder_weights=None,
         train_size=None,
         valid_size=None,
-        is_deterministic=False
+        is_deterministic=False,
+        use_shards=False,
+        use_streaming=False,
+        subset_strategy='ordered',
+        subset_seed=0,
+        prefetch_batches=0,
+        prefetch_device=None,
+        cache_splits=(),
+        cache_bytes=4 * 1024**3,
+        device_normalization=False,
+        resolution_scale=1.0,
+        readahead_depth=0,
+        readahead_threads=4,
+        staging_bytes=0,
+        staging_check_source=False,
+        check_targets=False,
+        crop_size=0,
+        crop_margin=0.25,
+        shared_collate=False
         ):
 
         super().__init__()
@@ -558,6 +1856,59 @@ class PoseRegressionDataModule(pl.LightningDataModule):
         self.train_size = train_size
         self.valid_size = valid_size
         self.is_deterministic = is_deterministic
+        self.use_shards = use_shards
+        self.use_streaming = use_streaming
+        self.subset_strategy = subset_strategy
+        self.subset_seed = subset_seed
+        self.prefetch_batches = prefetch_batches
+        self.prefetch_device = prefetch_device
+        self.cache_splits = list(cache_splits)
+        self.cache_bytes = cache_bytes
+        self.sample_caches = {}
+        self.device_normalization = device_normalization
+        self.resolution_scale = resolution_scale
+        self.readahead_depth = readahead_depth
+        self.readahead_threads = readahead_threads
+        self.readaheads = {}
+        self.staging_bytes = staging_bytes
+        self.staging_check_source = staging_check_source
+        self.check_targets = check_targets
+        self.staging_cache = None
+        self.crop_size = crop_size
+        self.crop_margin = crop_margin
+        self.shared_collate = shared_collate
+        self.image_normalization = None
+
+    def create_dataset(self, dataset_class, sharded_dataset_class, streaming_dataset_class, env_prefix, **kwargs):
+
+        # Subset selection and resolution parameters
+        kwargs.update({
+            'subset_strategy': self.subset_strategy,
+            'subset_seed': self.subset_seed,
+            'resolution_scale': self.resolution_scale
+        })
+
+        # Streaming the tar shards sequentially (see shard_tools.py)
+        if self.use_streaming:
+            return streaming_dataset_class(
+                shards_dir=pt.get_scaled_path(os.getenv(f"{env_prefix}_TARS"), self.resolution_scale),
+                shuffle=env_prefix.endswith('TRAIN') and not self.is_deterministic,
+                **kwargs
+            )
+
+        # Reading from the memory-mapped shards (see shard_tools.py)
+        elif self.use_shards:
+            return sharded_dataset_class(
+                shards_dir=pt.get_scaled_path(os.getenv(f"{env_prefix}_SHARDS"), self.resolution_scale),
+                **kwargs
+            )
+        
+        # Reading the original PNG/JSON files
+        else:
+            return dataset_class(
+                dataset_dir=pt.get_scaled_path(os.getenv(f"{env_prefix}_DATASET"), self.resolution_scale),
+                **kwargs
+            )
 
     def setup(self, stage=None):
 
@@ -571,16 +1922,22 @@ class PoseRegressionDataModule(pl.LightningDataModule):
         # CAMERA / NOCS
         if self.dataset_name == 'CAMERA':
 
-            train_dataset = CAMERADataset(
-                dataset_dir=pathlib.Path(os.getenv("NOCS_CAMERA_TRAIN_DATASET")),
+            train_dataset = self.create_dataset(
+                CAMERADataset,
+                ShardedCAMERADataset,
+                StreamingCAMERADataset,
+                "NOCS_CAMERA_TRAIN",
                 max_size=self.train_size,
                 classes=self.selected_classes,
                 augmentation=transforms.pose.get_training_augmentation(),
                 preprocessing=transforms.pose.get_preprocessing(preprocessing_fn)
             )
 
-            valid_dataset = CAMERADataset(
-                dataset_dir=pathlib.Path(os.getenv("NOCS_CAMERA_VALID_DATASET")), 
+            valid_dataset = self.create_dataset(
+                CAMERADataset,
+                ShardedCAMERADataset,
+                StreamingCAMERADataset,
+                "NOCS_CAMERA_VALID",
                 max_size=self.valid_size,
                 classes=self.selected_classes,
                 augmentation=transforms.pose.get_validation_augmentation(),
@@ -595,16 +1952,22 @@ class PoseRegressionDataModule(pl.LightningDataModule):
         # REAL / NOCS
         elif self.dataset_name == 'REAL':
 
-            train_dataset = REALDataset(
-                dataset_dir=pathlib.Path(os.getenv("NOCS_REAL_TRAIN_DATASET")),
+            train_dataset = self.create_dataset(
+                REALDataset,
+                ShardedREALDataset,
+                StreamingREALDataset,
+                "NOCS_REAL_TRAIN",
                 max_size=self.train_size,
                 classes=self.selected_classes,
                 augmentation=transforms.pose.get_training_augmentation(),
                 preprocessing=transforms.pose.get_preprocessing(preprocessing_fn)
             )
 
-            valid_dataset = REALDataset(
-                dataset_dir=pathlib.Path(os.getenv("NOCS_REAL_TEST_DATASET")), 
+            valid_dataset = self.create_dataset(
+                REALDataset,
+                ShardedREALDataset,
+                StreamingREALDataset,
+                "NOCS_REAL_TEST",
                 max_size=self.valid_size,
                 classes=self.selected_classes,
                 augmentation=transforms.pose.get_validation_augmentation(),
@@ -620,6 +1983,54 @@ class PoseRegressionDataModule(pl.LightningDataModule):
         else:
             raise RuntimeError('Dataset needs to be selected')
 
+        # Normalizing the uint8 images in the device (see transfer_batch_to_device)
+        if self.device_normalization:
+            self.image_normalization = transforms.pose.ImageNormalization.from_preprocessing_fn(preprocessing_fn)
+            for dataset in self.datasets.values():
+                dataset.set_image_normalization(self.image_normalization)
+
+        # Object-centric crops for the training of the heads (the validation
+        # uses the full images)
+        if self.crop_size > 0:
+            self.datasets['train'].set_crop(self.crop_size, self.crop_margin)
+
+        # Local copies (STAGING_DIR) of the files of the network mount (DATASET_DIR)
+        if self.staging_bytes > 0:
+            if self.staging_cache is None:
+                self.staging_cache = sg.StagingCache(
+                    os.getenv('DATASET_DIR'),
+                    os.getenv('STAGING_DIR'),
+                    self.staging_bytes,
+                    self.staging_check_source
+                )
+            for dataset in self.datasets.values():
+                dataset.set_staging_cache(self.staging_cache)
+
+        # Readahead of the raw files (only for the original PNG/JSON files)
+        if self.readahead_depth > 0:
+            for dataset_key, dataset in self.datasets.items():
+                if isinstance(dataset, (ShardedNOCSDataset, StreamingNOCSDataset)):
+                    continue
+                self.readaheads[dataset_key] = ra.SampleReadahead(
+                    len(dataset), 
+                    self.batch_size, 
+                    self.readahead_depth, 
+                    self.readahead_threads
+                )
+                dataset.set_readahead(self.readaheads[dataset_key])
+
+        # Excluding the outdated samples of the precomputed targets (opt-in,
+        # the targets are trusted otherwise)
+        if self.check_targets:
+            for dataset in self.datasets.values():
+                dataset.check_target_store()
+
+        # Shared-memory caches of the decoded samples (opt-in per split)
+        for dataset_key in self.cache_splits:
+            if dataset_key not in self.sample_caches:
+                self.sample_caches[dataset_key] = sc.SharedSampleCache(dataset_key, self.cache_bytes)
+            self.datasets[dataset_key].set_sample_cache(self.sample_caches[dataset_key])
+
         print(f"Training datset size: {len(self.datasets['train'])}")
         print(f"Validation dataset size: {len(self.datasets['valid'])}")
 
@@ -627,14 +2038,28 @@ class PoseRegressionDataModule(pl.LightningDataModule):
 
         if dataset_key in self.datasets.keys():        
             
+            # Collating the samples directly into shared memory batch tensors
+            collate_fn = shared_collate_fn if self.shared_collate else my_collate_fn
+
+            # Only the training batches are topped up with random samples, the
+            # evaluated set of the other splits stays the same
+            if dataset_key == 'train':
+                collate_fn = RefillCollate(self.datasets[dataset_key], self.batch_size, collate_fn=collate_fn)
+
             # Constructing general params
             params = {
                 'dataset': self.datasets[dataset_key],
                 'num_workers': self.num_workers,
                 'batch_size': self.batch_size,
-                'collate_fn': my_collate_fn,
+                'collate_fn': collate_fn,
+                # All the training steps run with the full batch size
+                'drop_last': dataset_key == 'train'
             }
 
+            # Keeping the workers (and their opened files) across epochs
+            if dataset_key in self.sample_caches and self.num_workers > 0:
+                params['persistent_workers'] = True
+
             # If deterministic, don't shuffle and provide seed_worker function
             if self.is_deterministic:
                 params.update({
@@ -646,8 +2071,43 @@ class PoseRegressionDataModule(pl.LightningDataModule):
                     'shuffle': True
                 })
 
+            # Sharding the samples by rank in ddp (Lightning only adds its
+            # DistributedSampler to a DataLoader, not to the PrefetchLoader)
+            rank, world_size = get_distributed_split()
+            if world_size > 1 and not isinstance(self.datasets[dataset_key], torch.utils.data.IterableDataset) and dataset_key not in self.readaheads:
+                params['sampler'] = torch.utils.data.DistributedSampler(
+                    self.datasets[dataset_key],
+                    num_replicas=world_size,
+                    rank=rank,
+                    shuffle=params.pop('shuffle')
+                )
+
+            # The sampler publishes the order of the samples (of this rank) to
+            # the readahead
+            if dataset_key in self.readaheads:
+                params['sampler'] = ra.ReadaheadSampler(
+                    self.readaheads[dataset_key],
+                    len(self.datasets[dataset_key]),
+                    shuffle=params.pop('shuffle'),
+                    num_of_replicas=world_size,
+                    rank=rank
+                )
+
+            # The streaming datasets shuffle (and split) the shards themselves
+            # and never return invalid samples
+            if isinstance(self.datasets[dataset_key], torch.utils.data.IterableDataset):
+                params.pop('shuffle')
+                params.pop('persistent_workers', None)
+                params['collate_fn'] = shared_collate_fn if self.shared_collate else my_collate_fn
+                dataloader = StreamingDataLoader(**params)
+
             # Passing parameters
-            dataloader = torch.utils.data.DataLoader(**params)
+            else:
+                dataloader = torch.utils.data.DataLoader(**params)
+
+            # Keeping batches in flight (pinned and copied to the device)
+            if self.prefetch_batches > 0:
+                dataloader = PrefetchLoader(dataloader, self.prefetch_batches, self.prefetch_device)
             
             return dataloader
 
@@ -655,6 +2115,36 @@ class PoseRegressionDataModule(pl.LightningDataModule):
 
             return None
 
+    def get_cache_stats(self):
+        return {k:v.get_stats() for k,v in self.sample_caches.items()}
+
+    def get_readahead_stats(self):
+        return {k:v.get_stats() for k,v in self.readaheads.items()}
+
+    def get_staging_stats(self):
+        return None if self.staging_cache is None else self.staging_cache.get_stats()
+
+    def normalize_batch(self, batch):
+        """
+        Args:
+            batch (dict): collated batch (already in its device)
+        Output:
+            batch (dict): the batch with the normalized images (unchanged if
+                the device normalization is disabled or already applied)
+        """
+
+        if self.image_normalization is None:
+            return batch
+
+        return transforms.pose.normalize_batch(batch, self.image_normalization)
+
+    def transfer_batch_to_device(self, batch, device):
+
+        # Moving the uint8 images first, then normalizing them in the device
+        batch = super().transfer_batch_to_device(batch, device)
+
+        return self.normalize_batch(batch)
+
     def train_dataloader(self):
         return self.get_loader('train')
 
@@ -693,6 +2183,122 @@ def test_pose_camera_dataset():
         fig_path = pathlib.Path(os.getenv("TEST_OUTPUT")) / f'quat_pose{i}.png'
         fig.savefig(str(fig_path), dpi=400)
 
+def test_device_normalization(num_of_samples=8):
+
+    preprocessing_fn = smp.encoders.get_preprocessing_fn(ENCODER, ENCODER_WEIGHTS)
+
+    dataset = CAMERADataset(
+        dataset_dir=pathlib.Path(os.getenv("NOCS_CAMERA_TRAIN_DATASET")),
+        max_size=num_of_samples,
+        classes=pj.constants.CAMERA_CLASSES,
+        preprocessing=transforms.pose.get_preprocessing(preprocessing_fn)
+    )
+
+    # Per-sample preprocessing (float images)
+    samples = [dataset[i] for i in range(num_of_samples)]
+    expected_images = np.stack([x['image'] for x in samples if x is not None])
+
+    # Batched normalization of the uint8 images
+    dataset.set_image_normalization(transforms.pose.ImageNormalization.from_preprocessing_fn(preprocessing_fn))
+    batch = my_collate_fn([dataset[i] for i in range(num_of_samples)], device='cpu')
+    assert batch['image'].dtype == torch.uint8
+
+    batch = dataset.normalize_batch(batch)
+
+    # Bit-compatible results
+    assert np.array_equal(batch['image'].numpy(), expected_images)
+    assert batch['clean_image'].dtype == torch.uint8
+
+def test_shared_collate(num_of_samples=8, num_of_workers=2):
+
+    dataset = CAMERADataset(
+        dataset_dir=pathlib.Path(os.getenv("NOCS_CAMERA_TRAIN_DATASET")),
+        max_size=num_of_samples,
+        classes=pj.constants.CAMERA_CLASSES
+    )
+
+    # Reference batch
+    expected_batch = my_collate_fn([dataset[i] for i in range(num_of_samples)])
+
+    # Batch collated within a worker (shared memory)
+    dataloader = torch.utils.data.DataLoader(
+        dataset,
+        batch_size=num_of_samples,
+        num_workers=num_of_workers,
+        collate_fn=shared_collate_fn
+    )
+    batch = next(iter(dataloader))
+
+    assert torch.equal(batch['image'], expected_batch['image'])
+    assert torch.equal(batch['mask'], expected_batch['mask'])
+
+    for key, value in expected_batch['agg_data'].items():
+        if isinstance(value, im.InstanceMasks):
+            assert torch.equal(batch['agg_data'][key].to_dense(), value.to_dense())
+        else:
+            assert torch.equal(batch['agg_data'][key], value)
+
+    # Offset table of the instances of each sample
+    offsets = batch['agg_data'].offsets
+    counts = torch.bincount(batch['agg_data']['sample_ids'], minlength=batch.batch_size)
+    assert torch.equal(offsets[1:] - offsets[:-1], counts)
+    assert torch.equal(batch.sample(1)['agg_data']['xy'], expected_batch['agg_data']['xy'][offsets[1]:offsets[2]])
+
+def test_mask_remapping_performance(num_of_runs=100):
+
+    # Previous implementation: three loops over the instances, on float masks
+    def loop_remapping(mask, instance_dict, class_values_map):
+
+        mask = mask.astype('float')
+        mask[mask == 255] = 0
+
+        instances_mask = np.zeros_like(mask)
+        for instance_id in instance_dict.keys():
+            instances_mask[mask == int(instance_id)] = int(instance_id)
+
+        good_instance_dict = {}
+        good_instances_mask = np.zeros_like(instances_mask)
+        for id_value, class_id in instance_dict.items():
+            if class_id in class_values_map.keys():
+                good_instances_mask[instances_mask == int(id_value)] = int(id_value)
+                good_instance_dict[int(id_value)] = class_values_map[class_id]
+
+        class_mask = np.zeros_like(good_instances_mask)
+        for instance_id, class_id in good_instance_dict.items():
+            class_mask[good_instances_mask == int(instance_id)] = class_id
+
+        return good_instances_mask, class_mask
+
+    def lut_remapping(mask, instance_dict, class_values_map):
+
+        lut, _ = create_remap_lut(instance_dict, class_values_map)
+        good_instances_mask, class_mask, _ = remap_mask(mask, lut)
+
+        return good_instances_mask, class_mask
+
+    # Synthetic 640x480 sample: 6 instances (1 unselected class) + 1 distractor
+    rng = np.random.RandomState(0)
+    mask = np.full((480, 640), 255, dtype=np.uint8)
+    for instance_id in range(1, 8):
+        y, x = rng.randint(0, 400), rng.randint(0, 560)
+        mask[y:y+80, x:x+80] = instance_id
+
+    instance_dict = {str(i):i for i in range(1, 7)}
+    class_values_map = {i:i for i in range(1, 6)}
+
+    # Both implementations need to match
+    loop_outputs = loop_remapping(mask, instance_dict, class_values_map)
+    lut_outputs = lut_remapping(mask, instance_dict, class_values_map)
+    for loop_output, lut_output in zip(loop_outputs, lut_outputs):
+        assert (loop_output == lut_output).all()
+
+    for name, function in [('loops', loop_remapping), ('lut', lut_remapping)]:
+        tic = time.time()
+        for i in range(num_of_runs):
+            function(mask, instance_dict, class_values_map)
+        toc = time.time()
+        print(f'{name}: {(toc-tic)/num_of_runs*1000:.3f} ms/sample')
+
 #-------------------------------------------------------------------------------
 # Main Code
 
@@ -703,3 +2309,12 @@ if __name__ == '__main__':
     # camera dataset
     test_pose_camera_dataset()
 
+    # device-side normalization (uint8 images)
+    test_device_normalization()
+
+    # collate into shared memory batch tensors
+    test_shared_collate()
+
+    # label remapping (loops vs lookup table)
+    test_mask_remapping_performance()
+
@@ -0,0 +1,467 @@
+import numpy as np
+
+import torch
+
+#-------------------------------------------------------------------------------
+# Classes
+
+class InstanceMasks(object):
+    """Compact container of N binary instance masks of the same image size.
+
+    Each mask is stored as its bounding box and a uint8 crop of the bounding
+    box. All the crops are flattened into a single buffer, so that the full
+    resolution (N,H,W) masks are only created on demand (to_dense).
+
+    Args:
+        bboxes (torch.Tensor): Nx4 int64 [y0, x0, y1, x1] (y1 and x1 exclusive)
+        crops (torch.Tensor): uint8 flat buffer of all the crops (row-major)
+        offsets (torch.Tensor): N+1 int64 start of each crop in the buffer
+        image_shape (tuple): (H,W) of the full resolution masks
+    """
+
+    def __init__(self, bboxes, crops, offsets, image_shape):
+        self.bboxes = bboxes
+        self.crops = crops
+        self.offsets = offsets
+        self.image_shape = tuple(int(x) for x in image_shape)
+
+    #---------------------------------------------------------------------------
+    # Constructors
+
+    @classmethod
+    def from_pixels(cls, instance_ids, ys, xs, num_of_instances, image_shape):
+        """
+        Args:
+            instance_ids (torch.Tensor): P instance id (0 to N-1) of each pixel
+            ys, xs (torch.Tensor): P coordinates of each pixel
+            num_of_instances (int): N
+            image_shape (tuple): (H,W)
+        Output:
+            instance_masks (InstanceMasks)
+        """
+
+        h, w = image_shape
+        device = instance_ids.device
+
+        # Number of pixels per instance
+        counts = torch.bincount(instance_ids, minlength=num_of_instances)
+        ends = torch.cumsum(counts, dim=0)
+        starts = ends - counts
+        is_empty = counts == 0
+
+        # Bounding boxes from sorting the pixels per instance and coordinate
+        sorted_ys = torch.sort(instance_ids * h + ys)[0] % h
+        sorted_xs = torch.sort(instance_ids * w + xs)[0] % w
+
+        safe_starts = torch.where(is_empty, torch.zeros_like(starts), starts)
+        safe_ends = torch.where(is_empty, torch.ones_like(ends), ends)
+
+        bboxes = torch.zeros((num_of_instances, 4), dtype=torch.int64, device=device)
+        if instance_ids.shape[0] > 0:
+            bboxes[:,0] = sorted_ys[safe_starts]
+            bboxes[:,1] = sorted_xs[safe_starts]
+            bboxes[:,2] = sorted_ys[safe_ends-1] + 1
+            bboxes[:,3] = sorted_xs[safe_ends-1] + 1
+        bboxes[is_empty] = 0
+
+        # Allocating the crops
+        bbox_hs = bboxes[:,2] - bboxes[:,0]
+        bbox_ws = bboxes[:,3] - bboxes[:,1]
+        offsets = torch.zeros((num_of_instances+1,), dtype=torch.int64, device=device)
+        offsets[1:] = torch.cumsum(bbox_hs * bbox_ws, dim=0)
+
+        # Filling the crops
+        crops = torch.zeros((int(offsets[-1]),), dtype=torch.uint8, device=device)
+        local_ys = ys - bboxes[instance_ids,0]
+        local_xs = xs - bboxes[instance_ids,1]
+        crops[offsets[instance_ids] + local_ys * bbox_ws[instance_ids] + local_xs] = 1
+
+        return cls(bboxes, crops, offsets, (h, w))
+
+    @classmethod
+    def from_dense(cls, masks):
+        """
+        Args:
+            masks (torch.Tensor or np.ndarray): NxHxW binary masks
+        Output:
+            instance_masks (InstanceMasks)
+        """
+
+        if isinstance(masks, np.ndarray):
+            masks = torch.from_numpy(masks)
+
+        n, h, w = masks.shape
+        instance_ids, ys, xs = torch.where(masks != 0)
+
+        return cls.from_pixels(instance_ids, ys, xs, n, (h, w))
+
+    @classmethod
+    def from_label_map(cls, label_map, num_of_labels):
+        """
+        Args:
+            label_map (torch.Tensor or np.ndarray): BxHxW labels (0 = background,
+                1 to num_of_labels = instances), e.g. from scipy.ndimage.label
+            num_of_labels (int): N
+        Output:
+            instance_masks (InstanceMasks)
+            sample_ids (torch.Tensor): N sample (B) of each instance
+        """
+
+        if isinstance(label_map, np.ndarray):
+            label_map = torch.from_numpy(label_map)
+
+        b, h, w = label_map.shape
+        sample_ids, ys, xs = torch.where(label_map != 0)
+        instance_ids = label_map[sample_ids, ys, xs].long() - 1
+
+        instance_masks = cls.from_pixels(instance_ids, ys, xs, num_of_labels, (h, w))
+
+        # Each label is within a single sample
+        instance_sample_ids = torch.zeros((num_of_labels,), dtype=torch.int64, device=label_map.device)
+        instance_sample_ids[instance_ids] = sample_ids
+
+        return instance_masks, instance_sample_ids
+
+    @classmethod
+    def cat(cls, list_of_instance_masks):
+
+        # Shifting the offsets of each container
+        offsets = [torch.zeros((1,), dtype=torch.int64, device=list_of_instance_masks[0].device)]
+        for instance_masks in list_of_instance_masks:
+            offsets.append(instance_masks.offsets[1:] + offsets[-1][-1])
+
+        return cls(
+            torch.cat([x.bboxes for x in list_of_instance_masks], dim=0),
+            torch.cat([x.crops for x in list_of_instance_masks], dim=0),
+            torch.cat(offsets, dim=0),
+            list_of_instance_masks[0].image_shape
+        )
+
+    #---------------------------------------------------------------------------
+    # Container
+
+    def __len__(self):
+        return self.bboxes.shape[0]
+
+    @property
+    def shape(self):
+        return (len(self), *self.image_shape)
+
+    @property
+    def device(self):
+        return self.crops.device
+
+    def __getitem__(self, ids):
+        """
+        Args:
+            ids (torch.Tensor, list, slice or int): instances to select
+        Output:
+            instance_masks (InstanceMasks): the selected instances
+        """
+
+        if isinstance(ids, slice):
+            ids = torch.arange(len(self), device=self.device)[ids]
+        elif isinstance(ids, torch.Tensor) and ids.dtype == torch.bool:
+            ids = torch.where(ids)[0]
+        else:
+            ids = torch.as_tensor(ids, dtype=torch.int64, device=self.device).reshape((-1,))
+
+        # Gathering the crops of the selected instances
+        sizes = self.offsets[ids+1] - self.offsets[ids]
+        offsets = torch.zeros((ids.shape[0]+1,), dtype=torch.int64, device=self.device)
+        offsets[1:] = torch.cumsum(sizes, dim=0)
+
+        crop_ids = torch.repeat_interleave(self.offsets[ids] - offsets[:-1], sizes)
+        crop_ids += torch.arange(crop_ids.shape[0], device=self.device)
+
+        return InstanceMasks(self.bboxes[ids], self.crops[crop_ids], offsets, self.image_shape)
+
+    def to(self, *args, **kwargs):
+        return InstanceMasks(
+            self.bboxes.to(*args, **kwargs),
+            self.crops.to(*args, **kwargs),
+            self.offsets.to(*args, **kwargs),
+            self.image_shape
+        )
+
+    def cpu(self):
+        return self.to('cpu')
+
+    def pin_memory(self):
+        return InstanceMasks(
+            self.bboxes.pin_memory(),
+            self.crops.pin_memory(),
+            self.offsets.pin_memory(),
+            self.image_shape
+        )
+
+    def __repr__(self):
+        return f'InstanceMasks(n={len(self)}, image_shape={self.image_shape}, crop_bytes={self.crops.shape[0]}, device={self.device})'
+
+    #---------------------------------------------------------------------------
+    # Accessors
+
+    def areas(self):
+        """
+        Output:
+            areas (torch.Tensor): N int64 number of pixels of each mask
+        """
+
+        # Summing the crops per instance
+        cumsum = torch.zeros((self.crops.shape[0]+1,), dtype=torch.int64, device=self.device)
+        cumsum[1:] = torch.cumsum(self.crops, dim=0)
+
+        return cumsum[self.offsets[1:]] - cumsum[self.offsets[:-1]]
+
+    def pixel_indices(self):
+        """
+        Output:
+            instance_ids (torch.Tensor): P instance id of each pixel
+            ys, xs (torch.Tensor): P coordinates of each pixel in the image
+        """
+
+        crop_ids = torch.where(self.crops != 0)[0]
+
+        # Locating the instance of each pixel within the flat buffer
+        instance_ids = torch.searchsorted(self.offsets[1:].contiguous(), crop_ids, right=True)
+        local_ids = crop_ids - self.offsets[instance_ids]
+        bbox_ws = (self.bboxes[:,3] - self.bboxes[:,1])[instance_ids]
+
+        ys = self.bboxes[instance_ids,0] + local_ids // bbox_ws
+        xs = self.bboxes[instance_ids,1] + local_ids % bbox_ws
+
+        return instance_ids, ys, xs
+
+    def crop_index(self, instance_ids, ys, xs):
+        """
+        Args:
+            instance_ids (torch.Tensor): K instance id of each pixel
+            ys, xs (torch.Tensor): K coordinates in the image (within the bboxes)
+        Output:
+            crop_ids (torch.Tensor): K positions of the pixels in the crops buffer
+        """
+
+        bboxes = self.bboxes[instance_ids]
+        bbox_ws = bboxes[:,3] - bboxes[:,1]
+
+        return self.offsets[instance_ids] + (ys - bboxes[:,0]) * bbox_ws + (xs - bboxes[:,1])
+
+    def pixel_coords(self, i):
+        """
+        Output:
+            pts (torch.Tensor): Kx2 [y, x] pixels of the i-th mask
+        """
+
+        y0, x0, y1, x1 = self.bboxes[i].tolist()
+        crop = self.crops[self.offsets[i]:self.offsets[i+1]].reshape((y1-y0, x1-x0))
+        pts = torch.stack(torch.where(crop), dim=1)
+        pts += torch.tensor([y0, x0], device=self.device)
+
+        return pts
+
+    def get_crop(self, i):
+        """
+        Output:
+            crop (torch.Tensor): (y1-y0)x(x1-x0) uint8 crop of the i-th mask
+        """
+
+        y0, x0, y1, x1 = self.bboxes[i].tolist()
+
+        return self.crops[self.offsets[i]:self.offsets[i+1]].reshape((y1-y0, x1-x0))
+
+    def crop(self, y0, x0, h, w):
+        """
+        Args:
+            y0, x0 (int): top-left corner of the window
+            h, w (int): size of the window
+        Output:
+            instance_masks (InstanceMasks): the N masks within the window (the
+                masks outside of it are empty)
+        """
+
+        instance_ids, ys, xs = self.pixel_indices()
+        is_inside = (ys >= y0) & (ys < y0 + h) & (xs >= x0) & (xs < x0 + w)
+
+        return InstanceMasks.from_pixels(
+            instance_ids[is_inside], 
+            ys[is_inside] - y0, 
+            xs[is_inside] - x0, 
+            len(self), 
+            (h, w)
+        )
+
+    def to_dense(self, ids=None):
+        """
+        Args:
+            ids (int, or see __getitem__): the instances to densify, None for all
+        Output:
+            masks (torch.Tensor): NxHxW (or HxW if ids is an int) bool masks
+        """
+
+        if isinstance(ids, int):
+            mask = torch.zeros(self.image_shape, dtype=torch.bool, device=self.device)
+            y0, x0, y1, x1 = self.bboxes[ids].tolist()
+            mask[y0:y1, x0:x1] = self.get_crop(ids) != 0
+            return mask
+
+        instance_masks = self if ids is None else self[ids]
+        masks = torch.zeros(instance_masks.shape, dtype=torch.bool, device=self.device)
+        masks[instance_masks.pixel_indices()] = True
+
+        return masks
+
+    def iou(self, other):
+        """
+        Args:
+            other (InstanceMasks): M masks
+        Output:
+            iou (torch.Tensor): NxM 2D IoU between the masks
+        """
+
+        areas1 = self.areas()
+        areas2 = other.areas()
+
+        # Only the pairs with overlapping bounding boxes can intersect
+        y0 = torch.max(self.bboxes[:,None,0], other.bboxes[None,:,0])
+        x0 = torch.max(self.bboxes[:,None,1], other.bboxes[None,:,1])
+        y1 = torch.min(self.bboxes[:,None,2], other.bboxes[None,:,2])
+        x1 = torch.min(self.bboxes[:,None,3], other.bboxes[None,:,3])
+        pair_is, pair_js = torch.where((y1 > y0) & (x1 > x0))
+
+        # Enumerating the pixels of all the overlap windows at once (batched,
+        # no per pair loop and host sync)
+        pair_y0s, pair_x0s = y0[pair_is, pair_js], x0[pair_is, pair_js]
+        pair_ws = x1[pair_is, pair_js] - pair_x0s
+        pair_sizes = (y1[pair_is, pair_js] - pair_y0s) * pair_ws
+
+        pair_ids = torch.repeat_interleave(torch.arange(pair_sizes.shape[0], device=self.device), pair_sizes)
+        local_ids = torch.arange(pair_ids.shape[0], device=self.device) - (torch.cumsum(pair_sizes, dim=0) - pair_sizes)[pair_ids]
+        ys = pair_y0s[pair_ids] + local_ids // pair_ws[pair_ids]
+        xs = pair_x0s[pair_ids] + local_ids % pair_ws[pair_ids]
+        i, j = pair_is[pair_ids], pair_js[pair_ids]
+
+        # Values of both crops at each window pixel
+        values1 = self.crops[self.crop_index(i, ys, xs)]
+        values2 = other.crops[other.crop_index(j, ys, xs)]
+
+        intersection = torch.zeros((len(self) * len(other),), dtype=torch.int64, device=self.device).index_add(
+            0, i * len(other) + j, (values1 & values2).long()
+        ).reshape((len(self), len(other)))
+
+        union = areas1[:,None] + areas2[None,:] - intersection
+
+        return intersection.float() / union.float()
+
+    #---------------------------------------------------------------------------
+    # Run-length encoding (storage)
+
+    def to_rle(self):
+        """
+        Objective:
+            Run-length encode the crops (alternating 0 and 1 runs, starting with
+            0), which is smaller than the crops for storing masks on disk
+        Output:
+            rle (dict): numpy arrays bboxes, runs, run_offsets and image_shape
+        """
+
+        bboxes = self.bboxes.cpu().numpy()
+        crops = self.crops.cpu().numpy()
+        offsets = self.offsets.cpu().numpy()
+
+        all_runs = []
+        run_offsets = np.zeros((len(self)+1,), dtype=np.int64)
+
+        for i in range(len(self)):
+
+            crop = crops[offsets[i]:offsets[i+1]]
+
+            # Positions where the value changes (plus start and end)
+            changes = np.where(np.diff(crop) != 0)[0] + 1
+            boundaries = np.concatenate([[0], changes, [crop.shape[0]]])
+            runs = np.diff(boundaries)
+
+            # Always starting with a run of zeros
+            if crop.shape[0] > 0 and crop[0] == 1:
+                runs = np.concatenate([[0], runs])
+
+            all_runs.append(runs.astype(np.int64))
+            run_offsets[i+1] = run_offsets[i] + runs.shape[0]
+
+        return {
+            'bboxes': bboxes,
+            'runs': np.concatenate(all_runs) if all_runs else np.zeros((0,), dtype=np.int64),
+            'run_offsets': run_offsets,
+            'image_shape': np.array(self.image_shape)
+        }
+
+    @classmethod
+    def from_rle(cls, rle):
+
+        bboxes = rle['bboxes']
+        runs = rle['runs']
+        run_offsets = rle['run_offsets']
+
+        crops = []
+        for i in range(bboxes.shape[0]):
+            instance_runs = runs[run_offsets[i]:run_offsets[i+1]]
+            values = np.arange(instance_runs.shape[0]) % 2
+            crops.append(np.repeat(values, instance_runs).astype(np.uint8))
+
+        sizes = (bboxes[:,2] - bboxes[:,0]) * (bboxes[:,3] - bboxes[:,1])
+        offsets = np.concatenate([[0], np.cumsum(sizes)]).astype(np.int64)
+
+        return cls(
+            torch.from_numpy(bboxes.astype(np.int64)),
+            torch.from_numpy(np.concatenate(crops) if crops else np.zeros((0,), dtype=np.uint8)),
+            torch.from_numpy(offsets),
+            tuple(rle['image_shape'])
+        )
+
+#-------------------------------------------------------------------------------
+# Functions
+
+def test_instance_masks():
+
+    # Random dense masks
+    rng = np.random.RandomState(0)
+    dense_masks = np.zeros((4, 48, 64), dtype=bool)
+    for i in range(3): # The last mask is empty
+        y, x = rng.randint(0, 30), rng.randint(0, 40)
+        dense_masks[i, y:y+15, x:x+20] = rng.rand(15, 20) > 0.3
+
+    instance_masks = InstanceMasks.from_dense(dense_masks)
+    torch_masks = torch.from_numpy(dense_masks)
+
+    # Dense conversion, areas and indexing
+    assert (instance_masks.to_dense() == torch_masks).all()
+    assert (instance_masks.to_dense(1) == torch_masks[1]).all()
+    assert (instance_masks.areas() == torch_masks.sum(dim=(1,2))).all()
+    assert (instance_masks[[2,0]].to_dense() == torch_masks[[2,0]]).all()
+    assert (InstanceMasks.cat([instance_masks, instance_masks[1:]]).to_dense() == torch.cat([torch_masks, torch_masks[1:]])).all()
+    assert (InstanceMasks.from_rle(instance_masks.to_rle()).to_dense() == torch_masks).all()
+    assert (instance_masks.crop(10, 20, 16, 32).to_dense() == torch_masks[:, 10:26, 20:52]).all()
+
+    # IoU against the dense computation
+    intersection = (torch_masks[:,None] & torch_masks[None]).sum(dim=(2,3)).float()
+    union = (torch_masks[:,None] | torch_masks[None]).sum(dim=(2,3)).float()
+    dense_iou = intersection / union
+    compact_iou = instance_masks.iou(instance_masks)
+    assert torch.allclose(compact_iou[:3,:3], dense_iou[:3,:3])
+
+    # IoU between different sets of masks (partial overlaps)
+    shifted_masks = np.roll(dense_masks[:3], (3, 5), axis=(1,2))
+    torch_shifted_masks = torch.from_numpy(shifted_masks)
+    intersection = (torch_masks[:3,None] & torch_shifted_masks[None]).sum(dim=(2,3)).float()
+    union = (torch_masks[:3,None] | torch_shifted_masks[None]).sum(dim=(2,3)).float()
+    compact_iou = instance_masks[:3].iou(InstanceMasks.from_dense(shifted_masks))
+    assert torch.allclose(compact_iou, intersection / union)
+
+    print(instance_masks)
+    print('Dense bytes: ', dense_masks.size * 4, ' Compact bytes: ', instance_masks.crops.shape[0])
+
+#-------------------------------------------------------------------------------
+# Main Code
+
+if __name__ == '__main__':
+
+    test_instance_masks()
@@ -1,5 +1,9 @@
 import json
+import time
+import struct
 import pathlib
+import argparse
+import tqdm
 
 import numpy as np
 
@@ -80,3 +84,237 @@ def load_from_json(file_path):
 
     
 
+
+#-------------------------------------------------------------------------------
+# Binary meta+ format
+
+# The _meta+.bin files contain the same data as the _meta+.json files, with a
+# 16 byte header (magic, version, number of instances, reserved) followed by a
+# fixed-dtype record per instance (little-endian, see META_DTYPE).
+
+META_BIN_MAGIC = b'NOCSMETA'
+META_BIN_VERSION = 1
+META_BIN_HEADER = struct.Struct('<8sHHI')
+
+META_DTYPE = np.dtype([
+    ('instance_id', '<u1'),
+    ('class_id', '<u1'),
+    ('RT', '<f8', (4,4)),
+    ('quaternion', '<f8', (4,)),
+    ('scale', '<f8', (3,)),
+    ('norm_factor', '<f8')
+])
+
+def meta_data_to_array(data):
+    """
+    Args:
+        data (dict): meta+ data (instance_dict, scales, RTs, norm_factors and
+            quaternions)
+    Output:
+        meta_array (np.ndarray): META_DTYPE array with one entry per instance
+    """
+
+    instance_dict = data['instance_dict']
+    meta_array = np.zeros((len(instance_dict),), dtype=META_DTYPE)
+
+    for enumerate_id, (instance_id, class_id) in enumerate(instance_dict.items()):
+        meta_array[enumerate_id]['instance_id'] = int(instance_id)
+        meta_array[enumerate_id]['class_id'] = class_id
+        meta_array[enumerate_id]['RT'] = data['RTs'][enumerate_id]
+        meta_array[enumerate_id]['quaternion'] = data['quaternions'][enumerate_id]
+        meta_array[enumerate_id]['scale'] = data['scales'][enumerate_id]
+        meta_array[enumerate_id]['norm_factor'] = data['norm_factors'][enumerate_id]
+
+    return meta_array
+
+def array_to_meta_data(meta_array):
+    """
+    Args:
+        meta_array (np.ndarray): META_DTYPE array of a single sample
+    Output:
+        data (dict): meta+ data matching the layout of load_from_json
+    """
+
+    return {
+        'instance_dict': {str(x):int(y) for x,y in zip(meta_array['instance_id'], meta_array['class_id'])},
+        'scales': meta_array['scale'],
+        'RTs': meta_array['RT'],
+        'norm_factors': meta_array['norm_factor'],
+        'quaternions': meta_array['quaternion']
+    }
+
+def save_to_meta_bin(file_path, data):
+    """
+    Saving meta+ data into a binary meta+ file.
+    Input:
+        file_path: (the destination file)
+        data: the meta+ data
+    Output:
+        None
+    """
+
+    # catching possible pathlib.Path object
+    if isinstance(file_path, str) is False:
+        file_path = str(file_path)
+
+    # checking if file_path is a binary meta file
+    assert file_path.endswith('.bin'), 'Given file_path is invalid for saving into binary meta file'
+
+    with open(file_path, 'wb') as outfile:
+        outfile.write(encode_meta_bin(data))
+
+def load_from_meta_bin(file_path):
+    """
+    Loading meta+ data from a binary meta+ file.
+    Input:
+        file_path: (the source file)
+    Output:
+        data: the loaded meta+ data
+    """
+
+    # catching possible pathlib.Path object
+    if isinstance(file_path, str) is False:
+        file_path = str(file_path)
+
+    with open(file_path, 'rb') as infile:
+        buffer = infile.read()
+
+    try:
+        return decode_meta_bin(buffer)
+    except RuntimeError:
+        raise RuntimeError(f'Invalid binary meta file: {file_path}')
+
+def encode_meta_bin(data):
+    """
+    Input:
+        data: the meta+ data
+    Output:
+        buffer: the contents of a binary meta+ file (bytes)
+    """
+
+    meta_array = meta_data_to_array(data)
+    header = META_BIN_HEADER.pack(META_BIN_MAGIC, META_BIN_VERSION, meta_array.shape[0], 0)
+
+    return header + meta_array.tobytes()
+
+def decode_meta_bin(buffer):
+    """
+    Input:
+        buffer: the contents of a binary meta+ file (bytes)
+    Output:
+        data: the meta+ data
+    """
+
+    magic, version, num_of_instances, _ = META_BIN_HEADER.unpack_from(buffer)
+
+    if magic != META_BIN_MAGIC or version != META_BIN_VERSION:
+        raise RuntimeError('Invalid binary meta+ data')
+
+    meta_array = np.frombuffer(buffer, dtype=META_DTYPE, count=num_of_instances, offset=META_BIN_HEADER.size)
+
+    return array_to_meta_data(meta_array)
+
+def get_meta_plus_path(color_path):
+    """
+    Output:
+        meta_plus_path: the _meta+.bin of the color image if available, else
+            the _meta+.json (or None if neither exists)
+    """
+
+    for suffix in ['_meta+.bin', '_meta+.json']:
+        meta_plus_path = pathlib.Path(str(color_path).replace('_color.png', suffix))
+        if meta_plus_path.exists():
+            return meta_plus_path
+
+    return None
+
+def load_meta_plus(color_path):
+    """
+    Loading the meta+ data of a color image, preferring the binary format.
+    Input:
+        color_path: the _color.png of the sample
+    Output:
+        data: the loaded meta+ data
+    """
+
+    meta_plus_path = get_meta_plus_path(color_path)
+
+    if meta_plus_path is None:
+        raise FileNotFoundError(f'No meta+ data for {color_path}')
+
+    return load_meta_plus_file(meta_plus_path)
+
+def load_meta_plus_file(meta_plus_path):
+    """
+    Input:
+        meta_plus_path: a _meta+.bin or _meta+.json file
+    Output:
+        data: the loaded meta+ data
+    """
+
+    if pathlib.Path(meta_plus_path).suffix == '.bin':
+        return load_from_meta_bin(meta_plus_path)
+    else:
+        return load_from_json(meta_plus_path)
+
+def convert_meta_json_to_bin(dataset_dir, overwrite=False):
+    """
+    Objective:
+        Create the _meta+.bin of every _meta+.json inside the dataset_dir
+    Output:
+        num_of_converted (int): number of created binary meta files
+    """
+
+    num_of_converted = 0
+
+    for json_path in tqdm.tqdm(sorted(pathlib.Path(dataset_dir).rglob('*_meta+.json'))):
+
+        bin_path = json_path.with_suffix('.bin')
+
+        if bin_path.exists() and not overwrite:
+            continue
+
+        save_to_meta_bin(bin_path, load_from_json(json_path))
+        num_of_converted += 1
+
+    return num_of_converted
+
+def test_meta_loading_performance(color_paths):
+
+    json_paths = [str(x).replace('_color.png', '_meta+.json') for x in color_paths]
+    bin_paths = [str(x).replace('_color.png', '_meta+.bin') for x in color_paths]
+
+    # Both formats need to contain the same data
+    for json_path, bin_path in zip(json_paths, bin_paths):
+        json_data = load_from_json(json_path)
+        bin_data = load_from_meta_bin(bin_path)
+        assert json_data['instance_dict'] == bin_data['instance_dict']
+        for key in ['scales', 'RTs', 'norm_factors', 'quaternions']:
+            assert np.allclose(np.asarray(json_data[key]), bin_data[key])
+
+    for name, load_function, paths in [('json', load_from_json, json_paths), ('bin', load_from_meta_bin, bin_paths)]:
+        tic = time.time()
+        for path in paths:
+            load_function(path)
+        toc = time.time()
+        print(f'{name}: {(toc-tic)/len(paths)*1000:.3f} ms/sample')
+
+#-------------------------------------------------------------------------------
+# Main Code
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Convert the _meta+.json files of a dataset into _meta+.bin')
+    parser.add_argument('DATASET_DIR', type=str)
+    parser.add_argument('--OVERWRITE', action='store_true')
+    parser.add_argument('--BENCHMARK_SIZE', type=int, default=1000)
+    args = parser.parse_args()
+
+    num_of_converted = convert_meta_json_to_bin(args.DATASET_DIR, args.OVERWRITE)
+    print(f'Converted: {num_of_converted}')
+
+    # Comparing the loading time of both formats
+    color_paths = sorted(pathlib.Path(args.DATASET_DIR).rglob('*_color.png'))[:args.BENCHMARK_SIZE]
+    color_paths = [x for x in color_paths if pathlib.Path(str(x).replace('_color.png', '_meta+.json')).exists()]
+    if color_paths:
+        test_meta_loading_performance(color_paths)
@@ -0,0 +1,347 @@
+import os
+import sys
+import pathlib
+import collections
+import logging
+import argparse
+import tqdm
+
+import numpy as np
+
+# Local Imports
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import json_tools as jt
+import data_manipulation as dm
+import project as pj
+
+#-------------------------------------------------------------------------------
+# File Constants
+
+MANIFEST_FILENAME = '.nocs_manifest.npz'
+MANIFEST_VERSION = 1
+
+# Instance class ids are the indices of the CAMERA_CLASSES (REAL shares them)
+NUM_OF_CLASSES = len(pj.constants.CAMERA_CLASSES)
+
+SUBSET_STRATEGIES = ['ordered', 'random', 'stratified']
+
+LOGGER = logging.getLogger('fastposecnn')
+
+#-------------------------------------------------------------------------------
+# Manifest Creation
+
+def scan_directory(dir_path):
+    """
+    Args:
+        dir_path (pathlib object): directory to scan (not recursive)
+    Objective:
+        List the color images of the directory and summarize their meta+ data,
+        with a single iterdir() call
+    Output:
+        entry (dict): the directory's mtime, subdirectories, color image names,
+            per-class instance counts and per-class counts of instances with
+            an invalid depth (z <= 0)
+    """
+
+    # Reading the mtime before the listing, so that any change during the
+    # scan invalidates the directory in the next run
+    mtime = dir_path.stat().st_mtime_ns
+
+    children = sorted(dir_path.iterdir())
+    subdirs = [x.name for x in children if x.is_dir()]
+    color_images = [x for x in children if x.name.find('color') != -1 and x.suffix == '.png' and x.is_file()]
+
+    class_counts = np.zeros((len(color_images), NUM_OF_CLASSES), dtype=np.uint8)
+    invalid_z_counts = np.zeros((len(color_images), NUM_OF_CLASSES), dtype=np.uint8)
+
+    for i, color_image in enumerate(color_images):
+
+        meta_plus_path = jt.get_meta_plus_path(color_image)
+
+        # Samples without meta+ data are kept with no instances (never selected)
+        if meta_plus_path is None:
+            continue
+
+        json_data = jt.load_meta_plus(color_image)
+
+        for enumerate_id, class_id in enumerate(json_data['instance_dict'].values()):
+            class_counts[i, class_id] += 1
+
+            # Same validity check as NOCSDataset.process_raw_sample
+            if dm.extract_z_from_RT(json_data['RTs'][enumerate_id]) <= 0:
+                invalid_z_counts[i, class_id] += 1
+
+    return {
+        'mtime': mtime,
+        'subdirs': subdirs,
+        'names': [x.name for x in color_images],
+        'class_counts': class_counts,
+        'invalid_z_counts': invalid_z_counts
+    }
+
+def manifest_to_dir_entries(manifest):
+    """
+    Objective:
+        Regroup the flat manifest arrays per directory, to reuse the entries of
+        the directories that did not change
+    Output:
+        dir_entries (dict): relative directory -> scan_directory-like entry
+    """
+
+    dirs = manifest['dirs']
+    parent_ids = manifest['dir_parent_ids']
+
+    # Recovering the subdirectories of each directory
+    subdirs = collections.defaultdict(list)
+    for dir_id, parent_id in enumerate(parent_ids):
+        if parent_id >= 0:
+            subdirs[parent_id].append(pathlib.PurePath(dirs[dir_id]).name)
+
+    # Splitting the samples by directory (samples are stored contiguously)
+    dir_starts = np.searchsorted(manifest['path_dir_ids'], np.arange(len(dirs) + 1))
+
+    dir_entries = {}
+    for dir_id, dir_name in enumerate(dirs):
+        start, end = dir_starts[dir_id], dir_starts[dir_id+1]
+        dir_entries[dir_name] = {
+            'mtime': manifest['dir_mtimes'][dir_id],
+            'subdirs': subdirs[dir_id],
+            'names': [pathlib.PurePath(x).name for x in manifest['paths'][start:end]],
+            'class_counts': manifest['class_counts'][start:end],
+            'invalid_z_counts': manifest['invalid_z_counts'][start:end]
+        }
+
+    return dir_entries
+
+def is_entry_changed(previous_entry, entry):
+
+    return (
+        list(previous_entry['subdirs']) != list(entry['subdirs']) or
+        list(previous_entry['names']) != list(entry['names']) or
+        not np.array_equal(previous_entry['class_counts'], entry['class_counts']) or
+        not np.array_equal(previous_entry['invalid_z_counts'], entry['invalid_z_counts'])
+    )
+
+def build_manifest(dataset_dir, previous_manifest=None):
+    """
+    Args:
+        dataset_dir (pathlib object): root directory of the dataset split
+        previous_manifest (dict): manifest to reuse for unchanged directories
+    Objective:
+        Walk the dataset breadth-first and only rescan the directories whose
+        mtime changed (or that are new)
+    Output:
+        manifest (dict): flat arrays, where the samples are stored in BFS order
+    """
+
+    dataset_dir = pathlib.Path(dataset_dir)
+
+    previous_entries = {}
+    if previous_manifest is not None:
+        previous_entries = manifest_to_dir_entries(previous_manifest)
+
+    dirs, dir_parent_ids, dir_mtimes = [], [], []
+    paths, path_dir_ids, class_counts, invalid_z_counts = [], [], [], []
+    num_of_rescanned_dirs = 0
+
+    # (relative directory, parent id)
+    eval_paths = collections.deque([('.', -1)])
+
+    with tqdm.tqdm(desc='manifest', unit='dir', disable=previous_manifest is not None) as pbar:
+
+        while eval_paths:
+
+            rel_dir, parent_id = eval_paths.popleft()
+            abs_dir = dataset_dir / rel_dir
+
+            # Reuse the previous entry if the directory did not change
+            previous_entry = previous_entries.get(rel_dir, None)
+            if previous_entry is not None and previous_entry['mtime'] == abs_dir.stat().st_mtime_ns:
+                entry = previous_entry
+            else:
+                entry = scan_directory(abs_dir)
+
+                # Only count actual changes (e.g. writing the manifest itself
+                # changes the mtime of the dataset's root directory)
+                if previous_entry is None or is_entry_changed(previous_entry, entry):
+                    num_of_rescanned_dirs += 1
+
+            dir_id = len(dirs)
+            dirs.append(rel_dir)
+            dir_parent_ids.append(parent_id)
+            dir_mtimes.append(entry['mtime'])
+
+            paths += [str(pathlib.PurePath(rel_dir) / x) for x in entry['names']]
+            path_dir_ids += [dir_id] * len(entry['names'])
+            class_counts.append(entry['class_counts'])
+            invalid_z_counts.append(entry['invalid_z_counts'])
+
+            eval_paths.extend([(str(pathlib.PurePath(rel_dir) / x), dir_id) for x in entry['subdirs']])
+            pbar.update(1)
+
+    LOGGER.debug(f"Manifest of {dataset_dir}: {num_of_rescanned_dirs}/{len(dirs)} directories rescanned")
+
+    manifest = {
+        'version': np.array(MANIFEST_VERSION),
+        'paths': np.array(paths, dtype=str),
+        'path_dir_ids': np.array(path_dir_ids, dtype=np.int64),
+        'class_counts': np.concatenate(class_counts, axis=0),
+        'invalid_z_counts': np.concatenate(invalid_z_counts, axis=0),
+        'dirs': np.array(dirs, dtype=str),
+        'dir_parent_ids': np.array(dir_parent_ids, dtype=np.int64),
+        'dir_mtimes': np.array(dir_mtimes, dtype=np.int64)
+    }
+
+    return manifest, num_of_rescanned_dirs
+
+def save_manifest(manifest_path, manifest):
+
+    # Writing into a temporary file and then renaming it, to avoid partially
+    # written manifests when several processes start at the same time
+    tmp_path = manifest_path.with_name(f'{manifest_path.name}.{os.getpid()}.tmp')
+
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, **manifest)
+
+    os.replace(tmp_path, manifest_path)
+
+def load_manifest(manifest_path):
+
+    try:
+        with np.load(str(manifest_path)) as data:
+            manifest = {k:data[k] for k in data.files}
+    except (OSError, ValueError, KeyError):
+        return None
+
+    if 'version' not in manifest or int(manifest['version']) != MANIFEST_VERSION:
+        return None
+
+    return manifest
+
+def get_manifest(dataset_dir, manifest_dir=None):
+    """
+    Args:
+        dataset_dir (pathlib object): root directory of the dataset split
+        manifest_dir (pathlib object): where to store the manifest, defaults to
+            the dataset_dir
+    Objective:
+        Load the manifest of the dataset, updating it if any directory changed
+    Output:
+        manifest (dict): see build_manifest
+    """
+
+    dataset_dir = pathlib.Path(dataset_dir)
+    manifest_dir = dataset_dir if manifest_dir is None else pathlib.Path(manifest_dir)
+    manifest_path = manifest_dir / MANIFEST_FILENAME
+
+    previous_manifest = load_manifest(manifest_path) if manifest_path.exists() else None
+    manifest, num_of_rescanned_dirs = build_manifest(dataset_dir, previous_manifest)
+
+    # Only write when something changed
+    if num_of_rescanned_dirs > 0:
+        try:
+            save_manifest(manifest_path, manifest)
+        except OSError as e: # read-only datasets can still be used
+            LOGGER.warning(f"Unable to save the manifest at {manifest_path}: {e}")
+
+    return manifest
+
+#-------------------------------------------------------------------------------
+# Subset Selection
+
+def select_samples(
+    class_counts,
+    invalid_z_counts,
+    class_ids,
+    max_size=None,
+    strategy='ordered',
+    seed=0,
+    exclude_invalid_z=False
+    ):
+    """
+    Args:
+        class_counts (np.ndarray): NxC number of instances per class
+        invalid_z_counts (np.ndarray): NxC number of instances with z <= 0
+        class_ids (list): the selected class ids
+        max_size (int): maximum number of samples
+        strategy (str): 'ordered' (first samples, BFS order), 'random' (uniform
+            random subset) or 'stratified' (round-robin over the selected
+            classes, so that each class appears in a similar number of samples)
+        seed (int): seed of the random and stratified strategies
+        exclude_invalid_z (bool): remove the samples with invalid instances
+    Output:
+        sample_ids (np.ndarray): the selected sample ids, in ascending order
+    """
+
+    if strategy not in SUBSET_STRATEGIES:
+        raise RuntimeError(f'Invalid subset strategy: {strategy}, options: {SUBSET_STRATEGIES}')
+
+    class_ids = np.array(class_ids, dtype=np.int64)
+
+    # Samples with at least one instance of the selected classes
+    selected_class_counts = class_counts[:, class_ids]
+    is_candidate = selected_class_counts.sum(axis=1) > 0
+
+    if exclude_invalid_z:
+        is_candidate &= invalid_z_counts[:, class_ids].sum(axis=1) == 0
+
+    candidate_ids = np.where(is_candidate)[0]
+
+    if max_size is None or max_size >= candidate_ids.shape[0]:
+        return candidate_ids
+
+    rng = np.random.RandomState(seed)
+
+    if strategy == 'ordered':
+        return candidate_ids[:max_size]
+
+    elif strategy == 'random':
+        return np.sort(rng.choice(candidate_ids, size=max_size, replace=False))
+
+    # Stratified: each class takes turns picking from its shuffled samples
+    queues = [
+        rng.permutation(candidate_ids[selected_class_counts[candidate_ids, i] > 0])
+        for i in range(class_ids.shape[0])
+    ]
+    queues = [x for x in queues if x.shape[0] > 0]
+    queue_positions = [0] * len(queues)
+
+    is_taken = np.zeros((class_counts.shape[0],), dtype=bool)
+    sample_ids = []
+
+    while len(sample_ids) < max_size:
+        for queue_id, queue in enumerate(queues):
+
+            # Skipping the samples already taken by other classes
+            while queue_positions[queue_id] < queue.shape[0] and is_taken[queue[queue_positions[queue_id]]]:
+                queue_positions[queue_id] += 1
+
+            if queue_positions[queue_id] < queue.shape[0]:
+                sample_id = queue[queue_positions[queue_id]]
+                is_taken[sample_id] = True
+                sample_ids.append(sample_id)
+
+            if len(sample_ids) >= max_size:
+                break
+
+    return np.sort(np.array(sample_ids, dtype=np.int64))
+
+#-------------------------------------------------------------------------------
+# Main Code
+
+if __name__ == '__main__':
+
+    # Importing the dataset also loads the environmental variables
+    import dataset as ds
+
+    parser = argparse.ArgumentParser(description='Create/update the manifest of a NOCS split')
+    parser.add_argument('--DATASET_NAME', type=str, default='CAMERA', choices=['CAMERA', 'REAL'])
+    parser.add_argument('--SPLIT', type=str, default='TRAIN', choices=['TRAIN', 'VALID', 'TEST'])
+    args = parser.parse_args()
+
+    manifest = get_manifest(pathlib.Path(os.getenv(f'NOCS_{args.DATASET_NAME}_{args.SPLIT}_DATASET')))
+
+    print(f"Samples: {manifest['paths'].shape[0]}, directories: {manifest['dirs'].shape[0]}")
+    print(f"Instances per class: {manifest['class_counts'].sum(axis=0)}")
+    print(f"Samples with invalid z: {(manifest['invalid_z_counts'].sum(axis=1) > 0).sum()}")
@@ -0,0 +1,202 @@
+import os
+import sys
+import pathlib
+import shutil
+import argparse
+import multiprocessing
+import tqdm
+
+import numpy as np
+import cv2
+import skimage.io
+
+# Local Imports
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import json_tools as jt
+
+#-------------------------------------------------------------------------------
+# File Constants
+
+# Supported downsampling factors of the dataset pyramid
+RESOLUTION_SCALES = [1.0, 0.5, 0.25]
+
+# The scaled images are padded (bottom and right) to a multiple of the
+# encoders' output stride, so that the decoders' skip connections match
+PAD_MULTIPLE = 32
+
+# Resampling and padding value of each image type of a sample
+IMAGE_TYPES = {
+    '_color.png': (cv2.INTER_AREA, 0),
+    '_mask.png': (cv2.INTER_NEAREST, 255), # 255 = background
+    '_depth.png': (cv2.INTER_NEAREST, 0)
+}
+
+#-------------------------------------------------------------------------------
+# Functions
+
+def check_resolution_scale(scale):
+
+    if scale not in RESOLUTION_SCALES:
+        raise RuntimeError(f'Invalid resolution scale {scale}, available: {RESOLUTION_SCALES}')
+
+def get_scaled_path(path, scale):
+    """
+    Args:
+        path (pathlib object): directory of a split (dataset, shards or tars)
+        scale (float): the resolution scale
+    Output:
+        scaled_path (pathlib object): the directory of the scaled variant (the
+            same directory for the full resolution)
+    """
+
+    check_resolution_scale(scale)
+    path = pathlib.Path(path)
+
+    if scale == 1.0:
+        return path
+
+    return path.parent / f'{path.name}_{scale:g}x'
+
+def scale_intrinsics(intrinsics, scale):
+    """
+    Args:
+        intrinsics (np.ndarray): 3x3 camera intrinsics at full resolution
+        scale (float): the resolution scale
+    Output:
+        scaled_intrinsics (np.ndarray): 3x3 intrinsics of the resized images
+            (pixel centers are at the integer coordinates, the padding does
+            not move the principal point)
+    """
+
+    scaled_intrinsics = np.array(intrinsics, dtype=np.float64)
+    scaled_intrinsics[0,0] *= scale
+    scaled_intrinsics[1,1] *= scale
+    scaled_intrinsics[:2,2] = (scaled_intrinsics[:2,2] + 0.5) * scale - 0.5
+
+    return scaled_intrinsics
+
+def get_scaled_image_size(image_size, scale):
+    """
+    Args:
+        image_size (tuple): (H, W) at full resolution
+        scale (float): the resolution scale
+    Output:
+        scaled_image_size (tuple): (H, W) of the resized and padded images,
+            e.g. (256, 320) for (480, 640) at 0.5
+    """
+
+    return tuple(int(round(x * scale)) + (-int(round(x * scale))) % PAD_MULTIPLE for x in image_size)
+
+def resize_image(image, scale, interpolation, pad_value):
+    """
+    Args:
+        image (np.ndarray): HxW or HxWxC image
+        scale (float): the resolution scale
+        interpolation (int): cv2 interpolation flag
+        pad_value (int): value of the bottom and right padding
+    Output:
+        resized_image (np.ndarray): the resized and padded image
+    """
+
+    h, w = image.shape[:2]
+    new_h, new_w = int(round(h * scale)), int(round(w * scale))
+    resized_image = cv2.resize(image, (new_w, new_h), interpolation=interpolation)
+
+    # cv2 drops the single channel dimension
+    if image.ndim == 3 and resized_image.ndim == 2:
+        resized_image = resized_image[:,:,np.newaxis]
+
+    padded_h, padded_w = get_scaled_image_size((h, w), scale)
+    pad_h, pad_w = padded_h - new_h, padded_w - new_w
+
+    if pad_h or pad_w:
+        pad_width = [(0, pad_h), (0, pad_w)] + [(0,0)] * (image.ndim - 2)
+        resized_image = np.pad(resized_image, pad_width, mode='constant', constant_values=pad_value)
+
+    return resized_image
+
+def scale_sample(color_path, dataset_dir, scaled_dataset_dir, scale):
+    """
+    Args:
+        color_path (pathlib object): the _color.png of the sample
+        dataset_dir (pathlib object): the full resolution split
+        scaled_dataset_dir (pathlib object): the destination split
+        scale (float): the resolution scale
+    Objective:
+        Write the resized color, mask and depth images of the sample and copy
+        its meta+ data (the poses do not depend on the resolution, the xy
+        targets are projected with the scaled intrinsics)
+    """
+
+    scaled_color_path = scaled_dataset_dir / color_path.relative_to(dataset_dir)
+    scaled_color_path.parent.mkdir(parents=True, exist_ok=True)
+
+    for suffix, (interpolation, pad_value) in IMAGE_TYPES.items():
+
+        image_path = pathlib.Path(str(color_path).replace('_color.png', suffix))
+        if image_path.exists() is False:
+            continue
+
+        scaled_image_path = pathlib.Path(str(scaled_color_path).replace('_color.png', suffix))
+        image = skimage.io.imread(str(image_path))
+        image = resize_image(image, scale, interpolation, pad_value)
+        skimage.io.imsave(str(scaled_image_path), image, check_contrast=False)
+
+    meta_plus_path = jt.get_meta_plus_path(color_path)
+    if meta_plus_path is not None:
+        shutil.copy2(
+            str(meta_plus_path),
+            str(scaled_color_path.parent / meta_plus_path.name)
+        )
+
+def scale_sample_star(args):
+    return scale_sample(*args)
+
+def create_scaled_dataset(dataset_dir, scale, num_of_workers=4):
+    """
+    Args:
+        dataset_dir (pathlib object): the full resolution split
+        scale (float): the resolution scale
+        num_of_workers (int): number of processes
+    Output:
+        scaled_dataset_dir (pathlib object): the scaled split (see get_scaled_path)
+    """
+
+    dataset_dir = pathlib.Path(dataset_dir)
+    scaled_dataset_dir = get_scaled_path(dataset_dir, scale)
+
+    if scale == 1.0:
+        return scaled_dataset_dir
+
+    color_paths = sorted(dataset_dir.rglob('*_color.png'))
+    tasks = [(x, dataset_dir, scaled_dataset_dir, scale) for x in color_paths]
+
+    with multiprocessing.Pool(num_of_workers) as pool:
+        for _ in tqdm.tqdm(pool.imap_unordered(scale_sample_star, tasks, chunksize=16), total=len(tasks)):
+            pass
+
+    return scaled_dataset_dir
+
+#-------------------------------------------------------------------------------
+# Main Code
+
+if __name__ == '__main__':
+
+    # Importing the dataset also loads the environmental variables
+    import dataset as ds
+
+    parser = argparse.ArgumentParser(description='Create a downsampled variant of a NOCS split')
+    parser.add_argument('--DATASET_NAME', type=str, default='CAMERA', choices=['CAMERA', 'REAL'])
+    parser.add_argument('--SPLIT', type=str, default='TRAIN', choices=['TRAIN', 'VALID', 'TEST'])
+    parser.add_argument('--RESOLUTION_SCALE', type=float, default=0.5)
+    parser.add_argument('--NUM_WORKERS', type=int, default=4)
+    args = parser.parse_args()
+
+    scaled_dataset_dir = create_scaled_dataset(
+        pathlib.Path(os.getenv(f'NOCS_{args.DATASET_NAME}_{args.SPLIT}_DATASET')),
+        args.RESOLUTION_SCALE,
+        args.NUM_WORKERS
+    )
+
+    print(f'Scaled dataset: {scaled_dataset_dir}')
@@ -0,0 +1,375 @@
+import os
+import time
+import math
+import collections
+import concurrent.futures
+import multiprocessing
+import logging
+
+import numpy as np
+import torch
+import torch.utils.data
+
+#-------------------------------------------------------------------------------
+# File Constants
+
+# File types of the records (see NOCSDataset.get_record_paths), the latency
+# stats are kept per type
+FILE_TYPES = ['color', 'mask', 'meta']
+
+# Shared counters: hits, misses, then (count, total ns, max ns) per file type
+NUM_OF_COUNTERS = 2 + 3 * len(FILE_TYPES)
+
+LOGGER = logging.getLogger('fastposecnn')
+
+#-------------------------------------------------------------------------------
+# Classes
+
+class SampleReadahead(object):
+    """Readahead of the raw file bytes of the upcoming samples of each
+    DataLoader worker, for high-latency storage (e.g. NFS).
+
+    The epoch's order of the samples is published by the ReadaheadSampler in
+    shared memory. The DataLoader hands the batches to the workers round-robin
+    (batch k to worker k % num_workers), therefore each worker knows which
+    samples it will load next and fetches their files with a small thread
+    pool. At most depth records are buffered (or in flight) per worker, and
+    the samples are decoded from memory.
+
+    The hit and miss counters and the per-file read latencies are shared
+    memory values of all the processes.
+
+    Args:
+        num_of_samples (int): size of the dataset
+        batch_size (int): batch size of the DataLoader
+        depth (int): maximum number of buffered records per worker
+        num_of_threads (int): number of reading threads per worker
+    """
+
+    def __init__(self, num_of_samples, batch_size, depth=8, num_of_threads=4):
+
+        self.batch_size = batch_size
+        self.depth = depth
+        self.num_of_threads = num_of_threads
+
+        # Shared order of the samples of the current epoch (of this rank, the
+        # first order_length ids)
+        self.order = multiprocessing.Array('q', max(num_of_samples, 1), lock=False)
+        self.order_length = multiprocessing.Value('q', num_of_samples, lock=False)
+        self.epoch = multiprocessing.Value('q', 0)
+
+        # Shared stats
+        self.counters = multiprocessing.Array('q', NUM_OF_COUNTERS)
+
+        # Per-process state, created lazily (see get_pool)
+        self.reset()
+
+    def reset(self):
+        self.pid = None
+        self.pool = None
+        self.buffer = collections.OrderedDict()
+        self.seen_epoch = 0
+        self.positions = None
+
+    def __getstate__(self):
+
+        # Threads and futures are created again by each worker
+        state = self.__dict__.copy()
+        state.update({
+            'pid': None,
+            'pool': None,
+            'buffer': collections.OrderedDict(),
+            'seen_epoch': 0,
+            'positions': None
+        })
+
+        return state
+
+    def publish_order(self, order):
+        """
+        Args:
+            order (list): the sample ids of the epoch, in the sampler's order
+        """
+
+        np.frombuffer(self.order, dtype=np.int64)[:len(order)] = order
+        self.order_length.value = len(order)
+
+        with self.epoch.get_lock():
+            self.epoch.value += 1
+
+    def get_pool(self):
+
+        # Pools inherited from another process (fork) have no threads
+        if self.pid != os.getpid():
+            self.reset()
+            self.pid = os.getpid()
+            self.pool = concurrent.futures.ThreadPoolExecutor(self.num_of_threads)
+
+        return self.pool
+
+    def get_order(self):
+        return np.frombuffer(self.order, dtype=np.int64)[:self.order_length.value]
+
+    def update_positions(self):
+
+        # The positions of the samples within the order of the current epoch
+        epoch = self.epoch.value
+
+        if epoch != self.seen_epoch:
+
+            for future in self.buffer.values():
+                future.cancel()
+            self.buffer.clear()
+
+            order = self.get_order()
+            self.positions = np.full((len(self.order),), -1, dtype=np.int64)
+            self.positions[order] = np.arange(order.shape[0])
+            self.seen_epoch = epoch
+
+    def get_upcoming_ids(self, position):
+        """
+        Args:
+            position (int): the position of the current sample in the order
+        Output:
+            upcoming_ids (list): the next (at most depth) sample ids of this
+                worker, in order
+        """
+
+        worker_info = torch.utils.data.get_worker_info()
+        num_of_workers = 1 if worker_info is None else worker_info.num_workers
+
+        order = self.get_order()
+        num_of_samples = order.shape[0]
+
+        # The rest of the current batch
+        batch_id = position // self.batch_size
+        upcoming_ids = order[position+1:min((batch_id+1) * self.batch_size, num_of_samples)].tolist()
+
+        # Then the next batches of this worker
+        batch_id += num_of_workers
+        while len(upcoming_ids) < self.depth and batch_id * self.batch_size < num_of_samples:
+            upcoming_ids.extend(order[batch_id * self.batch_size:min((batch_id+1) * self.batch_size, num_of_samples)].tolist())
+            batch_id += num_of_workers
+
+        return upcoming_ids[:self.depth]
+
+    def read_record(self, i, get_record_paths):
+        """
+        Args:
+            i (int): sample index
+            get_record_paths (function): sample index -> {record key: file path}
+        Output:
+            record (dict): {record key: file bytes}
+        """
+
+        record = {}
+
+        for key, file_path in get_record_paths(i).items():
+
+            tic = time.perf_counter_ns()
+            with open(file_path, 'rb') as f:
+                record[key] = f.read()
+            latency = time.perf_counter_ns() - tic
+
+            # Per-file latency stats
+            offset = 2 + 3 * FILE_TYPES.index(key.split('.')[0])
+            with self.counters.get_lock():
+                self.counters[offset] += 1
+                self.counters[offset+1] += latency
+                self.counters[offset+2] = max(self.counters[offset+2], latency)
+
+        return record
+
+    def get(self, i, get_record_paths):
+        """
+        Args:
+            i (int): sample index
+            get_record_paths (function): see read_record (must be thread-safe)
+        Objective:
+            Return the record of the sample (from the buffer if it was read
+            ahead) and schedule the reading of the next samples of the worker
+        Output:
+            record (dict): {record key: file bytes}
+        """
+
+        pool = self.get_pool()
+        self.update_positions()
+
+        future = self.buffer.pop(i, None)
+
+        # Scheduling the upcoming samples of this worker (samples that are not
+        # in the epoch's order, e.g. refills, are only read)
+        if self.positions is not None and 0 <= i < self.positions.shape[0] and self.positions[i] >= 0:
+
+            position = self.positions[i]
+
+            # Dropping the records of the samples that were skipped
+            while self.buffer and self.positions[next(iter(self.buffer))] < position:
+                self.buffer.popitem(last=False)[1].cancel()
+
+            for sample_id in self.get_upcoming_ids(position):
+                if len(self.buffer) >= self.depth:
+                    break
+                if sample_id not in self.buffer:
+                    self.buffer[sample_id] = pool.submit(self.read_record, sample_id, get_record_paths)
+
+        with self.counters.get_lock():
+            self.counters[0 if future is not None else 1] += 1
+
+        if future is None:
+            return self.read_record(i, get_record_paths)
+
+        try:
+            return future.result()
+        except OSError as e:
+            # Read again, the error is raised if it persists
+            LOGGER.debug(f'READAHEAD FAILED: {e}')
+            return self.read_record(i, get_record_paths)
+
+    def get_stats(self):
+        """
+        Output:
+            stats (dict): the readahead depth, hits, misses, hit rate and the
+                mean and max read latency (ms) per file type of all the processes
+        """
+
+        with self.counters.get_lock():
+            counters = list(self.counters)
+
+        hits, misses = counters[0], counters[1]
+        stats = {
+            'depth': self.depth,
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': hits / max(hits + misses, 1)
+        }
+
+        for file_id, file_type in enumerate(FILE_TYPES):
+            count, total_ns, max_ns = counters[2+3*file_id:5+3*file_id]
+            stats[f'{file_type}_mean_ms'] = total_ns / max(count, 1) / 1e6
+            stats[f'{file_type}_max_ms'] = max_ns / 1e6
+
+        return stats
+
+class ReadaheadSampler(torch.utils.data.Sampler):
+    """Sampler that publishes the order of each epoch to the SampleReadahead of
+    the dataset (the same orders as the default sequential or random samplers).
+
+    In ddp each rank gets its shard of the order, as the DistributedSampler
+    (same permutation in all the ranks from seed and epoch, padded to a
+    multiple of num_of_replicas), so Lightning must not replace it
+    (replace_sampler_ddp=False).
+
+    Args:
+        readahead (SampleReadahead): the readahead of the dataset (of this rank)
+        num_of_samples (int): size of the dataset
+        shuffle (bool): random order every epoch
+        num_of_replicas (int): number of ranks
+        rank (int): rank of this process
+        seed (int): seed of the permutation in ddp
+    """
+
+    def __init__(self, readahead, num_of_samples, shuffle=True, num_of_replicas=1, rank=0, seed=0):
+        self.readahead = readahead
+        self.num_of_samples = num_of_samples
+        self.shuffle = shuffle
+        self.num_of_replicas = num_of_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+
+        if self.shuffle and self.num_of_replicas > 1:
+            generator = torch.Generator()
+            generator.manual_seed(self.seed + self.epoch)
+            order = torch.randperm(self.num_of_samples, generator=generator).tolist()
+        elif self.shuffle:
+            order = torch.randperm(self.num_of_samples).tolist()
+        else:
+            order = list(range(self.num_of_samples))
+
+        # Shard of this rank
+        if self.num_of_replicas > 1:
+            order += order[:len(self) * self.num_of_replicas - self.num_of_samples]
+            order = order[self.rank::self.num_of_replicas]
+
+        # Published before any index reaches the workers
+        self.readahead.publish_order(order)
+
+        return iter(order)
+
+    def __len__(self):
+        return math.ceil(self.num_of_samples / self.num_of_replicas)
+
+#-------------------------------------------------------------------------------
+# Functions
+
+class RecordDataset(torch.utils.data.Dataset):
+    """Minimal dataset of single-file records (for test_sample_readahead)"""
+
+    def __init__(self, file_paths, readahead):
+        self.file_paths = file_paths
+        self.readahead = readahead
+
+    def get_record_paths(self, i):
+        return {'color.png': self.file_paths[i]}
+
+    def __getitem__(self, i):
+        return int(self.readahead.get(i, self.get_record_paths)['color.png'])
+
+    def __len__(self):
+        return len(self.file_paths)
+
+def test_sample_readahead(num_of_samples=64, batch_size=4, num_of_workers=2):
+
+    import tempfile
+    import pathlib
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+
+        file_paths = []
+        for i in range(num_of_samples):
+            file_path = pathlib.Path(tmp_dir) / f'{i}.txt'
+            file_path.write_bytes(str(i).encode())
+            file_paths.append(file_path)
+
+        readahead = SampleReadahead(num_of_samples, batch_size, depth=8, num_of_threads=2)
+        dataset = RecordDataset(file_paths, readahead)
+
+        dataloader = torch.utils.data.DataLoader(
+            dataset,
+            batch_size=batch_size,
+            num_workers=num_of_workers,
+            sampler=ReadaheadSampler(readahead, num_of_samples, shuffle=True)
+        )
+
+        # Two epochs, every sample is returned once per epoch
+        for epoch in range(2):
+            ids = torch.cat([x for x in dataloader]).tolist()
+            assert sorted(ids) == list(range(num_of_samples))
+
+        stats = readahead.get_stats()
+        print(stats)
+
+        # Only the first sample of each worker (per epoch) is not read ahead
+        assert stats['hits'] >= 2 * (num_of_samples - num_of_workers)
+
+        # Shards of two ranks (same permutation), together all the samples
+        shards = []
+        for rank in range(2):
+            sampler = ReadaheadSampler(readahead, num_of_samples, shuffle=True, num_of_replicas=2, rank=rank)
+            sampler.set_epoch(1)
+            shards.append(list(sampler))
+            assert readahead.get_order().tolist() == shards[-1]
+
+        assert sorted(shards[0] + shards[1]) == list(range(num_of_samples))
+
+#-------------------------------------------------------------------------------
+# Main Code
+
+if __name__ == '__main__':
+    test_sample_readahead()
@@ -0,0 +1,185 @@
+import os
+import pathlib
+import shutil
+import pickle
+import atexit
+import multiprocessing
+import logging
+
+#-------------------------------------------------------------------------------
+# File Constants
+
+# tmpfs (RAM) directory shared by all the processes of the machine
+SHARED_MEMORY_DIR = pathlib.Path('/dev/shm')
+
+# Number of insertions (per process) between the checks of the byte budget
+EVICT_INTERVAL = 32
+
+LOGGER = logging.getLogger('fastposecnn')
+
+#-------------------------------------------------------------------------------
+# Classes
+
+class SharedSampleCache(object):
+    """Cache of decoded samples shared by all the DataLoader workers.
+
+    Each entry is a pickled file in a shared-memory (tmpfs) directory, written
+    atomically (temporary file and rename), so any worker can read and write
+    the entries of the others. The least recently used entries (oldest mtime,
+    updated on every hit) are evicted once the byte budget is exceeded. The
+    hit and miss counters are shared memory values of all the processes.
+
+    The cache is created in the main process, which owns the directory and
+    removes it at exit, therefore it survives the workers (and epochs).
+
+    Args:
+        name (str): name of the cache (e.g. the split)
+        max_bytes (int): byte budget of the cache
+        cache_dir (pathlib object): parent directory of the cache
+    """
+
+    def __init__(self, name, max_bytes, cache_dir=SHARED_MEMORY_DIR):
+
+        self.max_bytes = max_bytes
+        self.cache_dir = pathlib.Path(cache_dir) / f'fastposecnn_{name}_{os.getpid()}'
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+        # Shared counters (hits, misses)
+        self.counters = multiprocessing.Array('q', 2)
+        self.num_of_insertions = 0
+
+        # Only the creator removes the cache
+        self.owner_pid = os.getpid()
+        atexit.register(self.cleanup)
+
+    def get_entry_path(self, key):
+        return self.cache_dir / f'{key}.pkl'
+
+    def get(self, key):
+        """
+        Args:
+            key (int or str): the entry key (e.g. the sample index)
+        Output:
+            value (object): the cached value or None if not found
+        """
+
+        entry_path = self.get_entry_path(key)
+
+        try:
+            with open(entry_path, 'rb') as f:
+                value = pickle.load(f)
+            os.utime(entry_path)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            with self.counters.get_lock():
+                self.counters[1] += 1
+            return None
+
+        with self.counters.get_lock():
+            self.counters[0] += 1
+
+        return value
+
+    def put(self, key, value):
+
+        entry_path = self.get_entry_path(key)
+        tmp_path = entry_path.with_name(f'{entry_path.name}.{os.getpid()}.tmp')
+
+        try:
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, entry_path)
+        except OSError as e:
+            # Full shared memory, the sample is simply not cached
+            LOGGER.debug(f'SAMPLE CACHE WRITE FAILED: {e}')
+            if tmp_path.exists():
+                tmp_path.unlink()
+            return None
+
+        # Checking the byte budget every few insertions
+        self.num_of_insertions += 1
+        if self.num_of_insertions % EVICT_INTERVAL == 0:
+            self.evict()
+
+    def evict(self):
+        """
+        Objective:
+            Remove the least recently used entries until the cache fits in the
+            byte budget. Entries removed by other workers are ignored.
+        """
+
+        entries = []
+        for entry_path in self.cache_dir.glob('*.pkl'):
+            try:
+                stat = entry_path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry_path))
+
+        total_bytes = sum([x[1] for x in entries])
+
+        for _, size, entry_path in sorted(entries):
+
+            if total_bytes <= self.max_bytes:
+                break
+
+            try:
+                entry_path.unlink()
+            except FileNotFoundError:
+                pass
+
+            total_bytes -= size
+
+    def get_stats(self):
+        """
+        Output:
+            stats (dict): hits, misses and hit rate of all the processes
+        """
+
+        with self.counters.get_lock():
+            hits, misses = self.counters[0], self.counters[1]
+
+        return {
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': hits / max(hits + misses, 1)
+        }
+
+    def cleanup(self):
+        if os.getpid() == self.owner_pid:
+            shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+#-------------------------------------------------------------------------------
+# Functions
+
+def test_shared_sample_cache():
+
+    import numpy as np
+
+    cache = SharedSampleCache('test', max_bytes=10 * 1024**2)
+
+    # Miss, put and hit
+    assert cache.get(0) is None
+    cache.put(0, {'image': np.ones((480, 640, 3), dtype=np.uint8)})
+    assert cache.get(0)['image'].sum() == 480 * 640 * 3
+
+    # Hits from another process
+    process = multiprocessing.Process(target=cache.get, args=(0,))
+    process.start(); process.join()
+
+    # Evicting the oldest entries beyond the budget (~0.9 MB each)
+    for i in range(1, 20):
+        cache.put(i, {'image': np.ones((480, 640, 3), dtype=np.uint8)})
+    cache.evict()
+
+    assert cache.get(0) is None
+    assert cache.get(19) is not None
+
+    print(cache.get_stats())
+
+    cache.cleanup()
+
+#-------------------------------------------------------------------------------
+# Main Code
+
+if __name__ == '__main__':
+    test_shared_sample_cache()
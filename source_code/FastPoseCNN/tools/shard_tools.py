@@ -0,0 +1,365 @@
+import os
+import io
+import sys
+import pathlib
+import argparse
+import tarfile
+import tqdm
+
+import numpy as np
+
+# Local Imports
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import json_tools as jt
+
+#-------------------------------------------------------------------------------
+# File Constants
+
+SHARD_INDEX_FILENAME = 'index.json'
+SAMPLES_PER_SHARD = 2048
+
+# Fixed layout of the per-instance pose data stored in each shard (same as
+# the binary meta+ files)
+POSE_DTYPE = jt.META_DTYPE
+
+# Sequential tar shards: {sample_id}.color.png, {sample_id}.mask.png and
+# {sample_id}.meta.bin members for each sample (the original files' bytes)
+TAR_INDEX_FILENAME = 'tar_index.json'
+TAR_SAMPLES_FILENAME = 'tar_samples.npz'
+
+#-------------------------------------------------------------------------------
+# Functions
+
+def get_shard_paths(shard_dir):
+    """
+    Args:
+        shard_dir (pathlib object): directory of a single shard
+    Output:
+        shard_paths (dict): filepaths of the shard's arrays
+    """
+
+    return {
+        'images': shard_dir / 'images.npy',
+        'masks': shard_dir / 'masks.npy',
+        'poses': shard_dir / 'poses.npy',
+        'offsets': shard_dir / 'offsets.npy'
+    }
+
+def json_data_to_poses(json_data):
+    """
+    Args:
+        json_data (dict): meta+ data of a single sample
+    Output:
+        poses (np.ndarray): POSE_DTYPE array with one entry per instance
+    """
+
+    return jt.meta_data_to_array(json_data)
+
+def poses_to_json_data(poses):
+    """
+    Args:
+        poses (np.ndarray): POSE_DTYPE array of a single sample
+    Output:
+        json_data (dict): meta+ data matching the layout of the _meta+.json
+    """
+
+    return jt.array_to_meta_data(poses)
+
+def pack_dataset_into_shards(dataset, output_dir, samples_per_shard=SAMPLES_PER_SHARD):
+    """
+    Args:
+        dataset (NOCSDataset): dataset to be packed (its images_fps define the
+            samples and their order)
+        output_dir (pathlib object): destination of the shards
+        samples_per_shard (int): maximum number of samples in each shard
+    Objective:
+        Pack the color images, the single-channel masks and the meta+ data of
+        the dataset into large memory-mappable .npy shards, each one containing:
+            images.npy: NxHxWx3 uint8
+            masks.npy: NxHxW uint8 (255 = background)
+            poses.npy: M POSE_DTYPE (flat instance table)
+            offsets.npy: N+1 int64 (instance offsets per sample)
+    Output:
+        index (dict): the contents of the index.json of the shards
+    """
+
+    output_dir = pathlib.Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    num_of_samples = len(dataset.images_fps)
+    image_shape = None
+
+    index = {
+        'num_of_samples': num_of_samples,
+        'image_shape': None,
+        'paths': [str(x) for x in dataset.images_fps],
+        'shards': []
+    }
+
+    for shard_id, start in enumerate(range(0, num_of_samples, samples_per_shard)):
+
+        # Determining the samples in this shard
+        end = min(start + samples_per_shard, num_of_samples)
+        shard_dir = output_dir / f'shard_{shard_id:05d}'
+        shard_dir.mkdir(exist_ok=True)
+        shard_paths = get_shard_paths(shard_dir)
+
+        # Containers for the variable-length pose data
+        all_poses = []
+        offsets = np.zeros((end - start + 1,), dtype=np.int64)
+
+        for local_id, i in enumerate(tqdm.tqdm(range(start, end), desc=f'shard {shard_id}')):
+
+            # The poses are packed from the meta+ data (load_raw_sample returns
+            # the precomputed targets instead when the split has a target store)
+            image, mask, _ = dataset.load_raw_sample(i)
+            json_data = dataset.load_meta_plus(i)
+
+            # Allocating the memory-mapped shard arrays once the shape is known
+            if local_id == 0:
+
+                if image_shape is None:
+                    image_shape = list(image.shape)
+                    index['image_shape'] = image_shape
+
+                images = np.lib.format.open_memmap(
+                    str(shard_paths['images']), mode='w+', dtype=np.uint8,
+                    shape=(end - start, *image_shape)
+                )
+                masks = np.lib.format.open_memmap(
+                    str(shard_paths['masks']), mode='w+', dtype=np.uint8,
+                    shape=(end - start, *image_shape[:2])
+                )
+
+            # Every sample needs to have the same shape to be packed
+            assert list(image.shape) == image_shape, f'Invalid image shape {image.shape} for {dataset.images_fps[i]}'
+
+            images[local_id] = image
+            masks[local_id] = mask
+
+            poses = json_data_to_poses(json_data)
+            all_poses.append(poses)
+            offsets[local_id+1] = offsets[local_id] + poses.shape[0]
+
+        # Flushing the image data
+        images.flush(); del images
+        masks.flush(); del masks
+
+        # Storing the flat instance table
+        np.save(str(shard_paths['poses']), np.concatenate(all_poses))
+        np.save(str(shard_paths['offsets']), offsets)
+
+        index['shards'].append({
+            'name': shard_dir.name,
+            'start': start,
+            'num_of_samples': end - start,
+            'num_of_instances': int(offsets[-1])
+        })
+
+    # Writing the index last, so that incomplete conversions are not used
+    jt.save_to_json(output_dir / SHARD_INDEX_FILENAME, index)
+
+    return index
+
+def load_shard_index(shards_dir):
+
+    index_path = pathlib.Path(shards_dir) / SHARD_INDEX_FILENAME
+
+    if index_path.exists() is False:
+        raise RuntimeError(f'No shards found in {shards_dir}, run shard_tools.py first')
+
+    return jt.load_from_json(index_path)
+
+def open_shard(shards_dir, shard_name, resolve_path=None):
+    """
+    Args:
+        shards_dir (pathlib object): directory containing the index.json
+        shard_name (str): name of the shard
+        resolve_path (function): optional mapping of the shard's files (e.g.
+            staging_cache.StagingCache.resolve)
+    Output:
+        shard (dict): read-only memory-mapped arrays of the shard
+    """
+
+    shard_paths = get_shard_paths(pathlib.Path(shards_dir) / shard_name)
+
+    if resolve_path is not None:
+        shard_paths = {k:resolve_path(v) for k,v in shard_paths.items()}
+
+    return {k:np.load(str(v), mmap_mode='r') for k,v in shard_paths.items()}
+
+def get_pose_summary(poses, num_of_classes):
+    """
+    Args:
+        poses (np.ndarray): POSE_DTYPE array of a single sample
+        num_of_classes (int): C
+    Output:
+        class_counts (np.ndarray): C number of instances per class
+        invalid_z_counts (np.ndarray): C number of instances with z <= 0
+    """
+
+    class_ids = poses['class_id'].astype(np.int64)
+    is_invalid_z = np.linalg.inv(poses['RT'])[:, 2, 3] <= 0
+
+    class_counts = np.bincount(class_ids, minlength=num_of_classes)
+    invalid_z_counts = np.bincount(class_ids[is_invalid_z], minlength=num_of_classes)
+
+    return class_counts, invalid_z_counts
+
+def pack_dataset_into_tar_shards(dataset, output_dir, num_of_classes, samples_per_shard=SAMPLES_PER_SHARD):
+    """
+    Args:
+        dataset (NOCSDataset): dataset to be packed (its images_fps define the
+            samples and their order)
+        output_dir (pathlib object): destination of the tar shards
+        num_of_classes (int): number of classes of the instance class ids
+        samples_per_shard (int): maximum number of samples in each shard
+    Objective:
+        Pack the original PNG files and the binary meta+ data of the dataset
+        into tar shards meant to be read sequentially (see iterate_tar_shard).
+        The per-sample class and invalid z counts are stored separately
+        (tar_samples.npz) to select the samples without reading the shards.
+    Output:
+        index (dict): the contents of the tar_index.json of the shards
+    """
+
+    output_dir = pathlib.Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    num_of_samples = len(dataset.images_fps)
+    class_counts = np.zeros((num_of_samples, num_of_classes), dtype=np.uint8)
+    invalid_z_counts = np.zeros((num_of_samples, num_of_classes), dtype=np.uint8)
+
+    index = {
+        'num_of_samples': num_of_samples,
+        'paths': [str(x) for x in dataset.images_fps],
+        'shards': []
+    }
+
+    for shard_id, start in enumerate(range(0, num_of_samples, samples_per_shard)):
+
+        end = min(start + samples_per_shard, num_of_samples)
+        shard_path = output_dir / f'shard_{shard_id:05d}.tar'
+        tmp_path = shard_path.with_suffix('.tar.tmp')
+
+        with tarfile.open(str(tmp_path), 'w') as tar:
+            for i in tqdm.tqdm(range(start, end), desc=f'shard {shard_id}'):
+
+                color_path = dataset.images_fps[i]
+                json_data = jt.load_meta_plus(color_path)
+                meta_bytes = jt.encode_meta_bin(json_data)
+
+                class_counts[i], invalid_z_counts[i] = get_pose_summary(jt.meta_data_to_array(json_data), num_of_classes)
+
+                tar.add(str(color_path), arcname=f'{i:09d}.color.png')
+                tar.add(str(color_path).replace('_color.png', '_mask.png'), arcname=f'{i:09d}.mask.png')
+
+                info = tarfile.TarInfo(f'{i:09d}.meta.bin')
+                info.size = len(meta_bytes)
+                tar.addfile(info, io.BytesIO(meta_bytes))
+
+        os.replace(tmp_path, shard_path)
+
+        index['shards'].append({
+            'name': shard_path.name,
+            'start': start,
+            'num_of_samples': end - start
+        })
+
+    # Writing the index last, so that incomplete conversions are not used
+    np.savez(str(output_dir / TAR_SAMPLES_FILENAME), class_counts=class_counts, invalid_z_counts=invalid_z_counts)
+    jt.save_to_json(output_dir / TAR_INDEX_FILENAME, index)
+
+    return index
+
+def load_tar_index(shards_dir):
+    """
+    Output:
+        index (dict): the contents of the tar_index.json
+        samples (dict): class_counts and invalid_z_counts of all the samples
+    """
+
+    index_path = pathlib.Path(shards_dir) / TAR_INDEX_FILENAME
+
+    if index_path.exists() is False:
+        raise RuntimeError(f'No tar shards found in {shards_dir}, run shard_tools.py --FORMAT tar first')
+
+    with np.load(str(pathlib.Path(shards_dir) / TAR_SAMPLES_FILENAME)) as data:
+        samples = {k:data[k] for k in data.files}
+
+    return jt.load_from_json(index_path), samples
+
+def iterate_tar_shard(shard_path):
+    """
+    Args:
+        shard_path (pathlib object): the tar shard
+    Objective:
+        Read the tar shard sequentially (streaming mode, no seeking)
+    Output:
+        (generator) sample_id (int), record (dict): the bytes of the 'color.png',
+            'mask.png' and 'meta.bin' members of each sample
+    """
+
+    current_id, record = None, {}
+
+    with tarfile.open(str(shard_path), 'r|') as tar:
+        for member in tar:
+
+            if not member.isfile():
+                continue
+
+            sample_id, member_type = member.name.split('.', 1)
+            sample_id = int(sample_id)
+
+            # The members of each sample are consecutive
+            if sample_id != current_id and record:
+                yield current_id, record
+                record = {}
+
+            current_id = sample_id
+            record[member_type] = tar.extractfile(member).read()
+
+    if record:
+        yield current_id, record
+
+#-------------------------------------------------------------------------------
+# Main Code
+
+if __name__ == '__main__':
+
+    # Importing the dataset also loads the environmental variables
+    import project as pj
+    import dataset as ds
+    import pyramid_tools as pt
+
+    parser = argparse.ArgumentParser(description='Pack a NOCS split into memory-mapped shards')
+    parser.add_argument('--DATASET_NAME', type=str, default='CAMERA', choices=['CAMERA', 'REAL'])
+    parser.add_argument('--SPLIT', type=str, default='TRAIN', choices=['TRAIN', 'VALID', 'TEST'])
+    parser.add_argument('--SAMPLES_PER_SHARD', type=int, default=SAMPLES_PER_SHARD)
+    parser.add_argument('--FORMAT', type=str, default='npy', choices=['npy', 'tar'])
+    parser.add_argument('--RESOLUTION_SCALE', type=float, default=1.0)
+    args = parser.parse_args()
+
+    dataset_class = ds.CAMERADataset if args.DATASET_NAME == 'CAMERA' else ds.REALDataset
+
+    # All classes are packed, class selection is done when loading the shards
+    dataset = dataset_class(
+        dataset_dir=pt.get_scaled_path(os.getenv(f'NOCS_{args.DATASET_NAME}_{args.SPLIT}_DATASET'), args.RESOLUTION_SCALE),
+        classes=pj.constants.CAMERA_CLASSES,
+        resolution_scale=args.RESOLUTION_SCALE
+    )
+
+    if args.FORMAT == 'npy':
+        pack_dataset_into_shards(
+            dataset,
+            pt.get_scaled_path(os.getenv(f'NOCS_{args.DATASET_NAME}_{args.SPLIT}_SHARDS'), args.RESOLUTION_SCALE),
+            args.SAMPLES_PER_SHARD
+        )
+    else:
+        pack_dataset_into_tar_shards(
+            dataset,
+            pt.get_scaled_path(os.getenv(f'NOCS_{args.DATASET_NAME}_{args.SPLIT}_TARS'), args.RESOLUTION_SCALE),
+            len(pj.constants.CAMERA_CLASSES),
+            args.SAMPLES_PER_SHARD
+        )
@@ -0,0 +1,356 @@
+import os
+import time
+import fcntl
+import pathlib
+import shutil
+import contextlib
+import multiprocessing
+import logging
+
+#-------------------------------------------------------------------------------
+# File Constants
+
+# Node-shared index of the staged bytes (in the stage directory)
+INDEX_FILENAME = '.staged_bytes'
+
+# The eviction removes files until the staged bytes are below this fraction of
+# the budget, and the stage directory is scanned at most once per interval
+EVICT_LOW_WATERMARK = 0.9
+EVICT_MIN_INTERVAL_SECONDS = 60
+
+# Recently used files are never evicted (their paths may have just been
+# returned by resolve and not opened yet)
+EVICT_GRACE_SECONDS = 60
+
+# Locks older than this are considered left by a crashed process
+STALE_LOCK_SECONDS = 600
+
+LOGGER = logging.getLogger('fastposecnn')
+
+#-------------------------------------------------------------------------------
+# Classes
+
+class StagingCache(object):
+    """Local (e.g. SSD scratch) copies of the dataset files of a slow network
+    mount, created on first access.
+
+    The staged files mirror the layout of the source directory. They are
+    copied to a temporary file and renamed, so the staged files are always
+    complete, and a lock file avoids copying the same file from several
+    processes at once (the others read the source meanwhile). The modification
+    time of the staged files is the source's one (integrity check against the
+    source, see check_source) and the access time is updated on every hit, so
+    the least recently used files are evicted once the byte budget is exceeded.
+    The staged bytes of all the processes of the node are counted in a locked
+    index file of the stage directory, which is only scanned when the budget
+    is exceeded. The hit, miss and bypass counters are shared memory values of
+    all the processes.
+
+    Args:
+        source_dir (pathlib object): root of the network mount (only its files
+            are staged)
+        stage_dir (pathlib object): local directory of the staged files
+        max_bytes (int): byte budget of the staged files
+        check_source (bool): compare the size and the modification time of the
+            staged files with the source on every hit (one stat in the network
+            mount), else the staged files are assumed up to date
+    """
+
+    def __init__(self, source_dir, stage_dir, max_bytes, check_source=False):
+
+        self.source_dir = pathlib.Path(source_dir).absolute()
+        self.stage_dir = pathlib.Path(stage_dir)
+        self.stage_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.check_source = check_source
+
+        self.index_path = self.stage_dir / INDEX_FILENAME
+
+        # Shared counters (hits, misses, bypasses, staged bytes)
+        self.counters = multiprocessing.Array('q', 4)
+
+    def get_staged_path(self, path):
+        """
+        Output:
+            staged_path (pathlib object): the location of the file in the stage
+                directory (None if the file is not in the source directory)
+        """
+
+        try:
+            return self.stage_dir / pathlib.Path(path).absolute().relative_to(self.source_dir)
+        except ValueError:
+            return None
+
+    def is_valid(self, staged_path, path):
+
+        try:
+            staged_stat = os.stat(staged_path)
+        except FileNotFoundError:
+            return False
+
+        if self.check_source:
+            try:
+                source_stat = os.stat(path)
+            except FileNotFoundError:
+                # The source is not available anymore, the copy is kept
+                return True
+
+            if (staged_stat.st_size, staged_stat.st_mtime_ns) != (source_stat.st_size, source_stat.st_mtime_ns):
+                return False
+
+        # Updating the access time (LRU) and keeping the source's mtime
+        try:
+            os.utime(staged_path, ns=(time.time_ns(), staged_stat.st_mtime_ns))
+        except FileNotFoundError:
+            return False
+
+        return True
+
+    def resolve(self, path):
+        """
+        Args:
+            path (str or pathlib object): a file of the source directory
+        Output:
+            path (pathlib object): the staged file (staged now if needed), or
+                the original file if it cannot be staged
+        """
+
+        staged_path = self.get_staged_path(path)
+
+        if staged_path is None:
+            return pathlib.Path(path)
+
+        if self.is_valid(staged_path, path):
+            self.increment(0)
+            return staged_path
+
+        return self.stage(pathlib.Path(path), staged_path)
+
+    def stage(self, path, staged_path):
+
+        staged_path.parent.mkdir(parents=True, exist_ok=True)
+        lock_path = staged_path.with_name(f'{staged_path.name}.lock')
+
+        # Only one process copies each file
+        try:
+            os.close(os.open(str(lock_path), os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            self.remove_stale_lock(lock_path)
+            self.increment(2)
+            return path
+
+        tmp_path = staged_path.with_name(f'{staged_path.name}.{os.getpid()}.tmp')
+
+        try:
+            source_stat = os.stat(path)
+            shutil.copyfile(str(path), str(tmp_path))
+
+            # Integrity: complete copy of an unmodified source
+            if os.stat(tmp_path).st_size != source_stat.st_size or os.stat(path).st_mtime_ns != source_stat.st_mtime_ns:
+                raise OSError(f'{path} changed while staging')
+
+            os.utime(tmp_path, ns=(time.time_ns(), source_stat.st_mtime_ns))
+
+            # Size of the outdated copy that is replaced (if any)
+            try:
+                replaced_bytes = os.stat(staged_path).st_size
+            except FileNotFoundError:
+                replaced_bytes = 0
+
+            os.replace(tmp_path, staged_path)
+
+        except OSError as e:
+            # Missing sources, full disks, etc. are read from the source
+            LOGGER.debug(f'STAGING FAILED: {e}')
+            if tmp_path.exists():
+                tmp_path.unlink()
+            self.increment(2)
+            return path
+
+        finally:
+            lock_path.unlink()
+
+        self.increment(1)
+        self.increment(3, source_stat.st_size)
+
+        # Checking the byte budget of the node
+        with self.locked_index() as index:
+            index['bytes'] += source_stat.st_size - replaced_bytes
+            is_over_budget = index['bytes'] > self.max_bytes and time.time() - index['evict_time'] > EVICT_MIN_INTERVAL_SECONDS
+            if is_over_budget:
+                index['evict_time'] = time.time()
+
+        if is_over_budget:
+            self.evict()
+
+        return staged_path
+
+    def remove_stale_lock(self, lock_path):
+
+        try:
+            if time.time() - os.stat(lock_path).st_mtime > STALE_LOCK_SECONDS:
+                lock_path.unlink()
+        except FileNotFoundError:
+            pass
+
+    @contextlib.contextmanager
+    def locked_index(self):
+        """
+        Objective:
+            Exclusive access (between the processes of the node) to the index
+            of the staged bytes, created with a scan if missing
+        Output:
+            index (dict): bytes (staged bytes) and evict_time (last eviction),
+                written back at the exit
+        """
+
+        with open(self.index_path, 'a+') as f:
+
+            # Released when the file is closed
+            fcntl.flock(f, fcntl.LOCK_EX)
+
+            f.seek(0)
+            values = f.read().split()
+
+            if len(values) == 2:
+                index = {'bytes': int(values[0]), 'evict_time': float(values[1])}
+            else:
+                index = {'bytes': sum([x[1] for x in self.scan()]), 'evict_time': 0.0}
+
+            yield index
+
+            f.seek(0)
+            f.truncate()
+            f.write(f"{index['bytes']} {index['evict_time']}")
+
+    def scan(self):
+        """
+        Output:
+            entries (list): (access time, size, path) of the staged files
+        """
+
+        entries = []
+        for entry_path in self.stage_dir.rglob('*'):
+
+            if entry_path.suffix in ['.lock', '.tmp'] or entry_path.name == INDEX_FILENAME:
+                continue
+
+            try:
+                stat = entry_path.stat()
+            except FileNotFoundError:
+                continue
+
+            if entry_path.is_file():
+                entries.append((stat.st_atime, stat.st_size, entry_path))
+
+        return entries
+
+    def evict(self):
+        """
+        Objective:
+            Remove the least recently used staged files until they fit in the
+            byte budget (below EVICT_LOW_WATERMARK of it). Files removed by
+            other processes are ignored.
+        """
+
+        with self.locked_index() as index:
+            index_bytes = index['bytes']
+            index['evict_time'] = time.time()
+
+        entries = self.scan()
+        total_bytes = sum([x[1] for x in entries])
+        grace_time = time.time() - EVICT_GRACE_SECONDS
+
+        for atime, size, entry_path in sorted(entries):
+
+            if total_bytes <= EVICT_LOW_WATERMARK * self.max_bytes or atime > grace_time:
+                break
+
+            try:
+                entry_path.unlink()
+            except FileNotFoundError:
+                pass
+
+            total_bytes -= size
+
+        # Correcting the index with the scanned bytes (the files staged during
+        # the scan stay counted)
+        with self.locked_index() as index:
+            index['bytes'] += total_bytes - index_bytes
+
+    def increment(self, counter_id, value=1):
+        with self.counters.get_lock():
+            self.counters[counter_id] += value
+
+    def get_stats(self):
+        """
+        Output:
+            stats (dict): hits, misses (stagings), bypasses (files read from the
+                source) and staged bytes of all the processes
+        """
+
+        with self.counters.get_lock():
+            hits, misses, bypasses, staged_bytes = list(self.counters)
+
+        return {
+            'hits': hits,
+            'misses': misses,
+            'bypasses': bypasses,
+            'hit_rate': hits / max(hits + misses + bypasses, 1),
+            'staged_gb': staged_bytes / 1024**3
+        }
+
+#-------------------------------------------------------------------------------
+# Functions
+
+def test_staging_cache():
+
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as source_dir, tempfile.TemporaryDirectory() as stage_dir:
+
+        staging_cache = StagingCache(source_dir, stage_dir, max_bytes=10 * 1024)
+
+        # Miss (staged), then hit
+        source_path = pathlib.Path(source_dir) / 'a' / '0000_color.png'
+        source_path.parent.mkdir()
+        source_path.write_bytes(b'0' * 1024)
+
+        staged_path = staging_cache.resolve(source_path)
+        assert staged_path != source_path and staged_path.read_bytes() == source_path.read_bytes()
+        assert staging_cache.resolve(source_path) == staged_path
+
+        # Files outside the source directory are not staged
+        assert staging_cache.resolve(pathlib.Path(stage_dir) / 'x') == pathlib.Path(stage_dir) / 'x'
+
+        # Modified sources are staged again
+        staging_cache.check_source = True
+        source_path.write_bytes(b'1' * 2048)
+        assert staging_cache.resolve(source_path).read_bytes() == b'1' * 2048
+
+        # Hits from another process
+        process = multiprocessing.Process(target=staging_cache.resolve, args=(source_path,))
+        process.start(); process.join()
+
+        # Evicting the oldest files beyond the budget (outside the grace period)
+        for i in range(20):
+            path = pathlib.Path(source_dir) / 'a' / f'{i+1:04d}_color.png'
+            path.write_bytes(b'0' * 1024)
+            staging_cache.resolve(path)
+            staged = staging_cache.get_staged_path(path)
+            os.utime(staged, ns=((i+1) * 10**9, os.stat(staged).st_mtime_ns))
+
+        staging_cache.evict()
+        assert staging_cache.get_staged_path(pathlib.Path(source_dir) / 'a' / '0001_color.png').exists() is False
+
+        # The index of the node matches the staged files
+        with staging_cache.locked_index() as index:
+            assert index['bytes'] == sum([x[1] for x in staging_cache.scan()]) <= staging_cache.max_bytes
+
+        print(staging_cache.get_stats())
+
+#-------------------------------------------------------------------------------
+# Main Code
+
+if __name__ == '__main__':
+    test_staging_cache()
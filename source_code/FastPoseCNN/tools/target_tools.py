@@ -0,0 +1,195 @@
+import os
+import sys
+import pathlib
+import argparse
+import logging
+import tqdm
+
+import numpy as np
+
+# Local Imports
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import json_tools as jt
+
+#-------------------------------------------------------------------------------
+# File Constants
+
+TARGET_STORE_DIRNAME = '.nocs_targets'
+TARGET_INDEX_FILENAME = 'index.json'
+TARGET_STORE_VERSION = 1
+
+# Columns of the flat instance table (all the instances of every sample, with
+# their original class ids) and their per-instance shapes
+TARGET_COLUMNS = {
+    'instance_id': (np.uint8, ()),
+    'class_id': (np.uint8, ()),
+    'quaternion': (np.float64, (4,)),
+    'scales': (np.float64, (3,)),
+    'xy': (np.float64, (2,)),
+    'z': (np.float64, (1,)),
+    'T': (np.float64, (3,)),
+    'R': (np.float64, (3,3)),
+    'RT': (np.float64, (4,4))
+}
+
+LOGGER = logging.getLogger('fastposecnn')
+
+#-------------------------------------------------------------------------------
+# Functions
+
+def get_column_paths(store_dir):
+
+    paths = {k:store_dir / f'{k}.npy' for k in TARGET_COLUMNS.keys()}
+    paths.update({
+        'offsets': store_dir / 'offsets.npy',
+        'meta_mtimes': store_dir / 'meta_mtimes.npy'
+    })
+
+    return paths
+
+def build_target_store(dataset, store_dir=None):
+    """
+    Args:
+        dataset (NOCSDataset): dataset with all the classes selected (its
+            images_fps define the samples)
+        store_dir (pathlib object): destination, defaults to the .nocs_targets
+            directory of the dataset
+    Objective:
+        Materialize the per-instance targets (see NOCSDataset.generate_instance_targets)
+        of every sample into columnar .npy arrays of a flat instance table, with
+        the offsets of each sample. The mtime of the meta+ file of each sample
+        is stored to detect the outdated samples.
+    Output:
+        index (dict): the contents of the index.json of the store
+    """
+
+    dataset_dir = pathlib.Path(dataset.dataset_dir)
+    store_dir = dataset_dir / TARGET_STORE_DIRNAME if store_dir is None else pathlib.Path(store_dir)
+    store_dir.mkdir(parents=True, exist_ok=True)
+
+    # Invalidating the previous store while the columns are rewritten
+    if (store_dir / TARGET_INDEX_FILENAME).exists():
+        (store_dir / TARGET_INDEX_FILENAME).unlink()
+
+    num_of_samples = len(dataset.images_fps)
+    columns = {k:[] for k in TARGET_COLUMNS.keys()}
+    offsets = np.zeros((num_of_samples+1,), dtype=np.int64)
+    meta_mtimes = np.zeros((num_of_samples,), dtype=np.int64)
+
+    for i, color_path in enumerate(tqdm.tqdm(dataset.images_fps)):
+
+        meta_mtimes[i] = jt.get_meta_plus_path(color_path).stat().st_mtime_ns
+        json_data = jt.load_meta_plus(color_path)
+
+        targets = dataset.generate_instance_targets(json_data)
+        targets['instance_id'] = np.array([int(x) for x in json_data['instance_dict'].keys()])
+        targets['class_id'] = targets['class_ids']
+
+        for key in TARGET_COLUMNS.keys():
+            columns[key].append(targets[key])
+
+        offsets[i+1] = offsets[i] + len(json_data['instance_dict'])
+
+    # Saving the columns (the index is written last, so that incomplete stores
+    # are not used)
+    column_paths = get_column_paths(store_dir)
+
+    for key, (dtype, shape) in TARGET_COLUMNS.items():
+        column = np.concatenate(columns[key], axis=0) if num_of_samples else np.zeros((0, *shape))
+        np.save(str(column_paths[key]), column.astype(dtype).reshape((-1, *shape)))
+
+    np.save(str(column_paths['offsets']), offsets)
+    np.save(str(column_paths['meta_mtimes']), meta_mtimes)
+
+    index = {
+        'version': TARGET_STORE_VERSION,
+        'intrinsics': np.asarray(dataset.INTRINSICS).tolist(),
+        'paths': [str(pathlib.Path(x).relative_to(dataset_dir)) for x in dataset.images_fps]
+    }
+    jt.save_to_json(store_dir / TARGET_INDEX_FILENAME, index)
+
+    return index
+
+def load_target_index(dataset_dir, intrinsics, store_dir=None):
+    """
+    Args:
+        dataset_dir (pathlib object): root directory of the dataset split
+        intrinsics (np.ndarray): intrinsics used by the dataset
+        store_dir (pathlib object): defaults to the .nocs_targets directory of
+            the dataset
+    Output:
+        store_dir (pathlib object): the directory of the store
+        rows (dict): {color image path (str): row of the sample}
+        (or None if the store does not exist or does not match the dataset)
+    """
+
+    dataset_dir = pathlib.Path(dataset_dir)
+    store_dir = dataset_dir / TARGET_STORE_DIRNAME if store_dir is None else pathlib.Path(store_dir)
+    index_path = store_dir / TARGET_INDEX_FILENAME
+
+    if index_path.exists() is False:
+        return None
+
+    index = jt.load_from_json(index_path)
+
+    if index.get('version', None) != TARGET_STORE_VERSION:
+        LOGGER.warning(f'Outdated target store at {store_dir}, run target_tools.py again')
+        return None
+
+    if not np.allclose(np.asarray(index['intrinsics']), np.asarray(intrinsics)):
+        LOGGER.warning(f'Target store at {store_dir} was created with different intrinsics, ignoring it')
+        return None
+
+    rows = {str(dataset_dir / x):i for i,x in enumerate(index['paths'])}
+
+    return store_dir, rows
+
+def open_target_store(store_dir):
+    """
+    Output:
+        store (dict): read-only memory-mapped columns, offsets and meta_mtimes
+    """
+
+    return {k:np.load(str(v), mmap_mode='r') for k,v in get_column_paths(pathlib.Path(store_dir)).items()}
+
+def get_sample_targets(store, row):
+    """
+    Args:
+        store (dict): see open_target_store
+        row (int): row of the sample
+    Output:
+        targets (dict): the columns of the sample's instances (a single slice)
+    """
+
+    start, end = store['offsets'][row], store['offsets'][row+1]
+
+    return {k:np.asarray(store[k][start:end]) for k in TARGET_COLUMNS.keys()}
+
+#-------------------------------------------------------------------------------
+# Main Code
+
+if __name__ == '__main__':
+
+    # Importing the dataset also loads the environmental variables
+    import dataset as ds
+    import pyramid_tools as pt
+
+    parser = argparse.ArgumentParser(description='Materialize the agg_data targets of a NOCS split')
+    parser.add_argument('--DATASET_NAME', type=str, default='CAMERA', choices=['CAMERA', 'REAL'])
+    parser.add_argument('--SPLIT', type=str, default='TRAIN', choices=['TRAIN', 'VALID', 'TEST'])
+    parser.add_argument('--RESOLUTION_SCALE', type=float, default=1.0)
+    args = parser.parse_args()
+
+    dataset_class = ds.CAMERADataset if args.DATASET_NAME == 'CAMERA' else ds.REALDataset
+
+    # All the classes are stored, class selection is done when loading the targets
+    dataset = dataset_class(
+        dataset_dir=pt.get_scaled_path(os.getenv(f'NOCS_{args.DATASET_NAME}_{args.SPLIT}_DATASET'), args.RESOLUTION_SCALE),
+        classes=None,
+        resolution_scale=args.RESOLUTION_SCALE
+    )
+
+    index = build_target_store(dataset)
+
+    print(f"Samples: {len(index['paths'])}")
@@ -1,11 +1,25 @@
+import os
+import sys
+import functools
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
 import albumentations as albu
 from albumentations.pytorch import ToTensor
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
 import general as g
+import instance_masks as im
 
 #-------------------------------------------------------------------------------
 # Pre-processing
 
+# The conversion is stateless, therefore it is only built once (instead of
+# once per sample)
+@functools.lru_cache(maxsize=None)
 def numpy_to_torch():
 
     conversion_transformation = albu.Compose([
@@ -27,6 +41,107 @@ def get_preprocessing(preprocessing_fn):
 
     return preprocessing_transform
 
+class ImageNormalization(torch.nn.Module):
+    """Device-side counterpart of the encoder's preprocessing_fn (see
+    segmentation_models_pytorch.encoders.get_preprocessing_fn), the max
+    magnitude normalization and the float32 conversion of NOCSDataset.create_sample.
+
+    The workers only ship the BxHxWx3 uint8 images and the normalization is
+    done in batch, in the same order and in float64 like the numpy version, so
+    that the results are bit-compatible.
+
+    Args:
+        mean (list): per-channel mean of the encoder (None to skip it)
+        std (list): per-channel standard deviation of the encoder (None to skip it)
+        input_space (str): 'RGB' or 'BGR' channel order of the encoder
+        input_range (list): [0,1] to map the images from [0,255] to [0,1]
+    """
+
+    def __init__(self, mean=None, std=None, input_space='RGB', input_range=None):
+        super().__init__()
+
+        self.input_space = input_space
+        self.input_range = input_range
+        self.has_mean = mean is not None
+        self.has_std = std is not None
+        self.is_float = self.has_mean or self.has_std
+
+        # Non-persistent, so that the checkpoints are not modified
+        for name, value in [('mean', mean), ('std', std)]:
+            value = torch.ones((1,3,1,1), dtype=torch.float64) if value is None else torch.tensor(value, dtype=torch.float64).reshape((1,-1,1,1))
+            self.register_buffer(name, value, persistent=False)
+
+    @classmethod
+    def from_preprocessing_fn(cls, preprocessing_fn):
+        """
+        Args:
+            preprocessing_fn (functools.partial): the preprocessing_fn given by
+                smp.encoders.get_preprocessing_fn (or None)
+        """
+
+        if preprocessing_fn is None:
+            return cls()
+
+        return cls(**{k:v for k,v in preprocessing_fn.keywords.items() if k in ['mean', 'std', 'input_space', 'input_range']})
+
+    def forward(self, image):
+        """
+        Args:
+            image (torch.Tensor): BxHxWx3 uint8 images
+        Output:
+            image (torch.Tensor): Bx3xHxW float32 normalized images
+        """
+
+        if self.input_space == 'BGR':
+            image = image.flip(-1)
+
+        # Changing to the torch layout convention
+        image = image.permute(0,3,1,2)
+
+        # Without the encoder normalization, the images are only converted 
+        # (skimage.img_as_float32)
+        if self.is_float is False:
+            return image.float() * (1. / 255)
+
+        x = image.double()
+
+        # Only the images with values larger than 1 are scaled (per image,
+        # like the preprocessing_fn)
+        if self.input_range is not None and self.input_range[1] == 1:
+            is_scaled = image.flatten(1).max(dim=1)[0] > 1
+            x = torch.where(is_scaled.reshape((-1,1,1,1)), x / 255.0, x)
+
+        if self.has_mean:
+            x = x - self.mean
+        if self.has_std:
+            x = x / self.std
+
+        # Normalize to maintain the -1 to +1 magnitude
+        x = x / x.abs().flatten(1).max(dim=1)[0].reshape((-1,1,1,1))
+
+        return x.float()
+
+def normalize_batch(batch, image_normalization):
+    """
+    Args:
+        batch (dict): collated batch with the BxHxWx3 uint8 images
+        image_normalization (ImageNormalization): the normalization module
+    Objective:
+        Normalize the images in the batch's device, the uint8 images are kept
+        as the clean images. Batches that are already normalized are passed
+        as is.
+    """
+
+    if batch is None or batch['image'].dtype != torch.uint8:
+        return batch
+
+    image_normalization.to(batch['image'].device)
+
+    batch['clean_image'] = batch['image']
+    batch['image'] = image_normalization(batch['image'])
+
+    return batch
+
 #-------------------------------------------------------------------------------
 # Training
 
@@ -67,6 +182,242 @@ def get_training_augmentation():
 
     return train_transform
 
+#-------------------------------------------------------------------------------
+# Batched Training Augmentation
+
+class BatchPoseAugmentation(object):
+    """Augmentation of whole collated batches (see dataset.my_collate_fn) as
+    torch tensors, in the main process or in the training device.
+
+    The geometric operations (scale, crop and horizontal flip) are applied to
+    the image, the class mask and the agg_data together. Scaling and cropping
+    keep the 3D pose and only change the camera intrinsics, so the projected
+    xy are re-derived with the per-sample intrinsics (stored in
+    batch['intrinsics']). The horizontal flip mirrors the scene along the
+    camera's X axis, therefore the R, T, RT and quaternion are mirrored too.
+    The photometric operations (brightness, contrast and noise) only change
+    the image.
+
+    Args:
+        intrinsics (np.ndarray): 3x3 camera intrinsics of the dataset (used
+            when the batch has no per-sample intrinsics)
+        flip_p (float): probability of the horizontal flip
+        scale_p (float): probability of the scale and crop
+        scale_range (tuple): range of the scale factor (< 1 pads the image)
+        photometric_p (float): probability of each photometric operation
+        brightness (float): maximum brightness shift
+        contrast (float): maximum relative contrast change
+        noise_std (float): standard deviation of the gaussian noise
+    """
+
+    def __init__(
+        self, 
+        intrinsics, 
+        flip_p=0.5, 
+        scale_p=0.5, 
+        scale_range=(0.8, 1.25),
+        photometric_p=0.5,
+        brightness=0.2,
+        contrast=0.2,
+        noise_std=0.03
+        ):
+
+        self.intrinsics = torch.as_tensor(np.asarray(intrinsics), dtype=torch.float32)
+        self.flip_p = flip_p
+        self.scale_p = scale_p
+        self.scale_range = scale_range
+        self.photometric_p = photometric_p
+        self.brightness = brightness
+        self.contrast = contrast
+        self.noise_std = noise_std
+
+    def __call__(self, batch):
+
+        # Empty batches (all invalid samples) are passed as is
+        if not batch:
+            return batch
+
+        b, _, h, w = batch['image'].shape
+        device = batch['image'].device
+
+        # Random per-sample geometric parameters
+        flips = torch.rand(b, device=device) < self.flip_p
+        scales = torch.empty(b, device=device).uniform_(*self.scale_range)
+        scales = torch.where(torch.rand(b, device=device) < self.scale_p, scales, torch.ones_like(scales))
+
+        affine = self.sample_affine(flips, scales, h, w)
+
+        batch['image'] = self.apply_photometric(batch['image'])
+        batch = self.apply_geometric(batch, affine, flips)
+
+        return batch
+
+    def sample_affine(self, flips, scales, h, w):
+        """
+        Args:
+            flips (torch.Tensor): B bool horizontal flips
+            scales (torch.Tensor): B scale factors
+            h, w (int): size of the images
+        Output:
+            affine (torch.Tensor): Bx3x3 mapping from the input pixel coordinates
+                to the output pixel coordinates (pixel centers)
+        """
+
+        b = scales.shape[0]
+        affine = torch.zeros((b, 3, 3), device=scales.device)
+        affine[:, 2, 2] = 1
+
+        # Crop window of size (h/s, w/s) in the input image (negative offsets
+        # when the window is larger than the image, i.e. padding)
+        for i, size in enumerate([h, w]):
+            window = size / scales
+            low = torch.min(torch.zeros_like(window), size - window)
+            high = torch.max(torch.zeros_like(window), size - window)
+            offset = low + (high - low) * torch.rand(b, device=scales.device)
+
+            # Mapping in the pixel-edge coordinates: e_out = s * (e_in - offset)
+            a = scales.clone()
+            c = -scales * offset
+
+            # Flip of the horizontal axis: e_out = w - e_out
+            if i == 1:
+                a = torch.where(flips, -a, a)
+                c = torch.where(flips, size - c, c)
+
+            # Converting to the pixel-center coordinates
+            affine[:, i, i] = a
+            affine[:, i, 2] = c + 0.5 * (a - 1)
+
+        # The rows were filled as (y, x), reordering them as (x, y)
+        affine = affine[:, [1, 0, 2]][:, :, [1, 0, 2]]
+
+        return affine
+
+    def apply_photometric(self, image):
+
+        b = image.shape[0]
+        device = image.device
+        view = (b, 1, 1, 1)
+
+        def random_switch():
+            return (torch.rand(view, device=device) < self.photometric_p).type(image.dtype)
+
+        # Brightness
+        shift = torch.empty(view, device=device).uniform_(-self.brightness, self.brightness)
+        image = image + random_switch() * shift
+
+        # Contrast (around the mean of each image)
+        factor = torch.empty(view, device=device).uniform_(1 - self.contrast, 1 + self.contrast)
+        mean = image.mean(dim=(1,2,3), keepdim=True)
+        image = image + random_switch() * (factor - 1) * (image - mean)
+
+        # Gaussian noise
+        image = image + random_switch() * self.noise_std * torch.randn_like(image)
+
+        return image
+
+    def warp(self, data, affine, mode):
+        """
+        Args:
+            data (torch.Tensor): BxCxHxW float data
+            affine (torch.Tensor): Bx3x3 (see sample_affine)
+            mode (str): 'bilinear' or 'nearest'
+        Output:
+            warped_data (torch.Tensor): BxCxHxW (zero outside the input)
+        """
+
+        b, _, h, w = data.shape
+
+        # affine_grid maps the normalized output to the normalized input
+        # coordinates (align_corners=False), n = (2 * p + 1) / size - 1
+        normalize = torch.tensor([[2/w, 0, 1/w - 1], [0, 2/h, 1/h - 1], [0, 0, 1]], device=data.device)
+        theta = normalize @ torch.inverse(affine) @ torch.inverse(normalize)
+
+        grid = F.affine_grid(theta[:, :2].type(data.dtype), data.shape, align_corners=False)
+
+        return F.grid_sample(data, grid, mode=mode, padding_mode='zeros', align_corners=False)
+
+    def apply_geometric(self, batch, affine, flips):
+
+        b, _, h, w = batch['image'].shape
+
+        # Image and class mask
+        batch['image'] = self.warp(batch['image'], affine, 'bilinear')
+        batch['mask'] = self.warp(batch['mask'][:,None].float(), affine, 'nearest')[:,0].type(batch['mask'].dtype)
+
+        # The clean image (BxHxWx3 uint8) is only used for visualization
+        if isinstance(batch.get('clean_image', None), torch.Tensor):
+            clean_image = batch['clean_image'].permute(0,3,1,2).float()
+            clean_image = self.warp(clean_image, affine, 'bilinear')
+            batch['clean_image'] = clean_image.round().clamp(0, 255).permute(0,2,3,1).type(batch['clean_image'].dtype)
+
+        # Intrinsics of each sample: K' = A @ K @ S (S mirrors the X axis), K
+        # is the sample's own intrinsics if any (e.g. crops)
+        mirror = torch.ones((b, 3), device=affine.device)
+        mirror[flips, 0] = -1
+        if isinstance(batch.get('intrinsics', None), torch.Tensor):
+            intrinsics = batch['intrinsics'].to(affine.device).float()
+        else:
+            intrinsics = self.intrinsics.to(affine.device)
+        batch['intrinsics'] = affine @ intrinsics @ torch.diag_embed(mirror)
+
+        agg_data = batch['agg_data']
+
+        if 'instance_masks' not in agg_data or len(agg_data['instance_masks']) == 0:
+            return batch
+
+        sample_ids = agg_data['sample_ids'].long()
+        instance_flips = flips[sample_ids]
+        instance_affine = affine[sample_ids]
+
+        # Instance masks (warped as a label map of all the instances)
+        num_of_instances = len(agg_data['instance_masks'])
+        instance_ids, ys, xs = agg_data['instance_masks'].pixel_indices()
+        label_map = torch.zeros((b, 1, h, w), device=affine.device)
+        label_map[sample_ids[instance_ids], 0, ys, xs] = (instance_ids + 1).float()
+        label_map = self.warp(label_map, affine, 'nearest')[:,0].long()
+        instance_masks, _ = im.InstanceMasks.from_label_map(label_map, num_of_instances)
+
+        # Projected centers
+        xy = agg_data['xy']
+        homogeneous_xy = torch.cat([xy, torch.ones_like(xy[:, :1])], dim=1)
+        agg_data['xy'] = (instance_affine.type(xy.dtype) @ homogeneous_xy[:,:,None])[:,:2,0]
+
+        # Mirroring the poses of the flipped samples (z and scales are kept)
+        if instance_flips.any():
+            s3 = torch.diag_embed(mirror[sample_ids])
+            s4 = torch.diag_embed(torch.cat([mirror[sample_ids], torch.ones_like(mirror[sample_ids, :1])], dim=1))
+
+            for key, s in [('R', s3), ('RT', s4)]:
+                if key in agg_data:
+                    s = s.type(agg_data[key].dtype)
+                    agg_data[key] = s @ agg_data[key] @ s
+
+            if 'T' in agg_data:
+                agg_data['T'] = agg_data['T'] * mirror[sample_ids].type(agg_data['T'].dtype)
+            
+            # Quaternion (x,y,z,w): conjugating by the mirror negates y and z
+            if 'quaternion' in agg_data:
+                q_mirror = torch.tensor([1, -1, -1, 1], device=affine.device, dtype=agg_data['quaternion'].dtype)
+                agg_data['quaternion'] = torch.where(
+                    instance_flips[:,None],
+                    agg_data['quaternion'] * q_mirror,
+                    agg_data['quaternion']
+                )
+
+        agg_data['instance_masks'] = instance_masks
+
+        # Removing the instances that were cropped out of the image (the
+        # offsets of each sample's instances are updated)
+        visible = instance_masks.areas() > 0
+        if not visible.all():
+            batch['agg_data'] = agg_data.select(visible)
+
+        return batch
+
+def get_batch_training_augmentation(intrinsics):
+    return BatchPoseAugmentation(intrinsics)
+
 #-------------------------------------------------------------------------------
 # Validation
 
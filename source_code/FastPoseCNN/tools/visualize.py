@@ -665,10 +665,14 @@ def compare_hough_voting_performance(image, preds_agg_data, return_as_figure=Tru
 
     for sequence_id, sample_id in enumerate(sample_ids):
 
+        # Creating the dense instance mask and its unit vectors on demand
+        instance_mask = preds_agg_data['instance_masks'].to_dense(sequence_id)
+        xy_mask = instance_mask * preds_agg_data['xy_img'][sample_id]
+
         # Visualize the pred uv
         pred_vis_uv_img = torch.from_numpy(get_visualized_u_vector_xy(
-            preds_agg_data['instance_masks'][sequence_id].cpu().numpy(),
-            preds_agg_data['xy_mask'][sequence_id].cpu().numpy()
+            instance_mask.cpu().numpy(),
+            xy_mask.detach().cpu().numpy()
         )).cpu()
 
         # Visualize gt hypothesis (casting from float to uint8)
@@ -676,7 +680,7 @@ def compare_hough_voting_performance(image, preds_agg_data, return_as_figure=Tru
             preds_agg_data['hypothesis'][sequence_id],
             preds_agg_data['pruned_hypothesis'][sequence_id],
             preds_agg_data['xy'][sequence_id],
-            preds_agg_data['instance_masks'][sequence_id],
+            instance_mask,
         )*255).type(torch.uint8).cpu()
 
         drawn_pred_uv[sample_id] = torch.where(
@@ -140,7 +140,10 @@ if __name__ == '__main__':
     HPARAM.DISTRIBUTED_BACKEND = None if HPARAM.NUM_GPUS <= 1 else HPARAM.DISTRIBUTED_BACKEND
 
     # Add the numpy instrinsics to the hyperparameters given the dataset name
-    HPARAM.NUMPY_INTRINSICS = tools.pj.constants.INTRINSICS[HPARAM.DATASET_NAME]
+    HPARAM.NUMPY_INTRINSICS = tools.pt.scale_intrinsics(
+        tools.pj.constants.INTRINSICS[HPARAM.DATASET_NAME],
+        HPARAM.RESOLUTION_SCALE
+    )
 
     # Creating data module
     dataset = tools.ds.PoseRegressionDataModule(
@@ -152,7 +155,25 @@ if __name__ == '__main__':
         encoder_weights=HPARAM.ENCODER_WEIGHTS,
         train_size=HPARAM.TRAIN_SIZE,
         valid_size=HPARAM.VALID_SIZE,
-        is_deterministic=HPARAM.DETERMINISTIC
+        is_deterministic=HPARAM.DETERMINISTIC,
+        use_shards=HPARAM.USE_SHARDS,
+        use_streaming=HPARAM.USE_STREAMING,
+        subset_strategy=HPARAM.SUBSET_STRATEGY,
+        subset_seed=HPARAM.SUBSET_SEED,
+        prefetch_batches=HPARAM.PREFETCH_BATCHES,
+        prefetch_device='cuda' if HPARAM.NUM_GPUS > 0 else None,
+        cache_splits=[x for x in HPARAM.SAMPLE_CACHE_SPLITS.split(',') if x],
+        cache_bytes=int(HPARAM.SAMPLE_CACHE_GB * 1024**3),
+        device_normalization=HPARAM.DEVICE_NORMALIZATION,
+        resolution_scale=HPARAM.RESOLUTION_SCALE,
+        readahead_depth=HPARAM.READAHEAD_DEPTH,
+        readahead_threads=HPARAM.READAHEAD_THREADS,
+        staging_bytes=int(HPARAM.STAGING_GB * 1024**3),
+        staging_check_source=HPARAM.STAGING_CHECK_SOURCE,
+        check_targets=HPARAM.CHECK_TARGETS,
+        crop_size=HPARAM.CROP_SIZE,
+        crop_margin=HPARAM.CROP_MARGIN,
+        shared_collate=HPARAM.SHARED_COLLATE
     )
 
     # Selecting the criterion (specific to each task)
@@ -230,7 +251,8 @@ if __name__ == '__main__':
         model=base_model,
         criterion=criterion,
         metrics=metrics,
-        HPARAM=HPARAM
+        HPARAM=HPARAM,
+        batch_augmentation=tools.transforms.pose.get_batch_training_augmentation(HPARAM.NUMPY_INTRINSICS) if HPARAM.BATCH_AUGMENTATION else None
     )
 
     # If no runs this day, create a runs-of-the-day folder
@@ -323,7 +345,10 @@ if __name__ == '__main__':
             tensorboard_callback, 
             loss_checkpoint_callback,
             ckpt_save_n_callback],
-        gradient_clip_val=0.15
+        gradient_clip_val=0.15,
+        # The datamodule shards the samples by rank itself (DistributedSampler
+        # or the readahead's ReadaheadSampler, see get_loader)
+        replace_sampler_ddp=False
     )
 
     # Train